@@ -1,6 +1,17 @@
 #!/usr/bin/env sh
 
-python -m openshift_metrics.merge /data/*.json \
+# every kind of metrics file the collector writes, skipping patterns that match nothing
+set --
+for file in /data/*.json /data/*.json.gz /data/*.ndjson /data/*.ndjson.gz /data/*.columnar; do
+    [ -e "$file" ] || continue
+    # a .columnar file written alongside holds the same samples and is quicker to read
+    case "$file" in
+        *.json | *.ndjson) [ -e "${file%.*}.columnar" ] && continue ;;
+    esac
+    set -- "$@" "$file"
+done
+
+python -m openshift_metrics.merge "$@" \
     --invoice-file /tmp/invoice.csv \
     --class-invoice-file /tmp/class.csv \
     --pod-report-file /tmp/pod-report.csv \
@@ -0,0 +1,212 @@
+"""Collects a range of days in parallel, writing one metrics file per day"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from openshift_metrics import utils
+from openshift_metrics.concurrency_governor import ConcurrencyGovernor
+from openshift_metrics.metrics_file import encode_metrics
+from openshift_metrics.coverage_index import (
+    CoverageIndex,
+    days as day_range,
+    metrics_key,
+)
+from openshift_metrics.openshift_prometheus_metrics import (
+    URL_CLUSTER_NAME_MAPPING,
+    collect_metrics,
+)
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.query_cache import QueryCache
+from openshift_metrics.config import (
+    OPENSHIFT_PROMETHEUS_URL,
+    OPENSHIFT_TOKEN,
+    S3_METRICS_BUCKET,
+    PROM_QUERY_INTERVAL_MINUTES,
+    PROM_QUERY_CONCURRENCY,
+    PROM_QUERY_REQUEST_BUDGET,
+    PROM_QUERY_CACHE_DIR,
+    PROM_QUERY_CACHE_MAX_BYTES,
+    PROM_QUERY_CACHE_MIN_AGE_HOURS,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def backfill_day(
+    prom_client,
+    day,
+    output_dir,
+    cluster_name,
+    upload_to_s3=False,
+    combined_query=False,
+    project_labels=False,
+    runs=False,
+):
+    """Collects the metrics of day into metrics-<day>.json and uploads it"""
+    metrics_dict = {}
+    metrics_dict["start_date"] = day
+    metrics_dict["end_date"] = day
+    metrics_dict["interval_minutes"] = prom_client.step_min
+    metrics_dict["cluster_name"] = cluster_name
+    metrics_dict.update(
+        collect_metrics(
+            prom_client,
+            day,
+            day,
+            combined_query=combined_query,
+            project_labels=project_labels,
+        )
+    )
+
+    if runs:
+        encode_metrics(metrics_dict, prom_client.step_min * 60)
+
+    output_file = os.path.join(output_dir, f"metrics-{day}.json")
+    # written under another name first so a crash never leaves half a day behind
+    with open(f"{output_file}.tmp", "w") as file:
+        json.dump(metrics_dict, file)
+    os.replace(f"{output_file}.tmp", output_file)
+    logger.info(f"Wrote metrics for {day} to {output_file}")
+
+    if upload_to_s3:
+        utils.upload_to_s3(output_file, S3_METRICS_BUCKET, metrics_key(day, day))
+
+
+def main():
+    """Collects the metrics for every day of the range"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--openshift-url",
+        help="OpenShift Prometheus URL",
+        default=OPENSHIFT_PROMETHEUS_URL,
+    )
+    parser.add_argument(
+        "--report-start-date", required=True, help="first day (ex: 2022-03-01)"
+    )
+    parser.add_argument(
+        "--report-end-date", required=True, help="last day (ex: 2022-03-31)"
+    )
+    parser.add_argument(
+        "--output-dir", default=".", help="Directory to write the daily files to"
+    )
+    parser.add_argument("--upload-to-s3", action="store_true")
+    parser.add_argument(
+        "--parallel-days",
+        type=int,
+        default=4,
+        help="How many days are collected at the same time",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Collect the days that already have a file in --output-dir again",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=PROM_QUERY_CACHE_DIR,
+        help="Cache the results of queries for past time ranges in this directory",
+    )
+    parser.add_argument(
+        "--project-labels",
+        action="store_true",
+        help="Only fetch the labels of the resource requests that the reports use",
+    )
+    parser.add_argument(
+        "--combined-query",
+        action="store_true",
+        help="Fetch the CPU, memory and GPU requests with a single query and split them by resource",
+    )
+    parser.add_argument(
+        "--runs",
+        action="store_true",
+        help="Write every series as runs of equal values rather than one value per step",
+    )
+
+    args = parser.parse_args()
+    if not args.openshift_url:
+        sys.exit(
+            "Must specify --openshift-url or set OPENSHIFT_PROMETHEUS_URL in your environment"
+        )
+    days = day_range(args.report_start_date, args.report_end_date)
+    if not days:
+        sys.exit("report_start_date cannot be after report_end_date")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if not args.overwrite:
+        done = [
+            day
+            for day in days
+            if os.path.exists(os.path.join(args.output_dir, f"metrics-{day}.json"))
+        ]
+        if done:
+            logger.info(f"Skipping {len(done)} days that already have a file")
+        days = [day for day in days if day not in done]
+
+    cache = None
+    if args.cache_dir:
+        cache = QueryCache(
+            args.cache_dir,
+            PROM_QUERY_CACHE_MAX_BYTES,
+            timedelta(hours=PROM_QUERY_CACHE_MIN_AGE_HOURS),
+        )
+
+    # the days share one client, so PROM_QUERY_CONCURRENCY caps the queries of
+    # all of them together rather than of each one
+    prom_client = PrometheusClient(
+        args.openshift_url,
+        OPENSHIFT_TOKEN,
+        PROM_QUERY_INTERVAL_MINUTES,
+        max_workers=PROM_QUERY_CONCURRENCY,
+        cache=cache,
+        governor=ConcurrencyGovernor(
+            PROM_QUERY_CONCURRENCY, budget=PROM_QUERY_REQUEST_BUDGET or None
+        ),
+    )
+    cluster_name = URL_CLUSTER_NAME_MAPPING.get(args.openshift_url, args.openshift_url)
+
+    with prom_client, ThreadPoolExecutor(max_workers=args.parallel_days) as executor:
+        futures = {
+            day: executor.submit(
+                backfill_day,
+                prom_client,
+                day,
+                args.output_dir,
+                cluster_name,
+                upload_to_s3=args.upload_to_s3,
+                combined_query=args.combined_query,
+                project_labels=args.project_labels,
+                runs=args.runs,
+            )
+            for day in days
+        }
+        failed = []
+        for day, future in futures.items():
+            try:
+                future.result()
+            except Exception:
+                logger.exception(f"Collecting metrics for {day} failed")
+                failed.append(day)
+
+    if args.upload_to_s3 and len(failed) < len(days):
+        coverage_index = CoverageIndex(S3_METRICS_BUCKET).load()
+        for day in days:
+            if day not in failed:
+                coverage_index.add(
+                    day, day, PROM_QUERY_INTERVAL_MINUTES, metrics_key(day, day)
+                )
+        coverage_index.save()
+
+    if failed:
+        sys.exit(
+            f"Collecting metrics failed for {', '.join(failed)}, rerun to collect only those days"
+        )
+
+
+if __name__ == "__main__":
+    main()
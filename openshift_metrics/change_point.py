@@ -0,0 +1,216 @@
+"""Collects range queries at a coarse resolution, refining only where values change"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from openshift_metrics import promql
+from openshift_metrics.prometheus_client import (
+    PrometheusClient,
+    date_range,
+    stitch_results,
+)
+from openshift_metrics.utils import EmptyResultError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COARSE_FUNCTIONS = ["min_over_time", "max_over_time", "count_over_time"]
+
+
+def series_key(labels: dict):
+    """Identifies a series by its labels, ignoring the metric name"""
+    return tuple(sorted((k, v) for k, v in labels.items() if k != "__name__"))
+
+
+class ChangePointCollector:
+    """
+    Sits in front of a PrometheusClient and fetches range queries in two
+    passes. Most series keep the same value for hours, so the query is first
+    scanned in windows of window_steps steps with min_over_time,
+    max_over_time and count_over_time subqueries. A series whose minimum and
+    maximum agree and that has a sample at every step of a window is
+    constant there, and its samples are filled in without fetching them.
+    Only the windows where a series changes or has gaps are queried at the
+    full resolution, and only for the pods of those series.
+
+    The result is the same as that of a plain query_range.
+    """
+
+    def __init__(self, prom_client, window_steps: int, max_pods_per_query: int = 100):
+        self.prom_client = prom_client
+        self.window_steps = window_steps
+        self.max_pods_per_query = max_pods_per_query
+        self.max_workers = prom_client.max_workers
+        self.coarse_client = PrometheusClient(
+            prom_client.prometheus_url,
+            prom_client.token,
+            step_min=prom_client.step_min * window_steps,
+            max_workers=prom_client.max_workers,
+            cache=prom_client.cache,
+            governor=prom_client.governor,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.coarse_client.close()
+        self.prom_client.close()
+
+    def submit(self, metric, start_date, end_date):
+        """Queries metric in the background, returns a Future for the result"""
+        return self._executor.submit(self.query_metric, metric, start_date, end_date)
+
+    def submit_series(self, selector, start_date, end_date):
+        """Label sets are cheap to fetch, so they go straight to the client"""
+        return self._executor.submit(
+            self.prom_client.query_series, selector, start_date, end_date
+        )
+
+    def query_metric(self, metric, start_date, end_date):
+        """Queries metric for the report dates"""
+        start, end = date_range(start_date, end_date)
+        return self.query_range(metric, start, end)
+
+    def query_range(self, metric, start: datetime, end: datetime):
+        """Queries metric between start and end, refining only where it changes"""
+        step = timedelta(minutes=self.prom_client.step_min)
+        window = step * self.window_steps
+        windows = ((end - start) // step + 1) // self.window_steps
+
+        # subqueries are evaluated on steps counted from the epoch, which only
+        # line up with the steps of query_range if start is on one of them
+        if start.timestamp() % step.total_seconds() or windows < 2:
+            return self.prom_client.query_range(metric, start, end)
+
+        stats = self._scan(metric, start, windows, step, window)
+        name = promql.metric_name(metric)
+
+        values = {}
+        labels = {}
+        refine = {}
+        for key, series_stats in stats.items():
+            labels[key] = dict(key)
+            if name is not None:
+                labels[key]["__name__"] = name
+            for index, (minimum, maximum, count) in series_stats.items():
+                window_start = start + index * window
+                if count == self.window_steps and minimum == maximum:
+                    points = values.setdefault(key, {})
+                    for i in range(self.window_steps):
+                        timestamp = int((window_start + i * step).timestamp())
+                        points[timestamp] = minimum
+                else:
+                    refine.setdefault(index, []).append(key)
+
+        pieces = []
+        for index, keys in sorted(refine.items()):
+            window_start = start + index * window
+            window_end = window_start + window - step
+            for query in self._refine_queries(metric, keys):
+                pieces.append((query, window_start, window_end, set(keys)))
+        # the steps after the last full window were never scanned
+        tail_start = start + windows * window
+        if tail_start <= end:
+            pieces.append((metric, tail_start, end, None))
+
+        logger.info(
+            f"Refining {len(refine)} of {windows} windows with {len(pieces)} queries for {metric}"
+        )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(
+                executor.map(
+                    lambda piece: self._fetch(self.prom_client, *piece[:3]), pieces
+                )
+            )
+        for (*_, keys), result in zip(pieces, results):
+            for series in result:
+                key = series_key(series["metric"])
+                if keys is not None and key not in keys:
+                    continue
+                labels.setdefault(key, series["metric"])
+                points = values.setdefault(key, {})
+                for timestamp, value in series["values"]:
+                    points[timestamp] = value
+
+        data = stitch_results(
+            [
+                [
+                    {
+                        "metric": labels[key],
+                        "values": [list(point) for point in sorted(points.items())],
+                    }
+                    for key, points in values.items()
+                ]
+            ]
+        )
+        if not data:
+            raise EmptyResultError(f"Error retrieving metric: {metric}")
+        return data
+
+    def _scan(self, metric, start: datetime, windows: int, step, window):
+        """
+        Returns {series: {window: (min, max, count)}} for the first windows
+        windows after start. A window is left out for a series with no samples
+        in it.
+        """
+        subquery = (
+            f"({metric})[{int(window.total_seconds()) - 1}s:"
+            f"{int(step.total_seconds())}s]"
+        )
+        first_end = start + window - step
+        last_end = first_end + (windows - 1) * window
+        with ThreadPoolExecutor(max_workers=len(COARSE_FUNCTIONS)) as executor:
+            results = list(
+                executor.map(
+                    lambda function: self._fetch(
+                        self.coarse_client,
+                        f"{function}({subquery})",
+                        first_end,
+                        last_end,
+                    ),
+                    COARSE_FUNCTIONS,
+                )
+            )
+        stats = {}
+        for position, result in enumerate(results):
+            for series in result:
+                series_stats = stats.setdefault(series_key(series["metric"]), {})
+                for timestamp, value in series["values"]:
+                    index = int(
+                        (timestamp - first_end.timestamp()) // window.total_seconds()
+                    )
+                    window_stats = series_stats.setdefault(index, [None, None, 0])
+                    window_stats[position] = int(value) if position == 2 else value
+        return stats
+
+    def _refine_queries(self, metric, keys):
+        """Returns the queries that fetch the series keys at full resolution"""
+        pods = sorted({dict(key).get("pod") for key in keys})
+        if None in pods:
+            return [metric]
+        return [
+            promql.add_label_matcher(
+                metric,
+                promql.regex_matcher("pod", pods[i : i + self.max_pods_per_query]),
+            )
+            for i in range(0, len(pods), self.max_pods_per_query)
+        ]
+
+    @staticmethod
+    def _fetch(prom_client, query, start: datetime, end: datetime):
+        """
+        Fetches query between start and end. Unlike query_range an empty
+        result is fine here, a window may well have no samples.
+        """
+        logger.info(f"Retrieving metric: {query} from {start} to {end}")
+        data = prom_client._fetch_range(query, start, end)
+        if data is None:
+            raise EmptyResultError(f"Error retrieving metric: {query}")
+        return data
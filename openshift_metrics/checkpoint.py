@@ -0,0 +1,110 @@
+"""Keeps the pieces of a collection that are done so a rerun can pick up from there"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MANIFEST = "manifest.json"
+
+
+class Checkpoint:
+    """
+    A work directory holding the result of every query piece (a query over
+    one time slice) that has been fetched, one JSON file each, along with a
+    manifest.json listing the pieces that are complete.
+
+    A piece is only added to the manifest once its file is written, so a
+    collector that dies halfway leaves nothing half done behind, and a rerun
+    with the same arguments only fetches the pieces that aren't listed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.pieces = self._read_manifest()
+        # every file of ours in the directory, which is all remove deletes
+        self._files = {MANIFEST} | {piece["file"] for piece in self.pieces.values()}
+        if self.pieces:
+            logger.info(f"Resuming with {len(self.pieces)} pieces from {directory}")
+
+    @staticmethod
+    def key(prometheus_url, query, start: datetime, end: datetime, step_min) -> str:
+        """Returns the key of a query piece"""
+        piece = json.dumps(
+            [prometheus_url, query, start.isoformat(), end.isoformat(), step_min]
+        )
+        return hashlib.sha256(piece.encode()).hexdigest()
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as file:
+                return json.load(file)["pieces"]
+        except FileNotFoundError:
+            return {}
+
+    def _write_json(self, file_name, data):
+        """Writes a file in the work directory so it's either all there or not at all"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(data, file)
+            os.replace(temp_path, os.path.join(self.directory, file_name))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def get(self, key):
+        """Returns the result of a complete piece, or None if it isn't done"""
+        with self._lock:
+            piece = self.pieces.get(key)
+        if piece is None:
+            return None
+        try:
+            with open(os.path.join(self.directory, piece["file"])) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            logger.warning(f"Fetching {piece['query']} again, its file is unreadable")
+            with self._lock:
+                self.pieces.pop(key, None)
+            return None
+
+    def put(self, key, query, start: datetime, end: datetime, data):
+        """Saves the result of a piece and marks it as complete"""
+        file_name = f"{key}.json"
+        with self._lock:
+            self._files.add(file_name)
+        self._write_json(file_name, data)
+        with self._lock:
+            self.pieces[key] = {
+                "query": query,
+                "start": start.isoformat(),
+                "end": end.isoformat(),
+                "file": file_name,
+                "series": len(data),
+            }
+            self._write_json(MANIFEST, {"pieces": self.pieces})
+
+    def remove(self):
+        """
+        Deletes the manifest and the piece files once the metrics file is
+        written, and the work directory if nothing else is left in it
+        """
+        with self._lock:
+            for file_name in self._files:
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    pass
+            self._files = set()
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
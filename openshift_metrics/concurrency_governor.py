@@ -0,0 +1,140 @@
+"""Adapts how many requests are sent to prometheus at once to how it copes"""
+
+import logging
+import threading
+import time
+from datetime import datetime, UTC
+from email.utils import parsedate_to_datetime
+
+from openshift_metrics.utils import RequestBudgetError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Statuses prometheus and thanos answer with when they are overloaded
+THROTTLE_STATUSES = [429, 503]
+
+
+def parse_retry_after(value, now: datetime = None):
+    """
+    Returns the number of seconds a Retry-After header asks to wait, or None
+    if there's no usable header. It's either a number of seconds or a date.
+    """
+    if not isinstance(value, str) or not value.strip():
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - (now or datetime.now(UTC))).total_seconds())
+
+
+class ConcurrencyGovernor:
+    """
+    Limits the requests in flight with additive increase, multiplicative
+    decrease (AIMD). The limit starts at initial_limit, max_limit unless
+    given, and goes up by about one every time a full limit of requests
+    succeed with a healthy latency, up to max_limit. It's cut by decrease_factor when a request is throttled or
+    takes more than latency_tolerance times the average for its kind of
+    request, and at least min_slow_latency seconds. Only requests sent after
+    the last cut can cut it again, so a burst of slow responses counts once.
+
+    A throttled request's Retry-After holds back every request, not just its
+    retry. At most budget requests are sent in total if a budget is given.
+
+    The governor is thread safe and meant to be shared by all the clients of
+    a run.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        min_limit: int = 1,
+        initial_limit: int = None,
+        budget: int = None,
+        latency_tolerance: float = 3.0,
+        decrease_factor: float = 0.5,
+        min_slow_latency: float = 1.0,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.budget = budget
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.min_slow_latency = min_slow_latency
+        if initial_limit is None:
+            initial_limit = max_limit
+        self.limit = float(min(max(initial_limit, self.min_limit), max_limit))
+        self.in_flight = 0
+        self.sent = 0
+        self.throttled = 0
+        self._latencies = {}
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> float:
+        """
+        Waits until a request may be sent and returns when it was let through,
+        which release needs. Raises RequestBudgetError once the budget is spent.
+        """
+        with self._condition:
+            while True:
+                if self.budget is not None and self.sent >= self.budget:
+                    raise RequestBudgetError(
+                        f"Sent all {self.budget} requests of the request budget"
+                    )
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+            self.sent += 1
+            return time.monotonic()
+
+    def release(
+        self, started: float, kind: str = "", throttled=False, retry_after=None
+    ):
+        """
+        Records how a request that was let through at started went. A
+        throttled request pauses all requests for retry_after seconds.
+        """
+        now = time.monotonic()
+        latency = now - started
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                self._decrease(started, now, "throttled")
+            else:
+                average = self._latencies.get(kind)
+                if average is not None and latency > max(
+                    average * self.latency_tolerance, self.min_slow_latency
+                ):
+                    self._decrease(started, now, f"{latency:.1f}s latency")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._latencies[kind] = (
+                    latency if average is None else 0.8 * average + 0.2 * latency
+                )
+            self._condition.notify_all()
+
+    def _decrease(self, started: float, now: float, reason: str):
+        if started < self._last_decrease:
+            return
+        self._last_decrease = now
+        limit = max(self.min_limit, self.limit * self.decrease_factor)
+        if int(limit) < int(self.limit):
+            logger.warning(
+                f"Lowering prometheus concurrency from {int(self.limit)} to {int(limit)} ({reason})"
+            )
+        self.limit = limit
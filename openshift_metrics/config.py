@@ -14,5 +14,21 @@ S3_ACCESS_KEY_ID = os.getenv("S3_OUTPUT_ACCESS_KEY_ID")
 S3_SECRET_ACCESS_KEY = os.getenv("S3_OUTPUT_SECRET_ACCESS_KEY")
 S3_INVOICE_BUCKET = os.getenv("S3_INVOICE_BUCKET", "nerc-invoicing")
 S3_METRICS_BUCKET = os.getenv("S3_METRICS_BUCKET", "openshift_metrics")
+# The size of the parts of multipart uploads, S3 needs at least 5 MiB
+S3_MULTIPART_PART_BYTES = int(os.getenv("S3_MULTIPART_PART_BYTES", 8 * 2**20))
+assert S3_MULTIPART_PART_BYTES >= 5 * 2**20, "Multipart parts must be at least 5 MiB"
 PROM_QUERY_INTERVAL_MINUTES = int(os.getenv("PROM_QUERY_INTERVAL_MINUTES", 15))
 assert PROM_QUERY_INTERVAL_MINUTES >= 1, "Query interval must be at least 1 minute"
+PROM_QUERY_CONCURRENCY = int(os.getenv("PROM_QUERY_CONCURRENCY", 5))
+assert PROM_QUERY_CONCURRENCY >= 1, "Query concurrency must be at least 1"
+PROM_QUERY_MAX_SAMPLES = int(os.getenv("PROM_QUERY_MAX_SAMPLES", 10000000))
+# The most requests a run may send to prometheus, 0 for no limit
+PROM_QUERY_REQUEST_BUDGET = int(os.getenv("PROM_QUERY_REQUEST_BUDGET", 0))
+PROM_QUERY_CACHE_DIR = os.getenv("PROM_QUERY_CACHE_DIR")
+PROM_QUERY_CACHE_MAX_BYTES = int(os.getenv("PROM_QUERY_CACHE_MAX_BYTES", 2**30))
+PROM_QUERY_CACHE_MIN_AGE_HOURS = int(os.getenv("PROM_QUERY_CACHE_MIN_AGE_HOURS", 6))
+NODE_LABEL_CACHE = os.getenv("NODE_LABEL_CACHE")
+PROM_CHANGE_POINT_WINDOW_STEPS = int(os.getenv("PROM_CHANGE_POINT_WINDOW_STEPS", 16))
+assert PROM_CHANGE_POINT_WINDOW_STEPS >= 2, (
+    "Change point windows must be at least 2 steps"
+)
@@ -0,0 +1,123 @@
+"""Keeps track of which days of metrics a bucket already holds"""
+
+import json
+import logging
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta
+
+from openshift_metrics import utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COVERAGE_KEY = "coverage.json"
+METRICS_KEY_RE = re.compile(
+    r"data_\d{4}-\d{2}/metrics-(\d{4}-\d{2}-\d{2})(?:-to-(\d{4}-\d{2}-\d{2}))?\.(?:(?:nd)?json(?:\.gz)?|columnar)"
+)
+
+
+def metrics_key(report_start_date, report_end_date, extension="json") -> str:
+    """Returns the key the metrics file of a report period is uploaded to"""
+    month_year = datetime.strptime(report_start_date, "%Y-%m-%d").strftime("%Y-%m")
+    if report_start_date == report_end_date:
+        return f"data_{month_year}/metrics-{report_start_date}.{extension}"
+    return f"data_{month_year}/metrics-{report_start_date}-to-{report_end_date}.{extension}"
+
+
+def days(start_date, end_date) -> list:
+    """Returns every day from start_date to end_date"""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    return [
+        (start + timedelta(days=i)).strftime("%Y-%m-%d")
+        for i in range((end - start).days + 1)
+    ]
+
+
+class CoverageIndex:
+    """
+    The report periods whose metrics files are in a bucket and the interval
+    they were collected at, kept in the coverage.json object of the bucket.
+
+    When there's no coverage.json yet the periods are read from the keys of
+    the metrics files. Their interval is unknown then, and they are taken to
+    be at whatever interval is asked for.
+    """
+
+    def __init__(self, bucket: str):
+        self.bucket = bucket
+        self.ranges = []
+
+    def load(self):
+        """Reads the index from the bucket"""
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, COVERAGE_KEY)
+            if utils.download_from_s3(self.bucket, COVERAGE_KEY, file_name):
+                with open(file_name) as file:
+                    self.ranges = json.load(file)["ranges"]
+            else:
+                self.ranges = self._ranges_from_keys()
+        logger.info(f"s3://{self.bucket} holds {len(self.ranges)} metrics files")
+        return self
+
+    def _ranges_from_keys(self) -> list:
+        ranges = []
+        for key in utils.list_s3_keys(self.bucket, "data_"):
+            match = METRICS_KEY_RE.fullmatch(key)
+            if match:
+                start_date, end_date = match.groups()
+                ranges.append(
+                    {
+                        "start_date": start_date,
+                        "end_date": end_date or start_date,
+                        "interval_minutes": None,
+                        "key": key,
+                    }
+                )
+        return ranges
+
+    def save(self):
+        """Writes the index back to the bucket"""
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, COVERAGE_KEY)
+            with open(file_name, "w") as file:
+                json.dump({"ranges": self.ranges}, file, indent=2)
+            utils.upload_to_s3(file_name, self.bucket, COVERAGE_KEY)
+
+    def add(self, start_date, end_date, interval_minutes, key):
+        """Records that the metrics from start_date to end_date were uploaded to key"""
+        self.ranges = [r for r in self.ranges if r["key"] != key]
+        self.ranges.append(
+            {
+                "start_date": start_date,
+                "end_date": end_date,
+                "interval_minutes": interval_minutes,
+                "key": key,
+            }
+        )
+        self.ranges.sort(key=lambda r: (r["start_date"], r["end_date"], r["key"]))
+        return self
+
+    def missing_ranges(self, start_date, end_date, interval_minutes) -> list:
+        """
+        Returns the (start_date, end_date) periods between start_date and
+        end_date that have no metrics at interval_minutes, each as long as
+        possible.
+        """
+        covered = set()
+        for r in self.ranges:
+            if r["interval_minutes"] in (None, interval_minutes):
+                covered.update(days(r["start_date"], r["end_date"]))
+
+        missing = []
+        for day in days(start_date, end_date):
+            if day in covered:
+                continue
+            previous = datetime.strptime(day, "%Y-%m-%d") - timedelta(days=1)
+            if missing and missing[-1][1] == previous.strftime("%Y-%m-%d"):
+                missing[-1] = (missing[-1][0], day)
+            else:
+                missing.append((day, day))
+        return missing
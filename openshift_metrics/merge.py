@@ -2,22 +2,34 @@
 Merges metrics from files and produces reports by pod and by namespace
 """
 
+import re
 import sys
 import logging
 import argparse
 from datetime import datetime, UTC, timedelta
-import json
 from typing import Tuple
 from decimal import Decimal
 from nerc_rates import rates, outages
 
-from openshift_metrics import utils, invoice
+from openshift_metrics import utils, invoice, metrics_file
 from openshift_metrics.metrics_processor import MetricsProcessor
-from openshift_metrics.config import S3_INVOICE_BUCKET, PROM_QUERY_INTERVAL_MINUTES
+from openshift_metrics.node_label_cache import NodeLabelCache
+from openshift_metrics.config import (
+    S3_INVOICE_BUCKET,
+    PROM_QUERY_INTERVAL_MINUTES,
+    NODE_LABEL_CACHE,
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The metric the series of every list of a metrics file are merged as
+METRIC_NAMES = {
+    "cpu_metrics": "cpu_request",
+    "memory_metrics": "memory_request",
+    "gpu_metrics": "gpu_request",
+}
+
 
 def compare_dates(date_str1, date_str2):
     """Returns true is date1 is earlier than date2"""
@@ -43,6 +55,41 @@ def parse_timestamp_range(timestamp_range: str) -> Tuple[datetime, datetime]:
         )
 
 
+def namespace_filter(namespaces=None, namespace_regex=None):
+    """
+    Returns a function that checks if a series is in one of namespaces, or in
+    a namespace matching namespace_regex, or None if neither is given. Like
+    prometheus the regular expression has to match the whole namespace.
+    """
+    if namespaces:
+        namespaces = set(namespaces)
+        return lambda metric: metric["metric"].get("namespace") in namespaces
+    if namespace_regex:
+        pattern = re.compile(namespace_regex)
+        return lambda metric: (
+            pattern.fullmatch(metric["metric"].get("namespace", "")) is not None
+        )
+    return None
+
+
+def load_metrics_file(file_name) -> dict:
+    """
+    Reads a metrics file of any format. Of an NDJSON file only the header is
+    read, its series are read as they're merged, and a columnar file is
+    memory-mapped rather than read.
+    """
+    return metrics_file.read_metrics_file(file_name)
+
+
+def load_metrics_files(files):
+    """
+    Yields the contents of files in order, reading each one once it's needed
+    so only one file is held in memory at a time
+    """
+    for file in files:
+        yield load_metrics_file(file)
+
+
 def get_su_definitions(report_month) -> dict:
     su_definitions = {}
     rates_data = rates.load_from_url()
@@ -67,6 +114,20 @@ def get_su_definitions(report_month) -> dict:
     return su_definitions
 
 
+def load_nerc_rates(report_month) -> invoice.Rates:
+    """Returns the SU rates of report_month from the nerc-rates repo"""
+    rates_data = rates.load_from_url()
+    return invoice.Rates(
+        cpu=rates_data.get_value_at("CPU SU Rate", report_month, Decimal),
+        gpu_a100=rates_data.get_value_at("GPUA100 SU Rate", report_month, Decimal),
+        gpu_a100sxm4=rates_data.get_value_at(
+            "GPUA100SXM4 SU Rate", report_month, Decimal
+        ),
+        gpu_v100=rates_data.get_value_at("GPUV100 SU Rate", report_month, Decimal),
+        gpu_h100=rates_data.get_value_at("GPUH100 SU Rate", report_month, Decimal),
+    )
+
+
 def main():
     """Reads the metrics from files and generates the reports"""
     parser = argparse.ArgumentParser()
@@ -95,6 +156,21 @@ def main():
         action="store_true",
         help="Use rates from the nerc-rates repo",
     )
+    parser.add_argument(
+        "--node-label-cache",
+        default=NODE_LABEL_CACHE,
+        help="File or s3://<bucket>/<key> object with the GPU labels of nodes, used when a metric has none",
+    )
+    namespace_group = parser.add_mutually_exclusive_group()
+    namespace_group.add_argument(
+        "--namespaces",
+        nargs="+",
+        help="Only report on these namespaces",
+    )
+    namespace_group.add_argument(
+        "--namespace-regex",
+        help="Only report on the namespaces matching this regular expression",
+    )
     parser.add_argument("--rate-cpu-su", type=Decimal)
     parser.add_argument("--rate-gpu-v100-su", type=Decimal)
     parser.add_argument("--rate-gpu-a100sxm4-su", type=Decimal)
@@ -109,17 +185,71 @@ def main():
     cluster_name = None
     interval_minutes = None
 
-    for file in files:
-        with open(file, "r") as jsonfile:
-            metrics_from_file = json.load(jsonfile)
-            if interval_minutes is None:
-                interval_minutes = metrics_from_file.get("interval_minutes")
-            else:
-                interval_minutes_from_file = metrics_from_file["interval_minutes"]
-                if interval_minutes != interval_minutes_from_file:
-                    sys.exit(
-                        f"Cannot process files with different intervals {interval_minutes} != {interval_minutes_from_file}"
+    node_labels = None
+    if args.node_label_cache:
+        node_labels = NodeLabelCache(args.node_label_cache).load().nodes
+    # the interval is taken from the first file that has one before merging
+    # it, runs on the processor's interval are merged without expanding them
+    processor = MetricsProcessor(
+        interval_minutes=PROM_QUERY_INTERVAL_MINUTES, node_labels=node_labels
+    )
+    in_namespaces = namespace_filter(args.namespaces, args.namespace_regex)
+
+    for metrics_from_file in load_metrics_files(files):
+        if interval_minutes is None:
+            interval_minutes = metrics_from_file.get("interval_minutes")
+            if interval_minutes is not None:
+                processor.interval_minutes = interval_minutes
+        else:
+            interval_minutes_from_file = metrics_from_file["interval_minutes"]
+            if interval_minutes != interval_minutes_from_file:
+                sys.exit(
+                    f"Cannot process files with different intervals {interval_minutes} != {interval_minutes_from_file}"
+                )
+
+        if cluster_name is None:
+            cluster_name = metrics_from_file.get("cluster_name")
+        if "series" in metrics_from_file:
+            # NDJSON files are merged a series at a time as they're read
+            for key, series in metrics_from_file["series"]:
+                if in_namespaces is None or in_namespaces(series):
+                    processor.merge_metrics(
+                        METRIC_NAMES[key], [series], interval_minutes
                     )
+        else:
+            cpu_request_metrics = metrics_from_file["cpu_metrics"]
+            memory_request_metrics = metrics_from_file["memory_metrics"]
+            gpu_request_metrics = metrics_from_file.get("gpu_metrics", None)
+            if in_namespaces is not None:
+                cpu_request_metrics = list(filter(in_namespaces, cpu_request_metrics))
+                memory_request_metrics = list(
+                    filter(in_namespaces, memory_request_metrics)
+                )
+                if gpu_request_metrics is not None:
+                    gpu_request_metrics = list(
+                        filter(in_namespaces, gpu_request_metrics)
+                    )
+            # run-length encoded series are laid out on the interval of the file
+            processor.merge_metrics(
+                "cpu_request", cpu_request_metrics, interval_minutes
+            )
+            processor.merge_metrics(
+                "memory_request", memory_request_metrics, interval_minutes
+            )
+            if gpu_request_metrics is not None:
+                processor.merge_metrics(
+                    "gpu_request", gpu_request_metrics, interval_minutes
+                )
+
+        if report_start_date is None:
+            report_start_date = metrics_from_file["start_date"]
+        elif compare_dates(metrics_from_file["start_date"], report_start_date):
+            report_start_date = metrics_from_file["start_date"]
+
+        if report_end_date is None:
+            report_end_date = metrics_from_file["end_date"]
+        elif compare_dates(report_end_date, metrics_from_file["end_date"]):
+            report_end_date = metrics_from_file["end_date"]
 
     if interval_minutes is None:
         logger.info(
@@ -130,31 +260,7 @@ def main():
         logger.info(
             f"Prometheus Query interval set to {interval_minutes} minute(s) from file"
         )
-
-    processor = MetricsProcessor(interval_minutes)
-
-    for file in files:
-        with open(file, "r") as jsonfile:
-            metrics_from_file = json.load(jsonfile)
-            if cluster_name is None:
-                cluster_name = metrics_from_file.get("cluster_name")
-            cpu_request_metrics = metrics_from_file["cpu_metrics"]
-            memory_request_metrics = metrics_from_file["memory_metrics"]
-            gpu_request_metrics = metrics_from_file.get("gpu_metrics", None)
-            processor.merge_metrics("cpu_request", cpu_request_metrics)
-            processor.merge_metrics("memory_request", memory_request_metrics)
-            if gpu_request_metrics is not None:
-                processor.merge_metrics("gpu_request", gpu_request_metrics)
-
-            if report_start_date is None:
-                report_start_date = metrics_from_file["start_date"]
-            elif compare_dates(metrics_from_file["start_date"], report_start_date):
-                report_start_date = metrics_from_file["start_date"]
-
-            if report_end_date is None:
-                report_end_date = metrics_from_file["end_date"]
-            elif compare_dates(report_end_date, metrics_from_file["end_date"]):
-                report_end_date = metrics_from_file["end_date"]
+    processor.interval_minutes = interval_minutes
 
     if cluster_name is None:
         cluster_name = "Unknown Cluster"
@@ -167,16 +273,7 @@ def main():
 
     if args.use_nerc_rates:
         logger.info("Using nerc rates for rates and outages")
-        rates_data = rates.load_from_url()
-        invoice_rates = invoice.Rates(
-            cpu=rates_data.get_value_at("CPU SU Rate", report_month, Decimal),
-            gpu_a100=rates_data.get_value_at("GPUA100 SU Rate", report_month, Decimal),
-            gpu_a100sxm4=rates_data.get_value_at(
-                "GPUA100SXM4 SU Rate", report_month, Decimal
-            ),
-            gpu_v100=rates_data.get_value_at("GPUV100 SU Rate", report_month, Decimal),
-            gpu_h100=rates_data.get_value_at("GPUH100 SU Rate", report_month, Decimal),
-        )
+        invoice_rates = load_nerc_rates(report_month)
         outage_data = outages.load_from_url()
         ignore_hours = outage_data.get_outages_during(
             report_start_date, report_end_date, cluster_name
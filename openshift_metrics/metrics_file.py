@@ -0,0 +1,422 @@
+"""Reads and writes the metrics files produced by the collector"""
+
+import gzip
+import json
+import logging
+import mmap
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from contextlib import nullcontext
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The series_format of a metrics file whose series are run-length encoded
+RUNS = "runs"
+# The lists of series in a metrics file
+SERIES_KEYS = ["cpu_metrics", "memory_metrics", "gpu_metrics"]
+
+# A columnar metrics file is laid out as
+#
+#   8 bytes      COLUMNAR_MAGIC
+#   8 bytes      the length of the header, a little-endian unsigned integer
+#   header       JSON: the metadata of the metrics file, "strings" holding
+#                every label name and value once, "label_sets" holding the
+#                labels of every distinct series as a flat list of string ids
+#                [name, value, name, value, ...], "values" holding every
+#                distinct sample value, and "lists" holding the number of
+#                "series" and "samples" of every list, in the order their
+#                columns follow
+#   then for every list, each column padded to a multiple of 8 bytes:
+#   int64[samples]     the epoch time of every sample
+#   int64[series + 1]  where the samples of every series start and end
+#   int32[series]      the label set id of every series
+#   int32[samples]     the value id of every sample
+#
+# All numbers are little-endian. Values are kept as the strings prometheus
+# returned them as, so they add up to exactly what they do in a JSON file.
+COLUMNAR_MAGIC = b"OSMCOL1\0"
+# The first bytes of a gzipped file
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def encode_runs(values, step: int) -> list:
+    """
+    Returns [epoch_time, value] samples as [start, count, value] runs of
+    samples step seconds apart that have the same value
+    """
+    runs = []
+    for epoch_time, value in values:
+        if runs:
+            run = runs[-1]
+            if value == run[2] and epoch_time == run[0] + run[1] * step:
+                run[1] += 1
+                continue
+        runs.append([epoch_time, 1, value])
+    return runs
+
+
+def decode_runs(runs, step: int) -> list:
+    """Returns the [epoch_time, value] samples of runs"""
+    return [
+        [start + i * step, value] for start, count, value in runs for i in range(count)
+    ]
+
+
+def encode_series(series: dict, step: int) -> dict:
+    """Returns series with its values replaced by runs"""
+    return {"metric": series["metric"], RUNS: encode_runs(series["values"], step)}
+
+
+def encode_metrics(metrics_dict: dict, step: int):
+    """Run-length encodes the series of a metrics dict in place"""
+    metrics_dict["series_format"] = RUNS
+    for key in SERIES_KEYS:
+        if key in metrics_dict:
+            metrics_dict[key] = [
+                encode_series(series, step) for series in metrics_dict[key]
+            ]
+
+
+def _open_text(file_name: str):
+    """Opens a text file for reading, decompressing it if it's gzipped"""
+    with open(file_name, "rb") as file:
+        magic = file.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        return gzip.open(file_name, "rt")
+    return open(file_name)
+
+
+def _open_output(file_name):
+    """Opens file_name for writing, or passes on a text file that's already open"""
+    if isinstance(file_name, str):
+        return open(file_name, "w")
+    return nullcontext(file_name)
+
+
+def read_ndjson(file_name: str) -> dict:
+    """
+    Returns the header of an NDJSON metrics file with a generator of its
+    (key, series) under "series", which reads the file a line at a time. A
+    file that was cut short is read up to its last whole line.
+    """
+    file = _open_text(file_name)
+    try:
+        metrics_dict = json.loads(file.readline())
+    except BaseException:
+        file.close()
+        raise
+
+    def series():
+        with file:
+            try:
+                for line in file:
+                    record = json.loads(line)
+                    yield record.pop("kind"), record
+            except (ValueError, EOFError):
+                logger.warning(f"{file_name} was cut short, reading what's there")
+
+    metrics_dict["series"] = series()
+    return metrics_dict
+
+
+def write_json(file_name, metrics_dict: dict):
+    """Writes a metrics dict as a JSON metrics file"""
+    with _open_output(file_name) as file:
+        logger.info(f"Writing metrics to {getattr(file, 'name', file_name)}")
+        json.dump(metrics_dict, file)
+
+
+def write_ndjson(file_name, metrics_dict: dict):
+    """Writes a metrics dict as an NDJSON metrics file"""
+    metadata = {k: v for k, v in metrics_dict.items() if k not in SERIES_KEYS}
+    with NdjsonMetricsFileWriter(file_name, metadata) as writer:
+        for key in SERIES_KEYS:
+            for series in metrics_dict.get(key, []):
+                writer.add_series(key, series)
+
+
+def _padding(length: int) -> int:
+    """Returns how many bytes bring length up to a multiple of 8"""
+    return -length % 8
+
+
+def write_columnar(file_name: str, metrics_dict: dict):
+    """Writes a metrics dict as a columnar metrics file"""
+    step = metrics_dict.get("interval_minutes", 15) * 60
+    metadata = {
+        k: v
+        for k, v in metrics_dict.items()
+        if k not in SERIES_KEYS and k != "series_format"
+    }
+    strings = {}
+    label_sets = {}
+    values = {}
+    lists = {}
+    columns = []
+    for key in SERIES_KEYS:
+        if key not in metrics_dict:
+            continue
+        timestamps = array("q")
+        offsets = array("q", [0])
+        label_ids = array("i")
+        value_ids = array("i")
+        for series in metrics_dict[key]:
+            label_set = tuple(
+                strings.setdefault(string, len(strings))
+                for label in series["metric"].items()
+                for string in label
+            )
+            label_ids.append(label_sets.setdefault(label_set, len(label_sets)))
+            if RUNS in series:
+                samples = decode_runs(series[RUNS], step)
+            else:
+                samples = series["values"]
+            for epoch_time, value in samples:
+                timestamps.append(int(epoch_time))
+                value_ids.append(values.setdefault(value, len(values)))
+            offsets.append(len(timestamps))
+        lists[key] = {"series": len(label_ids), "samples": len(timestamps)}
+        columns.extend([timestamps, offsets, label_ids, value_ids])
+
+    header = json.dumps(
+        {
+            **metadata,
+            "strings": list(strings),
+            "label_sets": [list(label_set) for label_set in label_sets],
+            "values": list(values),
+            "lists": lists,
+        }
+    ).encode()
+    logger.info(f"Writing metrics to {file_name}")
+    with open(file_name, "wb") as file:
+        file.write(COLUMNAR_MAGIC)
+        file.write(struct.pack("<Q", len(header)))
+        file.write(header)
+        file.write(bytes(_padding(len(header))))
+        for column in columns:
+            if sys.byteorder != "little":
+                column = array(column.typecode, column)
+                column.byteswap()
+            data = column.tobytes()
+            file.write(data)
+            file.write(bytes(_padding(len(data))))
+
+
+def read_columnar(file_name: str) -> dict:
+    """
+    Memory-maps a columnar metrics file and returns it as a metrics dict.
+    Rather than values its series hold views of the mapped columns: the
+    epoch times of their samples under "timestamps", and under "value_ids"
+    the positions of their values in the list under "value_table", which all
+    series share. No sample is turned into a Python object until it's used.
+    """
+    with open(file_name, "rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[: len(COLUMNAR_MAGIC)] != COLUMNAR_MAGIC:
+        mapped.close()
+        raise ValueError(f"{file_name} is not a columnar metrics file")
+    position = len(COLUMNAR_MAGIC)
+    (header_length,) = struct.unpack_from("<Q", mapped, position)
+    position += 8
+    metrics_dict = json.loads(mapped[position : position + header_length])
+    position += header_length + _padding(header_length)
+    view = memoryview(mapped)
+
+    def column(typecode, length):
+        nonlocal position
+        size = length * array(typecode).itemsize
+        data = view[position : position + size].cast(typecode)
+        position += size + _padding(size)
+        if sys.byteorder != "little":
+            data = array(typecode, data)
+            data.byteswap()
+        return data
+
+    strings = metrics_dict.pop("strings")
+    label_sets = [
+        {strings[ids[i]]: strings[ids[i + 1]] for i in range(0, len(ids), 2)}
+        for ids in metrics_dict.pop("label_sets")
+    ]
+    value_table = metrics_dict.pop("values")
+    for key, sizes in metrics_dict.pop("lists").items():
+        timestamps = column("q", sizes["samples"])
+        offsets = column("q", sizes["series"] + 1)
+        label_ids = column("i", sizes["series"])
+        value_ids = column("i", sizes["samples"])
+        metrics_dict[key] = [
+            {
+                "metric": dict(label_sets[label_ids[i]]),
+                "timestamps": timestamps[offsets[i] : offsets[i + 1]],
+                "value_ids": value_ids[offsets[i] : offsets[i + 1]],
+                "value_table": value_table,
+            }
+            for i in range(sizes["series"])
+        ]
+    return metrics_dict
+
+
+def read_metrics_file(file_name: str) -> dict:
+    """
+    Reads a metrics file of any format, telling them apart by their content.
+    JSON and NDJSON files may be gzipped. Of an NDJSON file only the header
+    is read, see read_ndjson.
+    """
+    with open(file_name, "rb") as file:
+        magic = file.read(len(COLUMNAR_MAGIC))
+    if magic == COLUMNAR_MAGIC:
+        return read_columnar(file_name)
+    with _open_text(file_name) as file:
+        first_line = file.readline()
+        try:
+            header = json.loads(first_line)
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or any(key in header for key in SERIES_KEYS):
+            # a JSON file, which may span lines if it was reformatted
+            if header is not None and not file.readline():
+                return header
+            file.seek(0)
+            return json.load(file)
+    return read_ndjson(file_name)
+
+
+class MetricsFileWriter:
+    """
+    Writes a metrics file one series at a time.
+
+    The series of every list are spooled to temporary files as they come in
+    and copied into the metrics file when the writer is closed, so the file is
+    byte-for-byte what json.dump(metrics_dict) would write without a whole
+    list ever being held in memory. Lists are written in the order they were
+    started; lists that are never started are left out like a missing key.
+
+    With a step every series is run-length encoded on a grid of step seconds
+    as it's added. Instead of a file name an open text file can be given,
+    which is written to and left open.
+    """
+
+    def __init__(self, file_name, metadata: dict, step: int = None):
+        self.file_name = file_name
+        self.metadata = metadata
+        self.step = step
+        self._spools = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    @property
+    def lists(self):
+        """The keys of the lists that have been started"""
+        return list(self._spools)
+
+    def start_list(self, key: str):
+        """Adds key to the file as an empty list, if it wasn't there already"""
+        with self._lock:
+            if key not in self._spools:
+                self._spools[key] = [tempfile.TemporaryFile("w+"), 0]
+
+    def add_series(self, key: str, series: dict):
+        """Appends series to the list under key"""
+        if self.step is not None:
+            series = encode_series(series, self.step)
+        self.start_list(key)
+        with self._lock:
+            spool = self._spools[key]
+            if spool[1]:
+                spool[0].write(", ")
+            json.dump(series, spool[0])
+            spool[1] += 1
+
+    def close(self):
+        """Writes out the metrics file"""
+        with _open_output(self.file_name) as file:
+            logger.info(f"Writing metrics to {getattr(file, 'name', self.file_name)}")
+            file.write("{")
+            for i, (key, value) in enumerate(self.metadata.items()):
+                if i:
+                    file.write(", ")
+                file.write(f"{json.dumps(key)}: {json.dumps(value)}")
+            for i, (key, (spool, _)) in enumerate(self._spools.items()):
+                if i or self.metadata:
+                    file.write(", ")
+                file.write(f"{json.dumps(key)}: [")
+                spool.seek(0)
+                shutil.copyfileobj(spool, file)
+                file.write("]")
+            file.write("}")
+        self.discard()
+
+    def discard(self):
+        """Drops the spooled series without writing anything"""
+        for spool, _ in self._spools.values():
+            spool.close()
+        self._spools = {}
+
+
+class NdjsonMetricsFileWriter:
+    """
+    Writes a metrics file as newline-delimited JSON: a header line with the
+    metadata, then a line for every series with the key of its list under
+    "kind". Series are written out as they are added, so the writer holds
+    none of them, and a file that was cut short can still be read up to its
+    last line.
+
+    With a step every series is run-length encoded on a grid of step seconds
+    as it's added. Instead of a file name an open text file can be given,
+    which is written to and left open.
+    """
+
+    def __init__(self, file_name, metadata: dict, step: int = None):
+        self.file_name = file_name
+        self.metadata = metadata
+        self.step = step
+        self._lists = []
+        self._lock = threading.Lock()
+        self._output = _open_output(file_name)
+        self._file = self._output.__enter__()
+        logger.info(f"Writing metrics to {getattr(self._file, 'name', file_name)}")
+        self._file.write(json.dumps(metadata) + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is not None:
+            logger.warning(f"Leaving {self.file_name} with the series written so far")
+        self.close()
+
+    @property
+    def lists(self):
+        """The keys of the lists that have been started"""
+        return list(self._lists)
+
+    def start_list(self, key: str):
+        """Only records key, lines are written per series"""
+        with self._lock:
+            if key not in self._lists:
+                self._lists.append(key)
+
+    def add_series(self, key: str, series: dict):
+        """Writes series as a line of the list under key"""
+        if self.step is not None:
+            series = encode_series(series, self.step)
+        line = json.dumps({"kind": key, **series}) + "\n"
+        self.start_list(key)
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        """Closes the metrics file"""
+        self._output.__exit__(None, None, None)
@@ -1,3 +1,4 @@
+import bisect
 import json
 from typing import List, Dict
 from collections import namedtuple
@@ -18,13 +19,28 @@ class MetricsProcessor:
         interval_minutes: int = 15,
         merged_data: dict = None,
         gpu_mapping_file: str = "gpu_node_map.json",
+        node_labels: Dict[str, Dict[str, str]] = None,
     ):
         self.interval_minutes = interval_minutes
         self.merged_data = merged_data if merged_data is not None else {}
         self.gpu_mapping = self._load_gpu_mapping(gpu_mapping_file)
+        self.node_labels = node_labels if node_labels is not None else {}
+        # the sorted sample times of the pods with samples that last more
+        # than one interval, by (namespace, pod)
+        self._spans = {}
 
-    def merge_metrics(self, metric_name, metric_list):
-        """Merge metrics (cpu, memory, gpu) by pod"""
+    def merge_metrics(self, metric_name, metric_list, interval_minutes=None):
+        """
+        Merge metrics (cpu, memory, gpu) by pod. The samples of a series are
+        either its values or the runs of a run-length encoded metrics file,
+        which are laid out interval_minutes apart (the processor's interval
+        unless given).
+
+        A run on the processor's interval is merged as a single sample with
+        "steps" set to its length, which condense_metrics reads as that many
+        samples with the same values.
+        """
+        step = (interval_minutes or self.interval_minutes) * 60
         for metric in metric_list:
             pod = metric["metric"]["pod"]
             namespace = metric["metric"]["namespace"]
@@ -44,7 +60,37 @@ class MetricsProcessor:
                 metric_name, metric
             )
 
-            for epoch_time, metric_value in metric["values"]:
+            pod_metrics = self.merged_data[namespace][pod]["metrics"]
+            starts = self._spans.get((namespace, pod))
+            if starts is None and "runs" in metric:
+                if step == self.interval_minutes * 60:
+                    starts = self._spans[(namespace, pod)] = sorted(pod_metrics)
+            if starts is not None:
+                extra = {
+                    "gpu_type": gpu_type,
+                    "gpu_resource": gpu_resource,
+                    "node_model": node_model,
+                    "node": node,
+                }
+                extra = {key: value for key, value in extra.items() if value}
+                if "runs" in metric and step == self.interval_minutes * 60:
+                    runs = metric["runs"]
+                else:
+                    runs = (
+                        (epoch_time, 1, metric_value)
+                        for epoch_time, metric_value in self._samples(metric, step)
+                    )
+                for start, count, metric_value in runs:
+                    self._merge_span(
+                        pod_metrics,
+                        starts,
+                        start,
+                        count,
+                        {metric_name: metric_value, **extra},
+                    )
+                continue
+
+            for epoch_time, metric_value in self._samples(metric, step):
                 self.merged_data[namespace][pod]["metrics"].setdefault(epoch_time, {})
 
                 self.merged_data[namespace][pod]["metrics"][epoch_time][metric_name] = (
@@ -67,6 +113,67 @@ class MetricsProcessor:
                         node
                     )
 
+    @staticmethod
+    def _samples(metric: Dict, step: int):
+        """Yields the samples of a series, reading runs and columns as they are"""
+        if "timestamps" in metric:
+            yield from zip(
+                metric["timestamps"],
+                map(metric["value_table"].__getitem__, metric["value_ids"]),
+            )
+            return
+        if "runs" not in metric:
+            yield from metric["values"]
+            return
+        for start, count, metric_value in metric["runs"]:
+            for i in range(count):
+                yield start + i * step, metric_value
+
+    def _merge_span(
+        self, metrics: Dict, starts: List[int], start: int, count: int, values: Dict
+    ):
+        """
+        Sets values on the count samples from start, splitting the samples
+        with "steps" the span only partly overlaps. starts are the sorted
+        times of metrics, and are kept that way.
+        """
+        step = self.interval_minutes * 60
+        end = start + count * step
+        new_starts = []
+
+        def put(span_start, span_end, sample):
+            steps = (span_end - span_start) // step
+            if steps > 1:
+                sample["steps"] = steps
+            metrics[span_start] = sample
+            new_starts.append(span_start)
+
+        # the samples overlapping the span are the one it starts in, if any,
+        # and those that start before it ends
+        low = bisect.bisect_right(starts, start) - 1
+        if (
+            low < 0
+            or starts[low] + metrics[starts[low]].get("steps", 1) * step <= start
+        ):
+            low += 1
+        high = bisect.bisect_left(starts, end, low)
+
+        uncovered = start
+        for span_start in starts[low:high]:
+            sample = metrics.pop(span_start)
+            span_end = span_start + sample.pop("steps", 1) * step
+            if uncovered < span_start:
+                put(uncovered, span_start, dict(values))
+            if span_start < start:
+                put(span_start, start, sample.copy())
+            uncovered = min(span_end, end)
+            put(max(span_start, start), uncovered, {**sample, **values})
+            if end < span_end:
+                put(end, span_end, sample.copy())
+        if uncovered < end:
+            put(uncovered, end, dict(values))
+        starts[low:high] = new_starts
+
     def _extract_gpu_info(self, metric_name: str, metric: Dict) -> GPUInfo:
         """Extract GPU related info"""
         gpu_type = None
@@ -79,12 +186,18 @@ class MetricsProcessor:
             )
             gpu_resource = metric["metric"].get("resource")
             node_model = metric["metric"].get("label_nvidia_com_gpu_machine")
+            node_name = metric["metric"].get("node")
+            node_labels = self.node_labels.get(node_name, {})
 
             # Sometimes GPU labels from the nodes can be missing, in that case
-            # we get the gpu_type from the gpu-node file
+            # we get them from the node label cache or the gpu-node file
+            if node_model is None:
+                node_model = node_labels.get("label_nvidia_com_gpu_machine")
             if gpu_type == GPU_UNKNOWN_TYPE:
-                node_name = metric["metric"].get("node")
-                gpu_type = self.gpu_mapping.get(node_name, GPU_UNKNOWN_TYPE)
+                gpu_type = node_labels.get(
+                    "label_nvidia_com_gpu_product",
+                    self.gpu_mapping.get(node_name, GPU_UNKNOWN_TYPE),
+                )
 
         return GPUInfo(gpu_type, gpu_resource, node_model)
 
@@ -117,10 +230,14 @@ class MetricsProcessor:
                 start_epoch_time = epoch_times_list[0]
 
                 start_metric_dict = metrics_dict[start_epoch_time].copy()
+                start_metric_dict.pop("steps", None)
+                # the last interval the previous sample covers
+                previous_time = self._last_time(
+                    start_epoch_time, metrics_dict[start_epoch_time], interval
+                )
 
                 for i in range(1, len(epoch_times_list)):
                     current_time = epoch_times_list[i]
-                    previous_time = epoch_times_list[i - 1]
 
                     metrics_changed = self._are_metrics_different(
                         metrics_dict[start_epoch_time],
@@ -142,9 +259,14 @@ class MetricsProcessor:
                         # Reset start_epoch_time and start_metric_dict
                         start_epoch_time = current_time
                         start_metric_dict = metrics_dict[start_epoch_time].copy()
+                        start_metric_dict.pop("steps", None)
+
+                    previous_time = self._last_time(
+                        current_time, metrics_dict[current_time], interval
+                    )
 
                 # Final block after the loop
-                duration = epoch_times_list[-1] - start_epoch_time + interval
+                duration = previous_time - start_epoch_time + interval
                 start_metric_dict["duration"] = duration
                 new_metrics_dict[start_epoch_time] = start_metric_dict
 
@@ -155,6 +277,11 @@ class MetricsProcessor:
 
         return condensed_dict
 
+    @staticmethod
+    def _last_time(epoch_time: int, metrics: Dict, interval: int) -> int:
+        """The time of the last interval a sample stands for"""
+        return epoch_time + (metrics.get("steps", 1) - 1) * interval
+
     @staticmethod
     def _are_metrics_different(
         metrics_a: Dict, metrics_b: Dict, metrics_to_check: List[str]
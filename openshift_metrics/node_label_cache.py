@@ -0,0 +1,101 @@
+"""Keeps the GPU labels of nodes between collector runs"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from openshift_metrics import utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# The node labels the metrics processor reads
+NODE_LABELS = ["label_nvidia_com_gpu_product", "label_nvidia_com_gpu_machine"]
+
+
+class NodeLabelCache:
+    """
+    The GPU labels of every node seen so far, stored as a JSON file mapping
+    node names to their labels, either locally or as an object in S3 when
+    location is s3://<bucket>/<key>.
+
+    The labels only change with the hardware, so nodes already in the cache
+    are not looked up again. Remove a node from the file (or the file itself)
+    to have its labels fetched again.
+    """
+
+    def __init__(self, location: str):
+        self.location = location
+        self.nodes = {}
+        self.updated = False
+        self._lock = threading.Lock()
+
+    def _s3_location(self):
+        bucket, _, key = self.location.removeprefix("s3://").partition("/")
+        return bucket, key
+
+    def load(self):
+        """Reads the cache, an absent cache is an empty one"""
+        if self.location.startswith("s3://"):
+            with tempfile.TemporaryDirectory() as directory:
+                file_name = os.path.join(directory, "node_labels.json")
+                if utils.download_from_s3(*self._s3_location(), file_name):
+                    with open(file_name) as file:
+                        self.nodes = json.load(file)
+        elif os.path.exists(self.location):
+            with open(self.location) as file:
+                self.nodes = json.load(file)
+        logger.info(f"Loaded labels of {len(self.nodes)} nodes from {self.location}")
+        return self
+
+    def save(self):
+        """Writes the cache back if any nodes were added"""
+        if not self.updated:
+            return
+        if self.location.startswith("s3://"):
+            with tempfile.TemporaryDirectory() as directory:
+                file_name = os.path.join(directory, "node_labels.json")
+                self._write(file_name)
+                utils.upload_to_s3(file_name, *self._s3_location())
+        else:
+            self._write(self.location)
+        self.updated = False
+
+    def _write(self, file_name):
+        with open(file_name, "w") as file:
+            json.dump(self.nodes, file, indent=2, sort_keys=True)
+
+    def missing(self, nodes) -> list:
+        """Returns the nodes that aren't in the cache"""
+        with self._lock:
+            return sorted(set(nodes) - set(self.nodes))
+
+    def update(self, node_labels: list) -> int:
+        """Adds the nodes of a node labels query result that are new"""
+        added = 0
+        with self._lock:
+            for node_label in node_labels:
+                node = node_label["metric"]["node"]
+                if node in self.nodes:
+                    continue
+                self.nodes[node] = {
+                    label: node_label["metric"][label]
+                    for label in NODE_LABELS
+                    if label in node_label["metric"]
+                }
+                added += 1
+            if added:
+                self.updated = True
+        if added:
+            logger.info(f"Added labels of {added} new nodes to {self.location}")
+        return added
+
+    def node_labels(self) -> list:
+        """Returns the cached nodes in the shape of a node labels query result"""
+        with self._lock:
+            return [
+                {"metric": {"node": node, **labels}}
+                for node, labels in sorted(self.nodes.items())
+            ]
@@ -14,19 +14,49 @@
 """Collect and save metrics from prometheus"""
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 import sys
 import json
 import logging
+import os
+import re
+from typing import List, Optional
 
-from openshift_metrics import utils
-from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics import promql, utils
+from openshift_metrics.change_point import ChangePointCollector
+from openshift_metrics.checkpoint import Checkpoint
+from openshift_metrics.concurrency_governor import ConcurrencyGovernor
+from openshift_metrics.coverage_index import CoverageIndex, metrics_key
+from openshift_metrics.prometheus_client import PrometheusClient, SHARD_DURATIONS
 from openshift_metrics.metrics_processor import MetricsProcessor
+from openshift_metrics.metrics_file import (
+    RUNS,
+    MetricsFileWriter,
+    NdjsonMetricsFileWriter,
+    encode_metrics,
+    write_columnar,
+    write_json,
+    write_ndjson,
+)
+from openshift_metrics.node_label_cache import NodeLabelCache
+from openshift_metrics.query_cache import QueryCache
+from openshift_metrics.query_planner import QueryPlanner
 from openshift_metrics.config import (
     OPENSHIFT_PROMETHEUS_URL,
     OPENSHIFT_TOKEN,
     S3_METRICS_BUCKET,
     PROM_QUERY_INTERVAL_MINUTES,
+    PROM_QUERY_CONCURRENCY,
+    PROM_QUERY_MAX_SAMPLES,
+    PROM_QUERY_REQUEST_BUDGET,
+    PROM_QUERY_CACHE_DIR,
+    PROM_QUERY_CACHE_MAX_BYTES,
+    PROM_QUERY_CACHE_MIN_AGE_HOURS,
+    NODE_LABEL_CACHE,
+    PROM_CHANGE_POINT_WINDOW_STEPS,
 )
 
 logging.basicConfig(level=logging.INFO)
@@ -35,8 +65,13 @@ logger = logging.getLogger(__name__)
 CPU_REQUEST = 'kube_pod_resource_request{resource="cpu", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable'
 MEMORY_REQUEST = 'kube_pod_resource_request{resource="memory", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable'
 GPU_REQUEST = 'kube_pod_resource_request{resource=~"nvidia.com.*", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable'
+RESOURCE_REQUEST = 'kube_pod_resource_request{resource=~"cpu|memory|nvidia.com.*", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable'
 KUBE_NODE_LABELS = 'kube_node_labels{label_nvidia_com_gpu_product!=""}'
 KUBE_POD_LABELS = 'kube_pod_labels{label_nerc_mghpcc_org_class!=""}'
+GPU_RESOURCE_RE = re.compile("nvidia.com.*")
+
+# The only labels of the resource requests that the metrics processor reads
+PROJECTED_LABELS = ["namespace", "pod", "node", "resource"]
 
 URL_CLUSTER_NAME_MAPPING = {
     "https://thanos-querier-openshift-monitoring.apps.shift.nerc.mghpcc.org": "ocp-prod",
@@ -46,6 +81,358 @@ URL_CLUSTER_NAME_MAPPING = {
 }
 
 
+def split_by_resource(resource_request_metrics: list) -> dict:
+    """Sorts the series of RESOURCE_REQUEST by the resource they request"""
+    resource_requests = {"cpu": [], "memory": [], "gpu": []}
+    for metric in resource_request_metrics:
+        resource = metric["metric"].get("resource", "")
+        if resource in ("cpu", "memory"):
+            resource_requests[resource].append(metric)
+        elif GPU_RESOURCE_RE.fullmatch(resource):
+            resource_requests["gpu"].append(metric)
+    return resource_requests
+
+
+def get_node_labels(
+    prom_client,
+    node_label_cache,
+    gpu_request_metrics,
+    report_start_date,
+    report_end_date,
+):
+    """
+    Returns the labels of the nodes in gpu_request_metrics from the cache,
+    only asking prometheus about the nodes it hasn't seen before.
+    """
+    missing = node_label_cache.missing(
+        metric["metric"]["node"] for metric in gpu_request_metrics
+    )
+    if missing:
+        selector = promql.add_label_matcher(
+            KUBE_NODE_LABELS, promql.regex_matcher("node", missing)
+        )
+        try:
+            node_label_cache.update(
+                prom_client.submit_series(
+                    selector, report_start_date, report_end_date
+                ).result()
+            )
+        except utils.EmptyResultError:
+            logger.info(f"No GPU labels found for nodes: {', '.join(missing)}")
+    node_labels = node_label_cache.node_labels()
+    if not node_labels:
+        raise utils.EmptyResultError("No node labels found")
+    return node_labels
+
+
+def collect_metrics(
+    prom_client,
+    report_start_date,
+    report_end_date,
+    combined_query=False,
+    project_labels=False,
+    node_label_cache=None,
+    namespace_matcher=None,
+):
+    """
+    Runs all the queries for the report period concurrently and joins the
+    labels into the resource request metrics.
+
+    Every query is submitted up front; each join only waits on the queries it
+    needs, so the CPU metrics can be labelled while the GPU queries are still
+    in flight. The labels only need the label sets of their series, so they
+    are fetched from the series API rather than with range queries.
+
+    With combined_query the CPU, memory and GPU requests are fetched with a
+    single query, so the unschedulable join is only evaluated once, and split
+    up by their resource label here.
+
+    With project_labels the resource requests are aggregated down to
+    PROJECTED_LABELS by prometheus, so the labels nothing reads are never
+    downloaded or stored.
+
+    With a node_label_cache the node labels are only queried for the GPU
+    nodes that aren't in the cache yet.
+
+    With a namespace_matcher, such as namespace=~"ns1|ns2", only the
+    resource requests and pod labels of the matching namespaces are fetched.
+    """
+    metrics_dict = {}
+
+    def resource_query(query):
+        if namespace_matcher:
+            query = promql.add_label_matcher(query, namespace_matcher)
+        if project_labels:
+            return promql.project_labels(query, PROJECTED_LABELS)
+        return query
+
+    pod_labels_query = KUBE_POD_LABELS
+    if namespace_matcher:
+        pod_labels_query = promql.add_label_matcher(KUBE_POD_LABELS, namespace_matcher)
+
+    if combined_query:
+        resource_request_future = prom_client.submit(
+            resource_query(RESOURCE_REQUEST), report_start_date, report_end_date
+        )
+    else:
+        cpu_request_future = prom_client.submit(
+            resource_query(CPU_REQUEST), report_start_date, report_end_date
+        )
+    pod_labels_future = prom_client.submit_series(
+        pod_labels_query, report_start_date, report_end_date
+    )
+    if not combined_query:
+        memory_request_future = prom_client.submit(
+            resource_query(MEMORY_REQUEST), report_start_date, report_end_date
+        )
+        gpu_request_future = prom_client.submit(
+            resource_query(GPU_REQUEST), report_start_date, report_end_date
+        )
+    if node_label_cache is None:
+        node_labels_future = prom_client.submit_series(
+            KUBE_NODE_LABELS, report_start_date, report_end_date
+        )
+
+    if combined_query:
+        resource_requests = split_by_resource(resource_request_future.result())
+        if not resource_requests["cpu"]:
+            raise utils.EmptyResultError(f"No CPU requests found: {RESOURCE_REQUEST}")
+        cpu_request_metrics = resource_requests["cpu"]
+    else:
+        cpu_request_metrics = cpu_request_future.result()
+
+    try:
+        pod_labels = pod_labels_future.result()
+        metrics_dict["cpu_metrics"] = MetricsProcessor.insert_pod_labels(
+            pod_labels, cpu_request_metrics
+        )
+    except utils.EmptyResultError:
+        logger.info(
+            f"No pod labels found for the period {report_start_date} to {report_end_date}"
+        )
+        metrics_dict["cpu_metrics"] = cpu_request_metrics
+
+    if combined_query:
+        metrics_dict["memory_metrics"] = resource_requests["memory"]
+    else:
+        metrics_dict["memory_metrics"] = memory_request_future.result()
+
+    # because if nobody requests a GPU then we will get an empty set
+    try:
+        if combined_query:
+            if not resource_requests["gpu"]:
+                raise utils.EmptyResultError(
+                    f"No GPU requests found: {RESOURCE_REQUEST}"
+                )
+            gpu_request_metrics = resource_requests["gpu"]
+        else:
+            gpu_request_metrics = gpu_request_future.result()
+        if node_label_cache is None:
+            node_labels = node_labels_future.result()
+        else:
+            node_labels = get_node_labels(
+                prom_client,
+                node_label_cache,
+                gpu_request_metrics,
+                report_start_date,
+                report_end_date,
+            )
+        metrics_dict["gpu_metrics"] = MetricsProcessor.insert_node_labels(
+            node_labels, gpu_request_metrics
+        )
+    except utils.EmptyResultError:
+        logger.info(
+            f"No GPU metrics found for the period {report_start_date} to {report_end_date}"
+        )
+
+    return metrics_dict
+
+
+def stream_metrics(
+    prom_client,
+    report_start_date,
+    report_end_date,
+    writer: MetricsFileWriter,
+    combined_query=False,
+    project_labels=False,
+    namespace_matcher=None,
+):
+    """
+    Streams the resource requests for the report period into writer one
+    series at a time, joining the labels into each series as it arrives.
+
+    The label sets are small so they're fetched first; only one series of
+    each resource request query is held in memory at a time. The file that
+    is written is the same as the one collect_metrics produces.
+    """
+
+    def resource_query(query):
+        if namespace_matcher:
+            query = promql.add_label_matcher(query, namespace_matcher)
+        if project_labels:
+            return promql.project_labels(query, PROJECTED_LABELS)
+        return query
+
+    pod_labels_query = KUBE_POD_LABELS
+    if namespace_matcher:
+        pod_labels_query = promql.add_label_matcher(KUBE_POD_LABELS, namespace_matcher)
+
+    pod_labels_future = prom_client.submit_series(
+        pod_labels_query, report_start_date, report_end_date
+    )
+    node_labels_future = prom_client.submit_series(
+        KUBE_NODE_LABELS, report_start_date, report_end_date
+    )
+
+    pod_labels = {}
+    try:
+        for pod_label in pod_labels_future.result():
+            pod_labels.setdefault(pod_label["metric"]["pod"], []).append(pod_label)
+    except utils.EmptyResultError:
+        logger.info(
+            f"No pod labels found for the period {report_start_date} to {report_end_date}"
+        )
+
+    node_labels = {}
+    try:
+        for node_label in node_labels_future.result():
+            node_labels.setdefault(node_label["metric"]["node"], []).append(node_label)
+    except utils.EmptyResultError:
+        pass
+
+    def add_cpu_request(metric):
+        MetricsProcessor.insert_pod_labels(
+            pod_labels.get(metric["metric"]["pod"], []), [metric]
+        )
+        writer.add_series("cpu_metrics", metric)
+
+    def add_memory_request(metric):
+        writer.add_series("memory_metrics", metric)
+
+    def add_gpu_request(metric):
+        # if the nodes have no GPU labels the GPU requests are left out
+        if node_labels:
+            MetricsProcessor.insert_node_labels(
+                node_labels.get(metric["metric"]["node"], []), [metric]
+            )
+            writer.add_series("gpu_metrics", metric)
+
+    def add_resource_request(metric):
+        resource_requests = split_by_resource([metric])
+        for metric in resource_requests["cpu"]:
+            add_cpu_request(metric)
+        for metric in resource_requests["memory"]:
+            add_memory_request(metric)
+        for metric in resource_requests["gpu"]:
+            add_gpu_request(metric)
+
+    writer.start_list("cpu_metrics")
+    writer.start_list("memory_metrics")
+
+    if combined_query:
+        futures = [
+            prom_client.submit_stream(
+                resource_query(RESOURCE_REQUEST),
+                report_start_date,
+                report_end_date,
+                add_resource_request,
+            )
+        ]
+        gpu_request_future = None
+    else:
+        futures = [
+            prom_client.submit_stream(
+                resource_query(CPU_REQUEST),
+                report_start_date,
+                report_end_date,
+                add_cpu_request,
+            ),
+            prom_client.submit_stream(
+                resource_query(MEMORY_REQUEST),
+                report_start_date,
+                report_end_date,
+                add_memory_request,
+            ),
+        ]
+        gpu_request_future = prom_client.submit_stream(
+            resource_query(GPU_REQUEST),
+            report_start_date,
+            report_end_date,
+            add_gpu_request,
+        )
+
+    for future in futures:
+        future.result()
+
+    # because if nobody requests a GPU then we will get an empty set
+    try:
+        if gpu_request_future is not None:
+            gpu_request_future.result()
+    except utils.EmptyResultError:
+        pass
+    if "gpu_metrics" not in writer.lists:
+        logger.info(
+            f"No GPU metrics found for the period {report_start_date} to {report_end_date}"
+        )
+
+
+def namespace_matcher(args):
+    """Returns the label matcher for --namespaces or --namespace-regex, if given"""
+    if args.namespaces:
+        return promql.regex_matcher("namespace", args.namespaces)
+    if args.namespace_regex:
+        return promql.pattern_matcher("namespace", args.namespace_regex)
+    return None
+
+
+@dataclass
+class Cluster:
+    """A cluster whose prometheus the metrics are collected from"""
+
+    url: str
+    token: str
+    name: str
+    concurrency: int = PROM_QUERY_CONCURRENCY
+    bucket: str = S3_METRICS_BUCKET
+    node_label_cache: Optional[str] = None
+
+
+def load_clusters(file_name) -> List[Cluster]:
+    """
+    Reads the clusters to collect from a JSON list of objects with the "url"
+    of each prometheus and optionally:
+
+    - "name": the cluster name in the metrics, looked up by url by default
+    - "token_env": the environment variable with the token, OPENSHIFT_TOKEN by default
+    - "concurrency": how many queries run at once, PROM_QUERY_CONCURRENCY by default
+    - "bucket": the S3 bucket to upload to, S3_METRICS_BUCKET by default
+    - "node_label_cache": as --node-label-cache, for this cluster
+
+    Raises ValueError if the token variable of a cluster isn't set.
+    """
+    with open(file_name) as file:
+        entries = json.load(file)
+    clusters = []
+    for entry in entries:
+        url = entry["url"]
+        name = entry.get("name", URL_CLUSTER_NAME_MAPPING.get(url, url))
+        token_env = entry.get("token_env", "OPENSHIFT_TOKEN")
+        token = os.getenv(token_env)
+        if token is None:
+            raise ValueError(f"Set {token_env} to the token of cluster {name}")
+        clusters.append(
+            Cluster(
+                url,
+                token,
+                name,
+                concurrency=entry.get("concurrency", PROM_QUERY_CONCURRENCY),
+                bucket=entry.get("bucket", S3_METRICS_BUCKET),
+                node_label_cache=entry.get("node_label_cache"),
+            )
+        )
+    return clusters
+
+
 def main():
     """This method kick starts the process of collecting and saving the metrics"""
 
@@ -67,9 +454,152 @@ def main():
     )
     parser.add_argument("--upload-to-s3", action="store_true")
     parser.add_argument("--output-file")
+    parser.add_argument(
+        "--shard",
+        choices=SHARD_DURATIONS.keys(),
+        help="Split each query into sub-ranges of this size and fetch them in parallel",
+    )
+    parser.add_argument(
+        "--split-by-namespace",
+        action="store_true",
+        help="Split queries that are too large for a single step by namespace",
+    )
+    parser.add_argument(
+        "--plan-queries",
+        action="store_true",
+        help="Probe the size of each query first and split it to stay under PROM_QUERY_MAX_SAMPLES",
+    )
+    parser.add_argument(
+        "--project-labels",
+        action="store_true",
+        help="Only fetch the labels of the resource requests that the reports use",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=PROM_QUERY_CACHE_DIR,
+        help="Cache the results of queries for past time ranges in this directory",
+    )
+    parser.add_argument(
+        "--node-label-cache",
+        default=NODE_LABEL_CACHE,
+        help="File or s3://<bucket>/<key> object that keeps the GPU labels of nodes between runs",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Parse the query responses and write the metrics file one series at a time",
+    )
+    parser.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="Write a metrics file with a header line and then a line per series",
+    )
+    parser.add_argument(
+        "--gzip-to-s3",
+        action="store_true",
+        help="Gzip the metrics file while writing it and stream it to S3 instead of --output-file",
+    )
+    parser.add_argument(
+        "--columnar",
+        nargs="?",
+        const="alongside",
+        choices=["alongside", "instead"],
+        help="Also write a memory-mappable .columnar metrics file, or only that with 'instead'",
+    )
+    parser.add_argument(
+        "--runs",
+        action="store_true",
+        help="Write every series as runs of equal values rather than one value per step",
+    )
+    parser.add_argument(
+        "--combined-query",
+        action="store_true",
+        help="Fetch the CPU, memory and GPU requests with a single query and split them by resource",
+    )
+    parser.add_argument(
+        "--change-points",
+        action="store_true",
+        help="Scan queries at a coarse step first and only fetch every step where the values change",
+    )
+    parser.add_argument(
+        "--clusters-file",
+        help="JSON file listing the clusters to collect from in parallel instead of --openshift-url",
+    )
+    namespace_group = parser.add_mutually_exclusive_group()
+    namespace_group.add_argument(
+        "--namespaces",
+        nargs="+",
+        help="Only collect the metrics of these namespaces",
+    )
+    namespace_group.add_argument(
+        "--namespace-regex",
+        help="Only collect the metrics of the namespaces matching this regular expression",
+    )
+    parser.add_argument(
+        "--fill-gaps",
+        action="store_true",
+        help="Only collect the days of the report period that the metrics bucket has no file for yet",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        help="Save every fetched query piece in this directory so a rerun only fetches what's missing",
+    )
 
     args = parser.parse_args()
-    if not args.openshift_url:
+    if args.stream and (args.shard or args.plan_queries):
+        parser.error("--stream cannot be combined with --shard or --plan-queries")
+    if args.stream and (args.cache_dir or args.split_by_namespace):
+        parser.error(
+            "--stream cannot be combined with --cache-dir or --split-by-namespace"
+        )
+    if args.stream and args.node_label_cache:
+        parser.error("--stream cannot be combined with --node-label-cache")
+    if args.change_points and (args.stream or args.plan_queries):
+        parser.error(
+            "--change-points cannot be combined with --stream or --plan-queries"
+        )
+    if args.checkpoint_dir and (args.stream or args.change_points):
+        parser.error(
+            "--checkpoint-dir cannot be combined with --stream or --change-points"
+        )
+    if args.columnar and args.stream:
+        parser.error("--columnar cannot be combined with --stream")
+    if args.columnar == "instead" and (args.ndjson or args.runs):
+        parser.error("--ndjson and --runs cannot be combined with --columnar instead")
+    if args.gzip_to_s3 and (args.columnar or not args.upload_to_s3):
+        parser.error(
+            "--gzip-to-s3 needs --upload-to-s3 and cannot be combined with --columnar"
+        )
+    if args.fill_gaps and (args.output_file or not args.upload_to_s3):
+        parser.error(
+            "--fill-gaps writes a file per gap and needs --upload-to-s3, it cannot be combined with --output-file"
+        )
+    if (args.namespaces or args.namespace_regex) and args.upload_to_s3:
+        # a partial file would replace the cluster's metrics of those days
+        parser.error(
+            "--namespaces and --namespace-regex cannot be combined with --upload-to-s3 or --fill-gaps"
+        )
+    clusters = None
+    if args.clusters_file:
+        if args.node_label_cache:
+            parser.error(
+                "--node-label-cache cannot be combined with --clusters-file, set node_label_cache per cluster instead"
+            )
+        try:
+            clusters = load_clusters(args.clusters_file)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.stream and any(cluster.node_label_cache for cluster in clusters):
+            parser.error("--stream cannot be combined with node_label_cache")
+        names = [cluster.name for cluster in clusters]
+        if len(set(names)) < len(names):
+            parser.error("Every cluster in --clusters-file needs a different name")
+        buckets = [cluster.bucket for cluster in clusters]
+        if args.upload_to_s3 and len(set(buckets)) < len(buckets):
+            parser.error(
+                "Every cluster in --clusters-file needs its own bucket to upload to"
+            )
+    elif not args.openshift_url:
         sys.exit(
             "Must specify --openshift-url or set OPENSHIFT_PROMETHEUS_URL in your environment"
         )
@@ -85,81 +615,233 @@ def main():
 
     if args.output_file:
         output_file = args.output_file
-    elif report_start_date == report_end_date:
-        output_file = f"metrics-{report_start_date}.json"
     else:
-        output_file = f"metrics-{report_start_date}-to-{report_end_date}.json"
+        output_file = os.path.basename(
+            metrics_key(report_start_date, report_end_date, file_extension(args))
+        )
 
     logger.info(
         f"Generating report starting {report_start_date} and ending {report_end_date} in {output_file} with interval {PROM_QUERY_INTERVAL_MINUTES} minute"
     )
 
-    prom_client = PrometheusClient(
-        openshift_url, OPENSHIFT_TOKEN, PROM_QUERY_INTERVAL_MINUTES
-    )
+    cache = None
+    if args.cache_dir:
+        cache = QueryCache(
+            args.cache_dir,
+            PROM_QUERY_CACHE_MAX_BYTES,
+            timedelta(hours=PROM_QUERY_CACHE_MIN_AGE_HOURS),
+        )
 
-    metrics_dict = {}
-    metrics_dict["start_date"] = report_start_date
-    metrics_dict["end_date"] = report_end_date
-    metrics_dict["interval_minutes"] = PROM_QUERY_INTERVAL_MINUTES
-    metrics_dict["cluster_name"] = URL_CLUSTER_NAME_MAPPING.get(
-        args.openshift_url, args.openshift_url
-    )
+    collect = fill_gaps if args.fill_gaps else collect_cluster
+    if clusters is None:
+        cluster = Cluster(
+            openshift_url,
+            OPENSHIFT_TOKEN,
+            URL_CLUSTER_NAME_MAPPING.get(openshift_url, openshift_url),
+            node_label_cache=args.node_label_cache,
+        )
+        collect(args, cluster, output_file, args.checkpoint_dir, cache)
+        return
 
-    cpu_request_metrics = prom_client.query_metric(
-        CPU_REQUEST, report_start_date, report_end_date
-    )
+    # the clusters share the process, the query cache and the S3 client, but
+    # each has its own clients and concurrency limit
+    with ThreadPoolExecutor(max_workers=len(clusters)) as executor:
+        futures = {
+            cluster.name: executor.submit(
+                collect,
+                args,
+                cluster,
+                os.path.join(
+                    os.path.dirname(output_file),
+                    cluster.name,
+                    os.path.basename(output_file),
+                ),
+                args.checkpoint_dir and os.path.join(args.checkpoint_dir, cluster.name),
+                cache,
+            )
+            for cluster in clusters
+        }
+    failed = []
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception:
+            logger.exception(f"Collecting metrics from {name} failed")
+            failed.append(name)
+    if failed:
+        sys.exit(f"Collecting metrics failed for: {', '.join(failed)}")
 
-    try:
-        pod_labels = prom_client.query_metric(
-            KUBE_POD_LABELS, report_start_date, report_end_date
+
+def file_extension(args) -> str:
+    """Returns the extension of the metrics files the arguments ask for"""
+    if args.columnar == "instead":
+        return "columnar"
+    extension = "ndjson" if args.ndjson else "json"
+    return f"{extension}.gz" if args.gzip_to_s3 else extension
+
+
+def metrics_output(args, cluster, output_file, s3_location):
+    """
+    Returns a context manager giving where the metrics file is written to:
+    output_file, or with --gzip-to-s3 a text file that is compressed and
+    uploaded to s3_location as it's written, so nothing goes to disk.
+    """
+    if args.gzip_to_s3:
+        return utils.gzip_to_s3(cluster.bucket, s3_location)
+    return nullcontext(output_file)
+
+
+def fill_gaps(args, cluster, output_file, checkpoint_dir=None, cache=None):
+    """
+    Collects the days of the report period that the coverage index of the
+    cluster's bucket has no metrics for at the current interval. Every run
+    of missing days goes into a file of its own next to output_file, which
+    is uploaded and added to the index before the next one is collected.
+    """
+    gaps = (
+        CoverageIndex(cluster.bucket)
+        .load()
+        .missing_ranges(
+            args.report_start_date, args.report_end_date, PROM_QUERY_INTERVAL_MINUTES
         )
-        metrics_dict["cpu_metrics"] = MetricsProcessor.insert_pod_labels(
-            pod_labels, cpu_request_metrics
+    )
+    if not gaps:
+        logger.info(f"s3://{cluster.bucket} has all the metrics of the report period")
+    for start_date, end_date in gaps:
+        logger.info(f"Filling the gap from {start_date} to {end_date}")
+        gap_file = os.path.join(
+            os.path.dirname(output_file),
+            os.path.basename(metrics_key(start_date, end_date, file_extension(args))),
         )
-    except utils.EmptyResultError:
-        logger.info(
-            f"No pod labels found for the period {report_start_date} to {report_end_date}"
+        collect_cluster(
+            args,
+            cluster,
+            gap_file,
+            checkpoint_dir,
+            cache,
+            report_start_date=start_date,
+            report_end_date=end_date,
         )
-        metrics_dict["cpu_metrics"] = cpu_request_metrics
 
-    memory_request_metrics = prom_client.query_metric(
-        MEMORY_REQUEST, report_start_date, report_end_date
+
+def collect_cluster(
+    args,
+    cluster,
+    output_file,
+    checkpoint_dir=None,
+    cache=None,
+    report_start_date=None,
+    report_end_date=None,
+):
+    """
+    Collects the metrics of one cluster into output_file and uploads it. The
+    report period is the one given by args unless another is passed.
+    """
+    report_start_date = report_start_date or args.report_start_date
+    report_end_date = report_end_date or args.report_end_date
+
+    node_label_cache = None
+    if cluster.node_label_cache:
+        node_label_cache = NodeLabelCache(cluster.node_label_cache).load()
+
+    checkpoint = None
+    shard = args.shard
+    if checkpoint_dir:
+        checkpoint = Checkpoint(checkpoint_dir)
+        # a whole day of work is the most a restart loses by default
+        shard = shard or "day"
+
+    prom_client = PrometheusClient(
+        cluster.url,
+        cluster.token,
+        PROM_QUERY_INTERVAL_MINUTES,
+        max_workers=cluster.concurrency,
+        shard=shard,
+        split_by_namespace=args.split_by_namespace,
+        cache=cache,
+        governor=ConcurrencyGovernor(
+            cluster.concurrency, budget=PROM_QUERY_REQUEST_BUDGET or None
+        ),
+        checkpoint=checkpoint,
     )
-    metrics_dict["memory_metrics"] = memory_request_metrics
+    if args.plan_queries:
+        prom_client = QueryPlanner(prom_client, PROM_QUERY_MAX_SAMPLES)
+    if args.change_points:
+        prom_client = ChangePointCollector(prom_client, PROM_CHANGE_POINT_WINDOW_STEPS)
 
-    # because if nobody requests a GPU then we will get an empty set
-    try:
-        gpu_request_metrics = prom_client.query_metric(
-            GPU_REQUEST, report_start_date, report_end_date
-        )
-        node_labels = prom_client.query_metric(
-            KUBE_NODE_LABELS, report_start_date, report_end_date
-        )
-        metrics_dict["gpu_metrics"] = MetricsProcessor.insert_node_labels(
-            node_labels, gpu_request_metrics
-        )
-    except utils.EmptyResultError:
-        logger.info(
-            f"No GPU metrics found for the period {report_start_date} to {report_end_date}"
-        )
-        pass
+    metrics_dict = {}
+    metrics_dict["start_date"] = report_start_date
+    metrics_dict["end_date"] = report_end_date
+    metrics_dict["interval_minutes"] = PROM_QUERY_INTERVAL_MINUTES
+    metrics_dict["cluster_name"] = cluster.name
 
-    month_year = datetime.strptime(report_start_date, "%Y-%m-%d").strftime("%Y-%m")
+    s3_location = metrics_key(report_start_date, report_end_date, file_extension(args))
+    columnar_file = f"{os.path.splitext(output_file)[0]}.columnar"
 
-    if report_start_date == report_end_date:
-        s3_location = f"data_{month_year}/metrics-{report_start_date}.json"
-    else:
-        s3_location = (
-            f"data_{month_year}/metrics-{report_start_date}-to-{report_end_date}.json"
-        )
+    if os.path.dirname(output_file) and not args.gzip_to_s3:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    with open(output_file, "w") as file:
-        logger.info(f"Writing metrics to {output_file}")
-        json.dump(metrics_dict, file)
+    step = PROM_QUERY_INTERVAL_MINUTES * 60 if args.runs else None
+    if args.stream:
+        if args.runs:
+            metrics_dict["series_format"] = RUNS
+        writer_class = NdjsonMetricsFileWriter if args.ndjson else MetricsFileWriter
+        with (
+            prom_client,
+            metrics_output(args, cluster, output_file, s3_location) as output,
+            writer_class(output, metrics_dict, step=step) as writer,
+        ):
+            stream_metrics(
+                prom_client,
+                report_start_date,
+                report_end_date,
+                writer,
+                combined_query=args.combined_query,
+                project_labels=args.project_labels,
+                namespace_matcher=namespace_matcher(args),
+            )
+    else:
+        with prom_client:
+            metrics_dict.update(
+                collect_metrics(
+                    prom_client,
+                    report_start_date,
+                    report_end_date,
+                    combined_query=args.combined_query,
+                    project_labels=args.project_labels,
+                    node_label_cache=node_label_cache,
+                    namespace_matcher=namespace_matcher(args),
+                )
+            )
+        if node_label_cache is not None:
+            node_label_cache.save()
+        if args.columnar == "instead":
+            write_columnar(output_file, metrics_dict)
+        else:
+            if args.columnar:
+                write_columnar(columnar_file, metrics_dict)
+            if args.runs:
+                encode_metrics(metrics_dict, step)
+            with metrics_output(args, cluster, output_file, s3_location) as output:
+                if args.ndjson:
+                    write_ndjson(output, metrics_dict)
+                else:
+                    write_json(output, metrics_dict)
+        if checkpoint is not None:
+            checkpoint.remove()
 
     if args.upload_to_s3:
-        utils.upload_to_s3(output_file, S3_METRICS_BUCKET, s3_location)
+        if not args.gzip_to_s3:
+            utils.upload_to_s3(output_file, cluster.bucket, s3_location)
+        if args.columnar == "alongside":
+            utils.upload_to_s3(
+                columnar_file,
+                cluster.bucket,
+                metrics_key(report_start_date, report_end_date, "columnar"),
+            )
+        CoverageIndex(cluster.bucket).load().add(
+            report_start_date, report_end_date, PROM_QUERY_INTERVAL_MINUTES, s3_location
+        ).save()
 
 
 if __name__ == "__main__":
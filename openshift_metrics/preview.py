@@ -0,0 +1,257 @@
+"""
+Estimates the costs of a report period by namespace straight from prometheus,
+at a coarse resolution, without collecting and merging the full metrics
+"""
+
+import argparse
+import logging
+import math
+import sys
+from datetime import datetime, timedelta, UTC
+from decimal import Decimal, ROUND_HALF_UP
+
+from nerc_rates import outages
+
+from openshift_metrics import invoice, utils
+from openshift_metrics.merge import get_su_definitions, load_nerc_rates
+from openshift_metrics.metrics_processor import MetricsProcessor
+from openshift_metrics.openshift_prometheus_metrics import (
+    URL_CLUSTER_NAME_MAPPING,
+    collect_metrics,
+)
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.config import (
+    OPENSHIFT_PROMETHEUS_URL,
+    OPENSHIFT_TOKEN,
+    PROM_QUERY_CONCURRENCY,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+COST_COLUMN = utils.INVOICE_HEADERS.index("Cost")
+
+
+def estimate_costs(
+    condensed_metrics_dict,
+    report_metadata: invoice.ReportMetadata,
+    rates: invoice.Rates,
+    su_definitions,
+    interval_minutes,
+    ignore_hours=None,
+) -> dict:
+    """
+    Returns {namespace: (cost, error_bound)} for the condensed metrics, with
+    the cost worked out like the invoice does.
+
+    The metrics were sampled every interval_minutes, so each stretch of
+    samples in the condensed metrics may have started up to an interval
+    earlier or ended up to an interval later than it appears to. The error
+    bound is the cost of one interval of every stretch, rounded up to whole
+    SU hours like the invoice. Pods that ran entirely between two samples
+    aren't seen at all and aren't covered by the bound.
+    """
+    interval_hours = Decimal(interval_minutes) / 60
+    estimates = {}
+    for namespace, pods in condensed_metrics_dict.items():
+        project_invoice = invoice.ProjectInvoce(
+            project=namespace,
+            project_id=namespace,
+            rates=rates,
+            su_definitions=su_definitions,
+            ignore_hours=ignore_hours,
+        )
+        uncertain_su_hours = {}
+        for pod, pod_dict in pods.items():
+            for epoch_time, pod_metric_dict in pod_dict["metrics"].items():
+                pod_obj = invoice.Pod(
+                    pod_name=pod,
+                    namespace=namespace,
+                    start_time=epoch_time,
+                    duration=pod_metric_dict["duration"],
+                    cpu_request=Decimal(pod_metric_dict.get("cpu_request", 0)),
+                    gpu_request=Decimal(pod_metric_dict.get("gpu_request", 0)),
+                    memory_request=Decimal(pod_metric_dict.get("memory_request", 0))
+                    / 2**30,
+                    gpu_type=pod_metric_dict.get("gpu_type"),
+                    gpu_resource=pod_metric_dict.get("gpu_resource"),
+                    node_hostname=pod_metric_dict.get("node"),
+                    node_model=pod_metric_dict.get("node_model"),
+                )
+                project_invoice.add_pod(pod_obj)
+                su_type, su_count, _ = pod_obj.get_service_unit(su_definitions)
+                uncertain_su_hours[su_type] = (
+                    uncertain_su_hours.get(su_type, 0) + su_count * interval_hours
+                )
+
+        cost = sum(
+            (
+                row[COST_COLUMN]
+                for row in project_invoice.generate_invoice_rows(report_metadata)
+            ),
+            Decimal(0),
+        )
+        error_bound = sum(
+            (
+                project_invoice.get_rate(su_type) * math.ceil(hours)
+                for su_type, hours in uncertain_su_hours.items()
+            ),
+            Decimal(0),
+        )
+        estimates[namespace] = (
+            cost,
+            error_bound.quantize(Decimal(".01"), rounding=ROUND_HALF_UP),
+        )
+    return estimates
+
+
+def main():
+    """Collects coarse metrics for the report period and estimates its costs"""
+    yesterday = datetime.today() - timedelta(days=1)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--openshift-url",
+        help="OpenShift Prometheus URL",
+        default=OPENSHIFT_PROMETHEUS_URL,
+    )
+    parser.add_argument(
+        "--report-start-date",
+        help="report date (ex: 2022-03-01), defaults to the start of the month",
+        default=yesterday.replace(day=1).strftime("%Y-%m-%d"),
+    )
+    parser.add_argument(
+        "--report-end-date",
+        help="report date (ex: 2022-03-14), defaults to yesterday",
+        default=yesterday.strftime("%Y-%m-%d"),
+    )
+    parser.add_argument(
+        "--interval-minutes",
+        type=int,
+        default=60,
+        help="How far apart the samples are, the error bound grows with it",
+    )
+    parser.add_argument(
+        "--max-source-resolution",
+        help="Have thanos answer from downsampled data (ex: 5m, 1h or auto)",
+    )
+    parser.add_argument(
+        "--output-file",
+        help="Name of the preview file. Defaults to Preview NERC OpenShift <report_month>.csv",
+    )
+    parser.add_argument(
+        "--use-nerc-rates",
+        action="store_true",
+        help="Use rates and outages from the nerc-rates repo",
+    )
+    parser.add_argument("--rate-cpu-su", type=Decimal)
+    parser.add_argument("--rate-gpu-v100-su", type=Decimal)
+    parser.add_argument("--rate-gpu-a100sxm4-su", type=Decimal)
+    parser.add_argument("--rate-gpu-a100-su", type=Decimal)
+    parser.add_argument("--rate-gpu-h100-su", type=Decimal)
+
+    args = parser.parse_args()
+    if not args.openshift_url:
+        sys.exit(
+            "Must specify --openshift-url or set OPENSHIFT_PROMETHEUS_URL in your environment"
+        )
+    if args.interval_minutes < 1:
+        sys.exit("--interval-minutes must be at least 1")
+
+    report_start_date = args.report_start_date
+    report_end_date = args.report_end_date
+    report_month = datetime.strptime(report_start_date, "%Y-%m-%d").strftime("%Y-%m")
+    cluster_name = URL_CLUSTER_NAME_MAPPING.get(args.openshift_url, args.openshift_url)
+
+    logger.info(
+        f"Previewing {report_start_date} to {report_end_date} for {cluster_name} at {args.interval_minutes} minute intervals"
+    )
+    with PrometheusClient(
+        args.openshift_url,
+        OPENSHIFT_TOKEN,
+        args.interval_minutes,
+        max_workers=PROM_QUERY_CONCURRENCY,
+        max_source_resolution=args.max_source_resolution,
+    ) as prom_client:
+        metrics_dict = collect_metrics(
+            prom_client, report_start_date, report_end_date, project_labels=True
+        )
+
+    processor = MetricsProcessor(interval_minutes=args.interval_minutes)
+    processor.merge_metrics("cpu_request", metrics_dict["cpu_metrics"])
+    processor.merge_metrics("memory_request", metrics_dict["memory_metrics"])
+    if "gpu_metrics" in metrics_dict:
+        processor.merge_metrics("gpu_request", metrics_dict["gpu_metrics"])
+    condensed_metrics_dict = processor.condense_metrics(
+        ["cpu_request", "memory_request", "gpu_request", "gpu_type"]
+    )
+
+    if args.use_nerc_rates:
+        invoice_rates = load_nerc_rates(report_month)
+        ignore_hours = outages.load_from_url().get_outages_during(
+            report_start_date, report_end_date, cluster_name
+        )
+    else:
+        invoice_rates = invoice.Rates(
+            cpu=Decimal(args.rate_cpu_su),
+            gpu_a100=Decimal(args.rate_gpu_a100_su),
+            gpu_a100sxm4=Decimal(args.rate_gpu_a100sxm4_su),
+            gpu_v100=Decimal(args.rate_gpu_v100_su),
+            gpu_h100=Decimal(args.rate_gpu_h100_su),
+        )
+        ignore_hours = None
+
+    report_start_time = datetime.strptime(report_start_date, "%Y-%m-%d").replace(
+        tzinfo=UTC
+    )
+    report_end_time = datetime.strptime(report_end_date, "%Y-%m-%d").replace(
+        tzinfo=UTC
+    ) + timedelta(days=1)
+    report_metadata = invoice.ReportMetadata(
+        report_month=report_month,
+        cluster_name=cluster_name,
+        report_start_time=report_start_time,
+        report_end_time=report_end_time,
+        generated_at=datetime.now(UTC),
+    )
+    estimates = estimate_costs(
+        condensed_metrics_dict,
+        report_metadata,
+        invoice_rates,
+        get_su_definitions(report_month),
+        args.interval_minutes,
+        ignore_hours,
+    )
+
+    rows = [
+        [
+            "Project - Allocation",
+            "Cluster Name",
+            "Report Start Time",
+            "Report End Time",
+            "Estimated Cost",
+            "Error Bound",
+        ]
+    ]
+    for namespace, (cost, error_bound) in sorted(estimates.items()):
+        rows.append(
+            [
+                namespace,
+                cluster_name,
+                report_start_time.isoformat(timespec="seconds"),
+                report_end_time.isoformat(timespec="seconds"),
+                cost,
+                error_bound,
+            ]
+        )
+    output_file = args.output_file or f"Preview NERC OpenShift {report_month}.csv"
+    utils.csv_writer(rows, output_file)
+
+    total_cost = sum((cost for cost, _ in estimates.values()), Decimal(0))
+    total_error_bound = sum((bound for _, bound in estimates.values()), Decimal(0))
+    logger.info(
+        f"Estimated cost of {len(estimates)} namespaces: {total_cost} +/- {total_error_bound}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,604 @@
+import json
+import math
+import re
 import requests
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, UTC
 
 from urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
-from openshift_metrics.utils import EmptyResultError
+from openshift_metrics import promql
+from openshift_metrics.concurrency_governor import (
+    THROTTLE_STATUSES,
+    ConcurrencyGovernor,
+    parse_retry_after,
+)
+from openshift_metrics.utils import EmptyResultError, QueryTooLargeError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SHARD_DURATIONS = {
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+}
+
+# Phrases thanos and prometheus use when a query hits one of the querier limits
+QUERY_TOO_LARGE_ERRORS = ["exceeded", "too many samples", "limit"]
+
+# How much of a streamed response body is read at a time
+STREAM_CHUNK_SIZE = 65536
+
+# How many times a throttled request is retried before giving up on it
+THROTTLED_RETRIES = 5
+
+RESULT_START_RE = re.compile(rb'"result"\s*:\s*\[')
+# Outside of strings only braces and quotes matter for finding where a series
+# ends, inside of them only the closing quote and escapes
+OBJECT_TOKEN_RE = re.compile(rb'[{}"]')
+STRING_TOKEN_RE = re.compile(rb'["\\]')
+
+
+def date_range(start_date, end_date):
+    """Returns the datetimes covering the report dates start_date through end_date"""
+    start = datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=UTC)
+    end = datetime.strptime(end_date, "%Y-%m-%d").replace(
+        tzinfo=UTC, hour=23, minute=59, second=59
+    )
+    return start, end
+
+
+def split_range(start: datetime, end: datetime, shard_duration, step):
+    """
+    Splits the range [start, end] into consecutive sub-ranges of roughly
+    shard_duration.
+
+    Every sub-range starts on the step grid of the full range and ends one step
+    before the next one starts, so a query_range over each sub-range returns
+    exactly the samples a single query over [start, end] would, with none of
+    them repeated at the boundaries.
+    """
+    ranges = []
+    shard_start = start
+    while shard_start <= end:
+        steps = math.ceil((shard_start + shard_duration - start) / step)
+        next_start = start + steps * step
+        shard_end = end if next_start > end else next_start - step
+        ranges.append((shard_start, shard_end))
+        shard_start = next_start
+    return ranges
+
+
+def bisect_range(start: datetime, end: datetime, step):
+    """
+    Splits [start, end] in two halves on the step grid, or returns None if the
+    range only holds a single step.
+    """
+    steps = (end - start) // step + 1
+    if steps <= 1:
+        return None
+    middle = start + (steps // 2) * step
+    return [(start, middle - step), (middle, end)]
+
+
+def is_query_too_large(response) -> bool:
+    """Checks if the query was refused for exceeding a resolution or sample limit"""
+    if response.status_code not in (400, 422, 503):
+        return False
+    try:
+        error = response.json().get("error", "")
+    except ValueError:
+        error = response.text
+    return is_too_large_error(error)
+
+
+def is_too_large_error(error: str) -> bool:
+    """Checks if a prometheus error message is about a querier limit"""
+    return any(phrase in error.lower() for phrase in QUERY_TOO_LARGE_ERRORS)
+
+
+def stitch_results(results):
+    """
+    Joins query_range results for consecutive sub-ranges into a single result.
+
+    The values of each series are concatenated in order and any sample that is
+    not newer than the last one already stitched is dropped. Series are sorted
+    by their labels the same way prometheus sorts a range query result.
+    """
+    series = {}
+    for result in results:
+        for metric in result:
+            key = tuple(sorted(metric["metric"].items()))
+            if key not in series:
+                series[key] = {"metric": metric["metric"], "values": []}
+            values = series[key]["values"]
+            for value in metric["values"]:
+                if not values or value[0] > values[-1][0]:
+                    values.append(value)
+    return [series[key] for key in sorted(series)]
+
+
+def iter_result_series(chunks):
+    """
+    Yields the series in data.result of a query_range response body, given as
+    an iterable of byte chunks, one at a time as soon as each one is complete.
+
+    Only the series being read is buffered, so memory use is bounded by the
+    largest series rather than by the size of the response.
+    """
+    chunks = iter(chunks)
+    buffer = bytearray()
+    while True:
+        match = RESULT_START_RE.search(buffer)
+        if match is not None:
+            del buffer[: match.end()]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError("No result in query_range response")
+        # keep enough of the buffer for a "result" key split between chunks
+        del buffer[:-32]
+        buffer += chunk
+
+    pos = 0
+    depth = 0
+    in_string = False
+    while True:
+        if pos >= len(buffer):
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("Truncated query_range response")
+            buffer += chunk
+            continue
+
+        if depth == 0:
+            char = buffer[pos : pos + 1]
+            if char == b"]":
+                return
+            if char == b"{":
+                del buffer[:pos]
+                pos = 1
+                depth = 1
+            else:
+                pos += 1
+            continue
+
+        token_re = STRING_TOKEN_RE if in_string else OBJECT_TOKEN_RE
+        match = token_re.search(buffer, pos)
+        if match is None:
+            pos = len(buffer)
+            continue
+        token = match.group()
+        pos = match.end()
+        if token == b"\\":
+            # skip the escaped character, even if it's in the next chunk
+            pos += 1
+        elif token == b'"':
+            in_string = not in_string
+        elif token == b"{":
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 0:
+                yield json.loads(buffer[:pos])
+                del buffer[:pos]
+                pos = 0
+
 
 class PrometheusClient:
-    def __init__(self, prometheus_url: str, token: str, step_min: int = 15):
+    def __init__(
+        self,
+        prometheus_url: str,
+        token: str,
+        step_min: int = 15,
+        max_workers: int = 5,
+        shard: str = None,
+        split_by_namespace: bool = False,
+        cache=None,
+        governor: ConcurrencyGovernor = None,
+        backoff_factor: float = 1,
+        checkpoint=None,
+        max_source_resolution: str = None,
+    ):
         self.prometheus_url = prometheus_url
         self.token = token
         self.step_min = step_min
+        self.max_workers = max_workers
+        self.shard = shard
+        self.split_by_namespace = split_by_namespace
+        self.cache = cache
+        self.governor = governor or ConcurrencyGovernor(max_workers)
+        self.backoff_factor = backoff_factor
+        self.checkpoint = checkpoint
+        # thanos answers from data downsampled to this resolution when set
+        self.max_source_resolution = max_source_resolution
+        self.session = self._create_session()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
 
-    def query_metric(self, metric, start_date, end_date):
-        """Queries metric from the provided prometheus_url"""
-        data = None
-        headers = {"Authorization": f"Bearer {self.token}"}
-        day_url_vars = f"start={start_date}T00:00:00Z&end={end_date}T23:59:59Z"
-        url = f"{self.prometheus_url}/api/v1/query_range?query={metric}&{day_url_vars}&step={self.step_min}m"
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stops the worker threads and closes pooled connections"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
 
+    def _create_session(self) -> requests.Session:
+        """
+        Creates a session that is shared by all queries so that connections
+        (and TLS handshakes) are reused. The pool is sized so that every worker
+        thread can hold its own connection.
+        """
+        # throttling is left to _send so the governor gets to see it, and
+        # thanos also uses 503 for sample limits, which need the query to be
+        # split rather than retried
         retries = Retry(
-            total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504]
+            total=3,
+            backoff_factor=1,
+            status_forcelist=[500, 502, 504],
+            respect_retry_after_header=False,
+        )
+        adapter = HTTPAdapter(
+            max_retries=retries,
+            pool_connections=1,
+            pool_maxsize=self.max_workers,
         )
         session = requests.Session()
-        session.mount("https://", HTTPAdapter(max_retries=retries))
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Authorization": f"Bearer {self.token}"})
+        return session
+
+    def submit(self, metric, start_date, end_date):
+        """Queries metric in the background and returns a Future for the result"""
+        return self._executor.submit(self.query_metric, metric, start_date, end_date)
 
+    def submit_series(self, selector, start_date, end_date):
+        """Fetches the label sets of selector in the background, returns a Future"""
+        return self._executor.submit(self.query_series, selector, start_date, end_date)
+
+    def query_series(self, selector, start_date, end_date):
+        """
+        Returns the distinct label sets of the series matching selector during
+        the report dates, in the same shape as query_metric but without any
+        values. This is all the label joins need and is much cheaper to produce
+        and to transfer than a full range query.
+        """
+        start, end = date_range(start_date, end_date)
+        logger.info(f"Retrieving series: {selector}")
+        label_sets = self._get_data(
+            "/api/v1/series",
+            {
+                "match[]": selector,
+                "start": f"{start:%Y-%m-%dT%H:%M:%SZ}",
+                "end": f"{end:%Y-%m-%dT%H:%M:%SZ}",
+            },
+        )
+        series = {tuple(sorted(labels.items())): labels for labels in label_sets}
+        if not series:
+            raise EmptyResultError(f"No series found for: {selector}")
+        return [{"metric": series[key]} for key in sorted(series)]
+
+    def submit_stream(self, metric, start_date, end_date, consume):
+        """
+        Streams metric in the background, passing every series to consume as
+        it is parsed. Returns a Future that is done once the stream is.
+        """
+
+        def stream():
+            for series in self.iter_metric(metric, start_date, end_date):
+                consume(series)
+
+        return self._executor.submit(stream)
+
+    def iter_metric(self, metric, start_date, end_date):
+        """
+        Queries metric like query_metric, but yields the series one at a time
+        while the response is still being read instead of returning them all
+        at once. Sharding and splitting aren't supported since they need the
+        whole result to stitch it back together.
+        """
+        start, end = date_range(start_date, end_date)
+        params = self._query_range_params(metric, start, end)
+        logger.info(f"Streaming metric: {metric}")
+
+        for _ in range(3):
+            response = self._send(
+                "get",
+                f"{self.prometheus_url}/api/v1/query_range",
+                "/api/v1/query_range",
+                params=params,
+                stream=True,
+            )
+
+            if is_query_too_large(response):
+                raise QueryTooLargeError(
+                    f"{response.status_code} Response: {response.reason}"
+                )
+            if response.status_code != 200:
+                logger.warning(f"{response.status_code} Response: {response.reason}")
+            else:
+                # once a series has been handed out the query can't be retried
+                empty = True
+                for series in iter_result_series(
+                    response.iter_content(STREAM_CHUNK_SIZE)
+                ):
+                    empty = False
+                    yield series
+                if not empty:
+                    return
+                logger.warning("Empty result set")
+            time.sleep(3)
+
+        raise EmptyResultError(f"Error retrieving metric: {metric}")
+
+    def query_metric(self, metric, start_date, end_date, shard=None):
+        """Queries metric from the provided prometheus_url"""
+        start, end = date_range(start_date, end_date)
+        return self.query_range(metric, start, end, shard)
+
+    def query_range(
+        self,
+        metric,
+        start: datetime,
+        end: datetime,
+        shard=None,
+        namespace_groups=None,
+        max_workers=None,
+    ):
+        """
+        Queries metric between start and end.
+
+        If a shard size ("hour", "day" or "week") is given, or was set on the
+        client, the range is split into sub-ranges of that size. If
+        namespace_groups is given, one query is sent per group of namespaces.
+        The pieces are fetched in parallel and stitched back together.
+
+        Any range that prometheus refuses as too large is bisected until each
+        piece succeeds. With a checkpoint every piece is saved as soon as it's
+        fetched, and pieces that are already in it aren't fetched again.
+        """
+        shard = shard or self.shard
         logger.info(f"Retrieving metric: {metric}")
 
+        if shard is None and not namespace_groups:
+            data = self._checkpointed_fetch_range(metric, start, end)
+        else:
+            if shard is None:
+                ranges = [(start, end)]
+            else:
+                ranges = split_range(
+                    start,
+                    end,
+                    SHARD_DURATIONS[shard],
+                    timedelta(minutes=self.step_min),
+                )
+            if namespace_groups:
+                queries = [
+                    promql.add_label_matcher(
+                        metric, promql.regex_matcher("namespace", group)
+                    )
+                    for group in namespace_groups
+                ]
+            else:
+                queries = [metric]
+            pieces = [(query, *piece) for query in queries for piece in ranges]
+            logger.info(f"Fetching {len(pieces)} pieces for {metric}")
+            with ThreadPoolExecutor(
+                max_workers=max_workers or self.max_workers
+            ) as executor:
+                results = list(
+                    executor.map(
+                        lambda piece: self._checkpointed_fetch_range(*piece), pieces
+                    )
+                )
+            # a piece that never got a successful response leaves a hole
+            if any(result is None for result in results):
+                raise EmptyResultError(f"Error retrieving metric: {metric}")
+            data = stitch_results(results)
+
+        if not data:
+            raise EmptyResultError(f"Error retrieving metric: {metric}")
+        return data
+
+    def _checkpointed_fetch_range(self, metric, start: datetime, end: datetime):
+        """_fetch_range, skipping pieces an earlier run already completed"""
+        if self.checkpoint is None:
+            return self._fetch_range(metric, start, end)
+
+        key = self.checkpoint.key(
+            self.prometheus_url, metric, start, end, self.step_min
+        )
+        data = self.checkpoint.get(key)
+        if data is not None:
+            logger.info(f"Using checkpointed {metric} from {start} to {end}")
+            return data
+        data = self._fetch_range(metric, start, end)
+        if data is not None:
+            self.checkpoint.put(key, metric, start, end, data)
+        return data
+
+    def _fetch_range(self, metric, start: datetime, end: datetime):
+        """
+        Fetches metric between start and end, bisecting the range whenever
+        prometheus says the query is too large. Once a range can't be split
+        any further the series are split by namespace, if enabled.
+        """
+        try:
+            return self._cached_query_range(metric, start, end)
+        except QueryTooLargeError:
+            halves = bisect_range(start, end, timedelta(minutes=self.step_min))
+            if halves is None:
+                if self.split_by_namespace:
+                    return self._fetch_by_namespace(metric, start, end)
+                raise
+
+        logger.warning(f"Query too large, splitting {start} to {end} in half")
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(
+                executor.map(lambda half: self._fetch_range(metric, *half), halves)
+            )
+        if any(result is None for result in results):
+            return None
+        return stitch_results(results)
+
+    def _fetch_by_namespace(
+        self, metric, start: datetime, end: datetime, namespaces=None
+    ):
+        """
+        Fetches metric for namespaces (all namespaces that have the metric by
+        default) by splitting the namespaces in half until each query succeeds.
+        """
+        if namespaces is None:
+            namespaces = self._label_values(
+                "namespace", promql.first_selector(metric), start, end
+            )
+        if len(namespaces) <= 1:
+            raise QueryTooLargeError(
+                f"Query too large even for one namespace: {metric}"
+            )
+
+        logger.warning(
+            f"Query too large, splitting {len(namespaces)} namespaces in half"
+        )
+        middle = len(namespaces) // 2
+        results = []
+        for group in [namespaces[:middle], namespaces[middle:]]:
+            query = promql.add_label_matcher(
+                metric, promql.regex_matcher("namespace", group)
+            )
+            try:
+                result = self._cached_query_range(query, start, end)
+            except QueryTooLargeError:
+                result = self._fetch_by_namespace(metric, start, end, group)
+            if result is None:
+                return None
+            results.append(result)
+        return stitch_results(results)
+
+    def query_instant(self, query, timestamp: datetime):
+        """Evaluates query at a single point in time"""
+        return self._get_data(
+            "/api/v1/query",
+            {"query": query, "time": f"{timestamp:%Y-%m-%dT%H:%M:%SZ}"},
+        )["result"]
+
+    def _label_values(self, label, selector, start: datetime, end: datetime):
+        """Returns the values of label across the series matching selector"""
+        return self._get_data(
+            f"/api/v1/label/{label}/values",
+            {
+                "match[]": selector,
+                "start": f"{start:%Y-%m-%dT%H:%M:%SZ}",
+                "end": f"{end:%Y-%m-%dT%H:%M:%SZ}",
+            },
+        )
+
+    def _get_data(self, path, params):
+        """Sends a request to one of the prometheus APIs and returns its data"""
+        response = self._send(
+            "get", f"{self.prometheus_url}{path}", path, params=params
+        )
+        response.raise_for_status()
+        return response.json()["data"]
+
+    def _send(self, method, url, kind, **kwargs):
+        """
+        Sends a request once the governor lets it through and tells it how the
+        request went. Throttled requests are retried after their Retry-After,
+        or an exponential backoff without one, and the last throttled response
+        is returned if prometheus never lets up. kind groups requests with
+        similar latencies.
+
+        Streamed responses give their slot back once the headers are in.
+        """
+        for attempt in range(THROTTLED_RETRIES + 1):
+            started = self.governor.acquire()
+            try:
+                response = getattr(self.session, method)(url, verify=True, **kwargs)
+            except BaseException:
+                # a failed connection says nothing about prometheus' load
+                self.governor.release(started, kind)
+                raise
+            throttled = response.status_code in THROTTLE_STATUSES and not (
+                is_query_too_large(response)
+            )
+            if not throttled:
+                self.governor.release(started, kind)
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is None:
+                retry_after = self.backoff_factor * 2**attempt
+            self.governor.release(
+                started, kind, throttled=True, retry_after=retry_after
+            )
+            logger.warning(
+                f"{response.status_code} Response: throttled, retrying in {retry_after}s"
+            )
+        return response
+
+    def _cached_query_range(self, metric, start: datetime, end: datetime):
+        """_query_range, answered from the cache for ranges that are over"""
+        if (
+            self.cache is None
+            or self.max_source_resolution
+            or not self.cache.is_cacheable(end)
+        ):
+            return self._query_range(metric, start, end)
+
+        key = self.cache.key(self.prometheus_url, metric, start, end, self.step_min)
+        data = self.cache.get(key)
+        if data is not None:
+            logger.info(f"Using cached result for {metric} from {start} to {end}")
+            return data
+        data = self._query_range(metric, start, end)
+        if data:
+            self.cache.put(key, data)
+        return data
+
+    def _query_range_params(self, metric, start: datetime, end: datetime) -> dict:
+        """
+        Returns the parameters of a query_range request. requests encodes
+        them, so a "+", "&" or "#" in a matcher reaches prometheus as it is.
+        """
+        params = {
+            "query": metric,
+            "start": f"{start:%Y-%m-%dT%H:%M:%SZ}",
+            "end": f"{end:%Y-%m-%dT%H:%M:%SZ}",
+            "step": f"{self.step_min}m",
+        }
+        if self.max_source_resolution:
+            params["max_source_resolution"] = self.max_source_resolution
+        return params
+
+    def _query_range(self, metric, start: datetime, end: datetime):
+        """
+        Sends a single query_range request and returns the result, or None if
+        no request succeeded. Raises QueryTooLargeError straight away if the
+        query hit a querier limit since retrying it as is can't succeed.
+        """
+        data = None
+        params = self._query_range_params(metric, start, end)
+
         for _ in range(3):
-            response = session.get(url, headers=headers, verify=True)
+            response = self._send(
+                "get",
+                f"{self.prometheus_url}/api/v1/query_range",
+                "/api/v1/query_range",
+                params=params,
+            )
 
+            if is_query_too_large(response):
+                raise QueryTooLargeError(
+                    f"{response.status_code} Response: {response.reason}"
+                )
             if response.status_code != 200:
                 print(f"{response.status_code} Response: {response.reason}")
             else:
@@ -43,6 +608,4 @@ class PrometheusClient:
                 logger.warning("Empty result set")
             time.sleep(3)
 
-        if not data:
-            raise EmptyResultError(f"Error retrieving metric: {metric}")
         return data
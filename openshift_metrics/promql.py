@@ -0,0 +1,55 @@
+"""Helpers for inspecting and rewriting the PromQL queries sent by the collector"""
+
+import re
+
+SELECTOR_RE = re.compile(r"[a-zA-Z_:][a-zA-Z0-9_:]*\{[^}]*\}")
+# a selector, optionally filtered by `unless`, keeps its metric name
+NAMED_QUERY_RE = re.compile(
+    r"\s*([a-zA-Z_:][a-zA-Z0-9_:]*)\{[^}]*\}\s*(unless\b.*)?", re.DOTALL
+)
+
+
+def first_selector(query: str) -> str:
+    """Returns the first vector selector with label matchers in query"""
+    match = SELECTOR_RE.search(query)
+    if match is None:
+        raise ValueError(f"No vector selector with label matchers in: {query}")
+    return match.group()
+
+
+def add_label_matcher(query: str, matcher: str) -> str:
+    """
+    Adds matcher to the first vector selector in query.
+
+    In our queries the first selector is the left hand side of any `unless`
+    so this is enough to restrict which series end up in the result.
+    """
+    selector = first_selector(query)
+    brace = query.index(selector) + selector.index("{") + 1
+    separator = "" if selector.endswith("{}") else ", "
+    return f"{query[:brace]}{matcher}{separator}{query[brace:]}"
+
+
+def regex_matcher(label: str, values) -> str:
+    """Returns a matcher for label that matches any of values exactly"""
+    return pattern_matcher(label, "|".join(re.escape(value) for value in values))
+
+
+def pattern_matcher(label: str, pattern: str) -> str:
+    """Returns a matcher for label that matches the regular expression pattern"""
+    pattern = pattern.replace("\\", "\\\\").replace('"', '\\"')
+    return f'{label}=~"{pattern}"'
+
+
+def project_labels(query: str, labels) -> str:
+    """Wraps query in an aggregation that drops every label but labels"""
+    return f"max by ({', '.join(labels)}) ({query})"
+
+
+def metric_name(query: str):
+    """
+    Returns the metric name the series in the result of query are labelled
+    with, or None if the query drops it.
+    """
+    match = NAMED_QUERY_RE.fullmatch(query)
+    return None if match is None else match.group(1)
@@ -0,0 +1,110 @@
+"""An on-disk cache for the results of range queries over past time ranges"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta, UTC
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class QueryCache:
+    """
+    Keeps query_range results as gzip compressed JSON files in directory.
+
+    Once a range ended more than min_age ago prometheus won't get any new
+    samples for it, so its result can be reused by any later run that sends
+    the same query. Only such ranges are cached. When the files add up to more
+    than max_bytes the least recently used ones are removed.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, min_age: timedelta):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(prometheus_url, query, start: datetime, end: datetime, step_min) -> str:
+        """
+        Returns the cache key of a range query. The end is moved back to the
+        last step of the range, so ranges that return the same samples share
+        a key whether or not they end on a step.
+        """
+        step = timedelta(minutes=step_min)
+        end = start + (end - start) // step * step
+        request = json.dumps(
+            [prometheus_url, query, start.isoformat(), end.isoformat(), step_min]
+        )
+        return hashlib.sha256(request.encode()).hexdigest()
+
+    def is_cacheable(self, end: datetime) -> bool:
+        """Checks if a range ending at end is old enough to never change"""
+        return end <= datetime.now(UTC) - self.min_age
+
+    def _path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}.json.gz")
+
+    def get(self, key):
+        """Returns the cached result for key, or None if there's none"""
+        path = self._path(key)
+        try:
+            with gzip.open(path, "rt") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logger.warning(f"Removing unreadable cache file {path}")
+            self._remove(path)
+            return None
+        # the modification time is what eviction goes by
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Caches data under key and evicts old results if the cache is full"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt") as file:
+                json.dump(data, file)
+            os.replace(temp_path, self._path(key))
+        except BaseException:
+            self._remove(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used results until the cache fits max_bytes"""
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(".json.gz"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
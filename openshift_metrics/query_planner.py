@@ -0,0 +1,173 @@
+"""Plans how the collector queries are split so they stay under the querier limits"""
+
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from openshift_metrics import promql
+from openshift_metrics.prometheus_client import (
+    SHARD_DURATIONS,
+    date_range,
+    split_range,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# prometheus refuses range queries that return more points than this per series
+MAX_POINTS_PER_SERIES = 11000
+
+
+@dataclass
+class QueryPlan:
+    """How a query is going to be fetched"""
+
+    series: int
+    samples: int
+    shard: Optional[str] = None
+    namespace_groups: List[List[str]] = field(default_factory=list)
+    concurrency: int = 1
+
+
+class QueryPlanner:
+    """
+    Sits in front of a PrometheusClient and sizes up every query with cheap
+    instant `count by (namespace)` probes before fetching it. The estimate is
+    used to pick the largest time slices, and if needed namespace partitions,
+    that keep each request under max_samples.
+    """
+
+    def __init__(self, prom_client, max_samples: int, max_concurrency: int = None):
+        self.prom_client = prom_client
+        self.max_samples = max_samples
+        self.max_concurrency = max_concurrency or prom_client.max_workers
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.prom_client.close()
+
+    def submit(self, metric, start_date, end_date):
+        """Plans and queries metric in the background, returns a Future for the result"""
+        return self._executor.submit(self.query_metric, metric, start_date, end_date)
+
+    def submit_series(self, selector, start_date, end_date):
+        """Label sets are cheap to fetch, so they go straight to the client"""
+        return self._executor.submit(
+            self.prom_client.query_series, selector, start_date, end_date
+        )
+
+    def query_metric(self, metric, start_date, end_date):
+        """Queries metric following the plan made for it"""
+        start, end = date_range(start_date, end_date)
+        plan = self.plan(metric, start, end)
+        return self.prom_client.query_range(
+            metric,
+            start,
+            end,
+            shard=plan.shard,
+            namespace_groups=plan.namespace_groups,
+            max_workers=plan.concurrency,
+        )
+
+    def probe(self, metric, start: datetime, end: datetime) -> Dict[str, int]:
+        """
+        Estimates the number of series per namespace. Pods come and go, so the
+        series are counted at the start, middle and end of the range and the
+        largest count for each namespace is kept.
+        """
+        series_per_namespace = {}
+        middle = start + (end - start) / 2
+        for timestamp in (start, middle, end):
+            result = self.prom_client.query_instant(
+                f"count by (namespace) ({metric})", timestamp
+            )
+            for count in result:
+                namespace = count["metric"].get("namespace", "")
+                series_per_namespace[namespace] = max(
+                    series_per_namespace.get(namespace, 0), int(count["value"][1])
+                )
+        return series_per_namespace
+
+    def plan(self, metric, start: datetime, end: datetime) -> QueryPlan:
+        """Chooses the time slices, namespace groups and concurrency for metric"""
+        step = timedelta(minutes=self.prom_client.step_min)
+        points = (end - start) // step + 1
+        series_per_namespace = self.probe(metric, start, end)
+        series = sum(series_per_namespace.values())
+        plan = QueryPlan(series=series, samples=series * points)
+
+        # try the whole range first, then smaller and smaller slices
+        shards = sorted(SHARD_DURATIONS, key=SHARD_DURATIONS.get, reverse=True)
+        for shard in [None, *shards]:
+            plan.shard = shard
+            if shard is not None:
+                points = min(points, math.ceil(SHARD_DURATIONS[shard] / step))
+            if points <= MAX_POINTS_PER_SERIES and series * points <= self.max_samples:
+                break
+        else:
+            # the probes only see the namespaces that had series at one of
+            # three instants, a namespace whose pods all ran in between would
+            # be left out of every group and never fetched
+            for namespace in self.prom_client._label_values(
+                "namespace", promql.first_selector(metric), start, end
+            ):
+                series_per_namespace.setdefault(namespace, 1)
+            plan.namespace_groups = self.group_namespaces(
+                series_per_namespace, max(1, self.max_samples // points)
+            )
+
+        if plan.shard is None:
+            slices = 1
+        else:
+            slices = len(split_range(start, end, SHARD_DURATIONS[plan.shard], step))
+        pieces = slices * max(1, len(plan.namespace_groups))
+        plan.concurrency = max(1, min(self.max_concurrency, pieces))
+
+        logger.info(
+            f"Query plan for {metric}: ~{plan.series} series, ~{plan.samples} samples, "
+            f"{slices} {plan.shard or 'full range'} slice(s), "
+            f"{len(plan.namespace_groups)} namespace group(s), "
+            f"concurrency {plan.concurrency}"
+        )
+        return plan
+
+    @staticmethod
+    def group_namespaces(
+        series_per_namespace: Dict[str, int], max_series: int
+    ) -> List[List[str]]:
+        """
+        Packs namespaces into as few groups as possible with at most max_series
+        series each, largest namespaces first. A namespace that is too large on
+        its own gets a group to itself.
+
+        Series without a namespace label would be dropped by a namespace
+        matcher, so such queries are never partitioned.
+        """
+        if len(series_per_namespace) <= 1 or "" in series_per_namespace:
+            return []
+
+        groups = []
+        group_sizes = []
+        for namespace in sorted(
+            series_per_namespace, key=lambda ns: (-series_per_namespace[ns], ns)
+        ):
+            size = series_per_namespace[namespace]
+            for i, group_size in enumerate(group_sizes):
+                if group_size + size <= max_series:
+                    groups[i].append(namespace)
+                    group_sizes[i] += size
+                    break
+            else:
+                groups.append([namespace])
+                group_sizes.append(size)
+        return groups
@@ -0,0 +1,102 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from openshift_metrics import backfill, utils
+from openshift_metrics.utils import EmptyResultError
+
+
+class TestBackfill(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_day_range(self):
+        self.assertEqual(
+            backfill.day_range("2022-02-27", "2022-03-02"),
+            ["2022-02-27", "2022-02-28", "2022-03-01", "2022-03-02"],
+        )
+        self.assertEqual(backfill.day_range("2022-03-02", "2022-03-01"), [])
+
+    def run_backfill(self, collect_metrics):
+        argv = [
+            "backfill",
+            "--openshift-url",
+            "https://thanos-querier-openshift-monitoring.apps.shift.nerc.mghpcc.org",
+            "--report-start-date",
+            "2022-02-27",
+            "--report-end-date",
+            "2022-03-02",
+            "--output-dir",
+            self.directory.name,
+            "--upload-to-s3",
+        ]
+        with (
+            mock.patch("sys.argv", argv),
+            mock.patch.object(backfill, "collect_metrics", collect_metrics),
+            mock.patch.object(utils, "upload_to_s3") as upload_to_s3,
+            mock.patch.object(backfill, "CoverageIndex") as self.coverage_index,
+        ):
+            backfill.main()
+        return upload_to_s3
+
+    def test_one_file_per_day(self):
+        collect_metrics = mock.Mock(return_value={"cpu_metrics": []})
+        upload_to_s3 = self.run_backfill(collect_metrics)
+
+        self.assertEqual(
+            sorted(os.listdir(self.directory.name)),
+            [
+                "metrics-2022-02-27.json",
+                "metrics-2022-02-28.json",
+                "metrics-2022-03-01.json",
+                "metrics-2022-03-02.json",
+            ],
+        )
+        with open(os.path.join(self.directory.name, "metrics-2022-03-01.json")) as file:
+            self.assertEqual(
+                json.load(file),
+                {
+                    "start_date": "2022-03-01",
+                    "end_date": "2022-03-01",
+                    "interval_minutes": 15,
+                    "cluster_name": "ocp-prod",
+                    "cpu_metrics": [],
+                },
+            )
+        upload_to_s3.assert_any_call(
+            os.path.join(self.directory.name, "metrics-2022-02-28.json"),
+            backfill.S3_METRICS_BUCKET,
+            "data_2022-02/metrics-2022-02-28.json",
+        )
+        self.assertEqual(upload_to_s3.call_count, 4)
+        index = self.coverage_index.return_value.load.return_value
+        index.add.assert_any_call(
+            "2022-02-28", "2022-02-28", 15, "data_2022-02/metrics-2022-02-28.json"
+        )
+        self.assertEqual(index.add.call_count, 4)
+        index.save.assert_called_once()
+        # every day goes through the same client
+        self.assertEqual(
+            len({call.args[0] for call in collect_metrics.call_args_list}), 1
+        )
+
+    def test_rerun_collects_failed_days(self):
+        def fail_one_day(prom_client, start_date, end_date, **kwargs):
+            if start_date == "2022-02-28":
+                raise EmptyResultError("no data")
+            return {"cpu_metrics": []}
+
+        with self.assertRaises(SystemExit) as raised:
+            self.run_backfill(fail_one_day)
+        self.assertIn("2022-02-28", str(raised.exception))
+        self.assertEqual(len(os.listdir(self.directory.name)), 3)
+
+        collect_metrics = mock.Mock(return_value={"cpu_metrics": []})
+        self.run_backfill(collect_metrics)
+        self.assertEqual(collect_metrics.call_count, 1)
+        self.assertEqual(collect_metrics.call_args.args[1], "2022-02-28")
+        self.assertEqual(len(os.listdir(self.directory.name)), 4)
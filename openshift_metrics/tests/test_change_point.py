@@ -0,0 +1,139 @@
+import math
+import re
+from datetime import datetime, timedelta, UTC
+
+from unittest import TestCase, mock
+
+from openshift_metrics.change_point import ChangePointCollector
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.tests.test_prometheus_client import request_params
+
+METRIC = 'fake_metric{resource="cpu"}'
+SUBQUERY_RE = re.compile(r"(\w+)_over_time\(\((.*)\)\[(\d+)s:(\d+)s\]\)")
+DAY = datetime(2022, 3, 14, tzinfo=UTC).timestamp()
+
+# the value of each series at a timestamp, None where it has no sample
+SERIES = {
+    ("ns1", "pod1"): lambda t: "1",
+    ("ns1", "pod2"): lambda t: "2" if t < DAY + 10 * 3600 + 420 else "3.5",
+    ("ns1", "pod3"): lambda t: "1" if DAY + 5 * 3600 <= t < DAY + 14 * 3600 else None,
+    ("ns2", "pod2"): lambda t: "4",
+    ("ns2", "pod4"): lambda t: "0.25" if t < DAY + 90000 else None,
+}
+
+
+class FakeChangingPrometheus:
+    """Evaluates METRIC and the over_time subqueries of it on SERIES"""
+
+    def __init__(self):
+        self.samples = 0
+
+    def __call__(self, url, **kwargs):
+        params = request_params(url, **kwargs)
+        query = params["query"][0]
+        start = datetime.fromisoformat(params["start"][0]).timestamp()
+        end = datetime.fromisoformat(params["end"][0]).timestamp()
+        step = int(params["step"][0].removesuffix("m")) * 60
+        timestamps = range(int(start), int(end) + 1, step)
+
+        match = SUBQUERY_RE.fullmatch(query)
+        if match is None:
+            result = self.evaluate(query, timestamps)
+            self.samples += sum(len(series["values"]) for series in result)
+        else:
+            function, inner, window, inner_step = match.groups()
+            window, inner_step = int(window), int(inner_step)
+            result = []
+            first = math.ceil((start - window) / inner_step) * inner_step
+            inner_timestamps = range(first, int(end) + 1, inner_step)
+            for series in self.evaluate(inner, inner_timestamps):
+                values = dict(series["values"])
+                series_values = []
+                for t in timestamps:
+                    first = math.ceil((t - window) / inner_step) * inner_step
+                    window_values = [
+                        float(values[i])
+                        for i in range(first, t + 1, inner_step)
+                        if i in values
+                    ]
+                    if not window_values:
+                        continue
+                    value = {
+                        "min": min(window_values),
+                        "max": max(window_values),
+                        "count": len(window_values),
+                    }[function]
+                    series_values.append([t, f"{value:g}"])
+                if series_values:
+                    labels = dict(series["metric"])
+                    del labels["__name__"]
+                    result.append({"metric": labels, "values": series_values})
+
+        return mock.Mock(status_code=200, json=lambda: {"data": {"result": result}})
+
+    @staticmethod
+    def evaluate(query, timestamps):
+        pods = re.search(r'pod=~"([^"]*)"', query)
+        result = []
+        for (namespace, pod), value in sorted(SERIES.items()):
+            if pods and not re.fullmatch(pods.group(1).replace("\\\\", "\\"), pod):
+                continue
+            values = [[t, value(t)] for t in timestamps if value(t) is not None]
+            if values:
+                labels = {
+                    "__name__": "fake_metric",
+                    "namespace": namespace,
+                    "pod": pod,
+                    "resource": "cpu",
+                }
+                result.append({"metric": labels, "values": values})
+        return result
+
+
+class TestChangePointCollector(TestCase):
+    def query(self, client, start_date, end_date):
+        with mock.patch("requests.Session.get", new=FakeChangingPrometheus()) as fake:
+            metrics = client.query_metric(METRIC, start_date, end_date)
+        return metrics, fake.samples
+
+    def test_same_result(self):
+        expected, samples = self.query(
+            PrometheusClient("https://fake-url", "fake-token"),
+            "2022-03-14",
+            "2022-03-15",
+        )
+        for window_steps in (16, 7):
+            with self.subTest(window_steps=window_steps):
+                collector = ChangePointCollector(
+                    PrometheusClient("https://fake-url", "fake-token"), window_steps
+                )
+                metrics, fine_samples = self.query(
+                    collector, "2022-03-14", "2022-03-15"
+                )
+                collector.close()
+                self.assertEqual(metrics, expected)
+                self.assertLess(fine_samples, samples / 4)
+
+    def test_few_pods_per_query(self):
+        expected, _ = self.query(
+            PrometheusClient("https://fake-url", "fake-token"),
+            "2022-03-14",
+            "2022-03-14",
+        )
+        collector = ChangePointCollector(
+            PrometheusClient("https://fake-url", "fake-token"), 16, max_pods_per_query=1
+        )
+        metrics, _ = self.query(collector, "2022-03-14", "2022-03-14")
+        collector.close()
+        self.assertEqual(metrics, expected)
+
+    def test_short_range_is_fetched_directly(self):
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        collector = ChangePointCollector(prom_client, 16)
+        start = datetime(2022, 3, 14, tzinfo=UTC)
+        with mock.patch.object(prom_client, "query_range") as query_range:
+            collector.query_range(METRIC, start, start + timedelta(hours=4))
+            collector.query_range(
+                METRIC, start + timedelta(minutes=5), start + timedelta(days=1)
+            )
+        self.assertEqual(query_range.call_count, 2)
@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+from datetime import datetime, UTC
+from unittest import TestCase, mock
+
+from openshift_metrics.checkpoint import Checkpoint
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.tests.test_prometheus_client import fake_query_range
+from openshift_metrics.utils import EmptyResultError
+
+RESULT = [{"metric": {"pod": "pod1"}, "values": [[1647216000, "1"]]}]
+START = datetime(2022, 3, 14, tzinfo=UTC)
+END = datetime(2022, 3, 14, 23, 59, 59, tzinfo=UTC)
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.work_dir = os.path.join(self.directory.name, "work")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_pieces_survive_a_restart(self):
+        checkpoint = Checkpoint(self.work_dir)
+        key = checkpoint.key("https://fake-url", "fake-metric", START, END, 15)
+        self.assertIsNone(checkpoint.get(key))
+        checkpoint.put(key, "fake-metric", START, END, RESULT)
+
+        checkpoint = Checkpoint(self.work_dir)
+        self.assertEqual(checkpoint.get(key), RESULT)
+        with open(os.path.join(self.work_dir, "manifest.json")) as file:
+            manifest = json.load(file)
+        self.assertEqual(
+            manifest["pieces"][key],
+            {
+                "query": "fake-metric",
+                "start": "2022-03-14T00:00:00+00:00",
+                "end": "2022-03-14T23:59:59+00:00",
+                "file": f"{key}.json",
+                "series": 1,
+            },
+        )
+
+    def test_unreadable_piece(self):
+        checkpoint = Checkpoint(self.work_dir)
+        checkpoint.put("a", "fake-metric", START, END, RESULT)
+        with open(os.path.join(self.work_dir, "a.json"), "w") as file:
+            file.write("[{")
+        self.assertIsNone(checkpoint.get("a"))
+
+    def test_remove(self):
+        checkpoint = Checkpoint(self.work_dir)
+        checkpoint.put("a", "fake-metric", START, END, RESULT)
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.work_dir))
+
+    def test_remove_keeps_other_files(self):
+        os.makedirs(self.work_dir)
+        with open(os.path.join(self.work_dir, "notes.txt"), "w") as file:
+            file.write("not a piece")
+        checkpoint = Checkpoint(self.work_dir)
+        checkpoint.put("a", "fake-metric", START, END, RESULT)
+        # pieces of an earlier run are known from the manifest
+        checkpoint = Checkpoint(self.work_dir)
+        checkpoint.put("b", "fake-metric", START, END, RESULT)
+        checkpoint.remove()
+        self.assertEqual(os.listdir(self.work_dir), ["notes.txt"])
+
+
+class TestResume(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def client(self):
+        return PrometheusClient(
+            "https://fake-url",
+            "fake-token",
+            shard="day",
+            checkpoint=Checkpoint(self.directory.name),
+        )
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_rerun_fetches_missing_pieces(self, mock_sleep, mock_get):
+        mock_get.side_effect = fake_query_range
+        expected = PrometheusClient("https://fake-url", "fake-token").query_metric(
+            "fake-metric", "2022-03-14", "2022-03-16"
+        )
+
+        def fail_second_day(url, **kwargs):
+            if kwargs["params"]["start"].startswith("2022-03-15"):
+                return mock.Mock(status_code=500, reason="Internal Server Error")
+            return fake_query_range(url, **kwargs)
+
+        mock_get.side_effect = fail_second_day
+        self.assertRaises(
+            EmptyResultError,
+            self.client().query_metric,
+            "fake-metric",
+            "2022-03-14",
+            "2022-03-16",
+        )
+
+        mock_get.reset_mock()
+        mock_get.side_effect = fake_query_range
+        metrics = self.client().query_metric("fake-metric", "2022-03-14", "2022-03-16")
+        self.assertEqual(metrics, expected)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertIn("2022-03-15", mock_get.call_args.kwargs["params"]["start"])
+
+        # once every piece is done nothing is fetched at all
+        self.client().query_metric("fake-metric", "2022-03-14", "2022-03-16")
+        self.assertEqual(mock_get.call_count, 1)
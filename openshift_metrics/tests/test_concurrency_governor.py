@@ -0,0 +1,150 @@
+import threading
+import time
+from datetime import datetime, UTC
+from unittest import TestCase, mock
+
+from openshift_metrics.concurrency_governor import (
+    ConcurrencyGovernor,
+    parse_retry_after,
+)
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.tests.test_prometheus_client import (
+    FakePrometheus,
+    fake_query_range,
+)
+from openshift_metrics.utils import RequestBudgetError
+
+
+class TestParseRetryAfter(TestCase):
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("3"), 3.0)
+        self.assertEqual(parse_retry_after("-1"), 0.0)
+
+    def test_date(self):
+        now = datetime(2022, 3, 14, 12, 0, tzinfo=UTC)
+        self.assertEqual(
+            parse_retry_after("Mon, 14 Mar 2022 12:00:30 GMT", now=now), 30.0
+        )
+
+    def test_unusable(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after(""))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+class TestConcurrencyGovernor(TestCase):
+    def test_initial_limit(self):
+        self.assertEqual(ConcurrencyGovernor(4).limit, 4)
+        self.assertEqual(ConcurrencyGovernor(4, initial_limit=2).limit, 2)
+        self.assertEqual(ConcurrencyGovernor(4, initial_limit=9).limit, 4)
+        self.assertEqual(ConcurrencyGovernor(4, min_limit=3, initial_limit=1).limit, 3)
+
+    def test_additive_increase(self):
+        governor = ConcurrencyGovernor(4, initial_limit=1)
+        self.assertEqual(governor.limit, 1)
+        for _ in range(20):
+            governor.release(governor.acquire())
+        self.assertEqual(governor.limit, 4)
+
+    def test_throttling_halves_the_limit_once_per_burst(self):
+        governor = ConcurrencyGovernor(8)
+        started = [governor.acquire() for _ in range(3)]
+        for request in started:
+            governor.release(request, throttled=True)
+        self.assertEqual(governor.limit, 4)
+        self.assertEqual(governor.throttled, 3)
+        governor.release(governor.acquire(), throttled=True)
+        self.assertEqual(governor.limit, 2)
+        governor.release(governor.acquire(), throttled=True)
+        governor.release(governor.acquire(), throttled=True)
+        self.assertEqual(governor.limit, 1)
+
+    @mock.patch("time.monotonic")
+    def test_latency_increase(self, mock_monotonic):
+        governor = ConcurrencyGovernor(8, min_slow_latency=0)
+        for latency in [1, 1, 5]:
+            mock_monotonic.return_value = 100
+            started = governor.acquire()
+            mock_monotonic.return_value = 100 + latency
+            governor.release(started, "query_range")
+        self.assertEqual(governor.limit, 4)
+        # other kinds of requests have latencies of their own
+        mock_monotonic.return_value = 200
+        started = governor.acquire()
+        mock_monotonic.return_value = 210
+        governor.release(started, "series")
+        self.assertGreater(governor.limit, 4)
+
+    def test_limit_blocks(self):
+        governor = ConcurrencyGovernor(1)
+        started = governor.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(
+            target=lambda: (governor.acquire(), acquired.set()), daemon=True
+        )
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        governor.release(started)
+        self.assertTrue(acquired.wait(1))
+
+    def test_retry_after_pauses_all_requests(self):
+        governor = ConcurrencyGovernor(4, min_limit=4)
+        governor.release(governor.acquire(), throttled=True, retry_after=0.2)
+        before = time.monotonic()
+        governor.acquire()
+        self.assertGreaterEqual(time.monotonic() - before, 0.15)
+
+    def test_budget(self):
+        governor = ConcurrencyGovernor(4, budget=2)
+        governor.release(governor.acquire())
+        governor.release(governor.acquire())
+        self.assertRaises(RequestBudgetError, governor.acquire)
+
+
+class TestThrottledPrometheus(TestCase):
+    @mock.patch("requests.Session.get")
+    def expected(self, mock_get):
+        mock_get.side_effect = fake_query_range
+        return PrometheusClient("https://fake-url", "fake-token").query_metric(
+            "fake-metric", "2022-03-14", "2022-03-16"
+        )
+
+    def test_sharded_query_with_throttling(self):
+        lock = threading.Lock()
+        requests = []
+
+        def throttling(path):
+            with lock:
+                requests.append(path)
+                throttle = len(requests) % 10 == 0
+            if throttle:
+                return 429, {"error": "slow down"}, {"Retry-After": "0"}
+            return FakePrometheus.query_range(path)
+
+        with FakePrometheus(respond=throttling, delay=0.01) as server:
+            with PrometheusClient(
+                server.url, "fake-token", max_workers=6, shard="hour"
+            ) as prom_client:
+                metrics = prom_client.query_metric(
+                    "fake-metric", "2022-03-14", "2022-03-16"
+                )
+        self.assertEqual(metrics, self.expected())
+        self.assertEqual(prom_client.governor.throttled, 7)
+        self.assertEqual(len(server.requests), 79)
+        self.assertLessEqual(server.max_in_flight, 6)
+        self.assertGreater(server.max_in_flight, 1)
+
+    def test_budget(self):
+        with FakePrometheus() as server:
+            governor = ConcurrencyGovernor(4, budget=10)
+            with PrometheusClient(
+                server.url, "fake-token", shard="hour", governor=governor
+            ) as prom_client:
+                self.assertRaises(
+                    RequestBudgetError,
+                    prom_client.query_metric,
+                    "fake-metric",
+                    "2022-03-14",
+                    "2022-03-16",
+                )
+        self.assertEqual(len(server.requests), 10)
@@ -0,0 +1,95 @@
+import json
+from unittest import TestCase, mock
+
+from openshift_metrics import coverage_index, utils
+from openshift_metrics.coverage_index import CoverageIndex
+
+
+class TestCoverageIndex(TestCase):
+    def test_metrics_key(self):
+        self.assertEqual(
+            coverage_index.metrics_key("2022-03-14", "2022-03-14"),
+            "data_2022-03/metrics-2022-03-14.json",
+        )
+        self.assertEqual(
+            coverage_index.metrics_key("2022-03-01", "2022-03-31"),
+            "data_2022-03/metrics-2022-03-01-to-2022-03-31.json",
+        )
+
+    def test_missing_ranges(self):
+        index = CoverageIndex("openshift-metrics")
+        index.add("2022-03-03", "2022-03-04", 15, "a")
+        index.add("2022-03-06", "2022-03-06", None, "b")
+        index.add("2022-03-08", "2022-03-08", 60, "c")
+        self.assertEqual(
+            index.missing_ranges("2022-03-01", "2022-03-09", 15),
+            [
+                ("2022-03-01", "2022-03-02"),
+                ("2022-03-05", "2022-03-05"),
+                ("2022-03-07", "2022-03-09"),
+            ],
+        )
+        self.assertEqual(index.missing_ranges("2022-03-03", "2022-03-04", 15), [])
+
+    def test_add_replaces_key(self):
+        index = CoverageIndex("openshift-metrics")
+        index.add(
+            "2022-03-01", "2022-03-01", 60, "data_2022-03/metrics-2022-03-01.json"
+        )
+        index.add(
+            "2022-03-01", "2022-03-01", 15, "data_2022-03/metrics-2022-03-01.json"
+        )
+        self.assertEqual(len(index.ranges), 1)
+        self.assertEqual(index.ranges[0]["interval_minutes"], 15)
+
+    def test_load_from_keys(self):
+        keys = [
+            "data_2022-03/metrics-2022-03-01.json",
+            "data_2022-03/metrics-2022-03-02-to-2022-03-05.json",
+            "data_2022-03/NERC-2022-03-Pod-NERC.csv",
+        ]
+        with (
+            mock.patch.object(utils, "download_from_s3", return_value=False),
+            mock.patch.object(utils, "list_s3_keys", return_value=keys),
+        ):
+            index = CoverageIndex("openshift-metrics").load()
+        self.assertEqual(
+            [(r["start_date"], r["end_date"]) for r in index.ranges],
+            [("2022-03-01", "2022-03-01"), ("2022-03-02", "2022-03-05")],
+        )
+        self.assertEqual(
+            index.missing_ranges("2022-03-01", "2022-03-06", 15),
+            [("2022-03-06", "2022-03-06")],
+        )
+
+    def test_save_and_load(self):
+        uploaded = {}
+
+        def upload_to_s3(file_name, bucket, key):
+            with open(file_name) as file:
+                uploaded[key] = json.load(file)
+
+        def download_from_s3(bucket, key, file_name):
+            with open(file_name, "w") as file:
+                json.dump(uploaded[key], file)
+            return True
+
+        with (
+            mock.patch.object(utils, "upload_to_s3", upload_to_s3),
+            mock.patch.object(utils, "download_from_s3", download_from_s3),
+        ):
+            CoverageIndex("openshift-metrics").add(
+                "2022-03-01", "2022-03-31", 15, "data_2022-03/metrics.json"
+            ).save()
+            index = CoverageIndex("openshift-metrics").load()
+        self.assertEqual(
+            index.ranges,
+            [
+                {
+                    "start_date": "2022-03-01",
+                    "end_date": "2022-03-31",
+                    "interval_minutes": 15,
+                    "key": "data_2022-03/metrics.json",
+                }
+            ],
+        )
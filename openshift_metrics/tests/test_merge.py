@@ -0,0 +1,81 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from openshift_metrics import merge, metrics_file
+
+
+class TestLoadMetricsFiles(TestCase):
+    def test_files_are_loaded_in_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for day in range(1, 11):
+                file_name = os.path.join(directory, f"metrics-2022-03-{day:02}.json")
+                with open(file_name, "w") as file:
+                    json.dump({"start_date": f"2022-03-{day:02}"}, file)
+                files.append(file_name)
+
+            metrics = list(merge.load_metrics_files(files))
+            self.assertEqual(
+                [m["start_date"] for m in metrics],
+                [f"2022-03-{day:02}" for day in range(1, 11)],
+            )
+
+
+class TestLoadNdjson(TestCase):
+    def test_series_are_read_lazily(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for day in (1, 2):
+                file_name = os.path.join(directory, f"metrics-2022-03-0{day}.ndjson")
+                metrics_file.write_ndjson(
+                    file_name,
+                    {
+                        "start_date": f"2022-03-0{day}",
+                        "cpu_metrics": [{"metric": {"pod": f"pod{day}"}, "values": []}],
+                    },
+                )
+                files.append(file_name)
+
+            loaded = []
+            for metrics in merge.load_metrics_files(files):
+                loaded.append(
+                    (
+                        metrics["start_date"],
+                        [
+                            (key, series["metric"]["pod"])
+                            for key, series in metrics["series"]
+                        ],
+                    )
+                )
+        self.assertEqual(
+            loaded,
+            [
+                ("2022-03-01", [("cpu_metrics", "pod1")]),
+                ("2022-03-02", [("cpu_metrics", "pod2")]),
+            ],
+        )
+
+
+class TestNamespaceFilter(TestCase):
+    metrics = [
+        {"metric": {"namespace": "ns1", "pod": "pod1"}},
+        {"metric": {"namespace": "ns-22", "pod": "pod2"}},
+        {"metric": {"namespace": "ns-22-test", "pod": "pod3"}},
+        {"metric": {"pod": "pod4"}},
+    ]
+
+    def pods(self, in_namespaces):
+        return [m["metric"]["pod"] for m in filter(in_namespaces, self.metrics)]
+
+    def test_namespaces(self):
+        in_namespaces = merge.namespace_filter(namespaces=["ns1", "ns-22"])
+        self.assertEqual(self.pods(in_namespaces), ["pod1", "pod2"])
+
+    def test_namespace_regex(self):
+        in_namespaces = merge.namespace_filter(namespace_regex=r"ns-\d+")
+        self.assertEqual(self.pods(in_namespaces), ["pod2"])
+
+    def test_no_filter(self):
+        self.assertIsNone(merge.namespace_filter())
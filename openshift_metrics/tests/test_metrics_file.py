@@ -0,0 +1,309 @@
+import gzip
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from openshift_metrics import metrics_file
+from openshift_metrics.metrics_file import MetricsFileWriter, NdjsonMetricsFileWriter
+
+METADATA = {
+    "start_date": "2022-03-14",
+    "end_date": "2022-03-14",
+    "interval_minutes": 15,
+    "cluster_name": "test-cluster",
+}
+
+
+def series(pod):
+    return {
+        "metric": {"pod": pod, "namespace": "nsé"},
+        "values": [[1647216000, "1"], [1647216900, "2"]],
+    }
+
+
+class TestMetricsFileWriter(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, "metrics.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        with open(self.file_name) as file:
+            return file.read()
+
+    def test_same_as_json_dump(self):
+        metrics_dict = dict(METADATA)
+        metrics_dict["cpu_metrics"] = [series("pod1"), series("pod2")]
+        metrics_dict["memory_metrics"] = []
+        metrics_dict["gpu_metrics"] = [series("pod3")]
+
+        with MetricsFileWriter(self.file_name, METADATA) as writer:
+            writer.start_list("cpu_metrics")
+            writer.start_list("memory_metrics")
+            writer.add_series("cpu_metrics", series("pod1"))
+            writer.add_series("gpu_metrics", series("pod3"))
+            writer.add_series("cpu_metrics", series("pod2"))
+
+        self.assertEqual(self.read(), json.dumps(metrics_dict))
+
+    def test_discarded_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with MetricsFileWriter(self.file_name, METADATA) as writer:
+                writer.add_series("cpu_metrics", series("pod1"))
+                raise RuntimeError
+        self.assertFalse(os.path.exists(self.file_name))
+
+    def test_runs(self):
+        with MetricsFileWriter(self.file_name, METADATA, step=900) as writer:
+            writer.add_series("cpu_metrics", series("pod1"))
+        with open(self.file_name) as file:
+            metrics = json.load(file)
+        self.assertEqual(
+            metrics["cpu_metrics"],
+            [
+                {
+                    "metric": {"pod": "pod1", "namespace": "nsé"},
+                    "runs": [[1647216000, 1, "1"], [1647216900, 1, "2"]],
+                }
+            ],
+        )
+
+
+class TestRuns(TestCase):
+    def test_encode_runs(self):
+        values = [
+            [0, "1"],
+            [900, "1"],
+            [1800, "1"],
+            [2700, "2"],
+            # a gap ends a run even if the value is the same
+            [4500, "2"],
+            [5400, "2"],
+            [6000, "2"],
+        ]
+        runs = metrics_file.encode_runs(values, 900)
+        self.assertEqual(
+            runs, [[0, 3, "1"], [2700, 1, "2"], [4500, 2, "2"], [6000, 1, "2"]]
+        )
+        self.assertEqual(metrics_file.decode_runs(runs, 900), values)
+        self.assertEqual(metrics_file.encode_runs([], 900), [])
+
+    def test_encode_metrics(self):
+        metrics_dict = dict(METADATA)
+        metrics_dict["cpu_metrics"] = [series("pod1")]
+        metrics_dict["memory_metrics"] = []
+        metrics_file.encode_metrics(metrics_dict, 900)
+        self.assertEqual(metrics_dict["series_format"], metrics_file.RUNS)
+        self.assertEqual(
+            metrics_dict["cpu_metrics"][0]["runs"],
+            [[1647216000, 1, "1"], [1647216900, 1, "2"]],
+        )
+        self.assertNotIn("gpu_metrics", metrics_dict)
+
+
+class TestNdjson(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, "metrics.ndjson")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read(self):
+        metrics_dict = metrics_file.read_ndjson(self.file_name)
+        series_list = list(metrics_dict.pop("series"))
+        return metrics_dict, series_list
+
+    def test_one_line_per_series(self):
+        with NdjsonMetricsFileWriter(self.file_name, METADATA) as writer:
+            writer.start_list("cpu_metrics")
+            writer.add_series("cpu_metrics", series("pod1"))
+            writer.add_series("gpu_metrics", series("pod3"))
+            writer.add_series("cpu_metrics", series("pod2"))
+            self.assertEqual(writer.lists, ["cpu_metrics", "gpu_metrics"])
+
+        with open(self.file_name) as file:
+            self.assertEqual(len(file.readlines()), 4)
+        metadata, series_list = self.read()
+        self.assertEqual(metadata, METADATA)
+        self.assertEqual(
+            series_list,
+            [
+                ("cpu_metrics", series("pod1")),
+                ("gpu_metrics", series("pod3")),
+                ("cpu_metrics", series("pod2")),
+            ],
+        )
+
+    def test_write_ndjson(self):
+        metrics_dict = dict(METADATA)
+        metrics_dict["cpu_metrics"] = [series("pod1")]
+        metrics_dict["memory_metrics"] = [series("pod1")]
+        metrics_file.write_ndjson(self.file_name, metrics_dict)
+        self.assertEqual(
+            self.read(),
+            (
+                METADATA,
+                [("cpu_metrics", series("pod1")), ("memory_metrics", series("pod1"))],
+            ),
+        )
+
+    def test_runs(self):
+        with NdjsonMetricsFileWriter(self.file_name, METADATA, step=900) as writer:
+            writer.add_series("cpu_metrics", series("pod1"))
+        _, series_list = self.read()
+        self.assertEqual(
+            series_list[0][1]["runs"], [[1647216000, 1, "1"], [1647216900, 1, "2"]]
+        )
+
+    def test_partial_file(self):
+        with self.assertRaises(RuntimeError):
+            with NdjsonMetricsFileWriter(self.file_name, METADATA) as writer:
+                writer.add_series("cpu_metrics", series("pod1"))
+                writer.add_series("cpu_metrics", series("pod2"))
+                raise RuntimeError
+        # as if the collector died halfway through writing a line
+        with open(self.file_name) as file:
+            content = file.read()
+        with open(self.file_name, "w") as file:
+            file.write(content[:-20])
+
+        _, series_list = self.read()
+        self.assertEqual(series_list, [("cpu_metrics", series("pod1"))])
+
+
+class TestColumnar(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, "metrics.columnar")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def samples(self, series):
+        return [
+            [epoch_time, series["value_table"][value_id]]
+            for epoch_time, value_id in zip(series["timestamps"], series["value_ids"])
+        ]
+
+    def test_round_trip(self):
+        metrics_dict = dict(METADATA)
+        metrics_dict["cpu_metrics"] = [series("pod1"), series("pod2")]
+        metrics_dict["memory_metrics"] = [series("pod1")]
+        metrics_dict["memory_metrics"][0]["values"][1][1] = "4294967296"
+        metrics_file.write_columnar(self.file_name, metrics_dict)
+
+        read = metrics_file.read_columnar(self.file_name)
+        self.assertEqual({k: v for k, v in read.items() if k in METADATA}, METADATA)
+        self.assertEqual(
+            [
+                (key, s["metric"], self.samples(s))
+                for key in metrics_file.SERIES_KEYS
+                for s in read.get(key, [])
+            ],
+            [
+                (key, s["metric"], s["values"])
+                for key in metrics_file.SERIES_KEYS
+                for s in metrics_dict.get(key, [])
+            ],
+        )
+        self.assertNotIn("gpu_metrics", read)
+        # labels and values are stored once however many series share them
+        self.assertEqual(len(read["cpu_metrics"][0]["value_table"]), 3)
+
+    def test_runs(self):
+        metrics_dict = dict(METADATA)
+        metrics_dict["cpu_metrics"] = [series("pod1")]
+        metrics_file.encode_metrics(metrics_dict, 900)
+        metrics_file.write_columnar(self.file_name, metrics_dict)
+
+        read = metrics_file.read_columnar(self.file_name)
+        self.assertNotIn("series_format", read)
+        self.assertEqual(self.samples(read["cpu_metrics"][0]), series("pod1")["values"])
+
+    def test_not_columnar(self):
+        with open(self.file_name, "w") as file:
+            json.dump(METADATA, file)
+        with self.assertRaises(ValueError):
+            metrics_file.read_columnar(self.file_name)
+
+
+class TestReadMetricsFile(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.metrics_dict = dict(METADATA)
+        self.metrics_dict["cpu_metrics"] = [series("pod1")]
+        self.metrics_dict["memory_metrics"] = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def file_name(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_json(self):
+        file_name = self.file_name("metrics.json")
+        with open(file_name, "w") as file:
+            json.dump(self.metrics_dict, file)
+        self.assertEqual(metrics_file.read_metrics_file(file_name), self.metrics_dict)
+
+    def test_indented_json(self):
+        file_name = self.file_name("metrics.json")
+        with open(file_name, "w") as file:
+            json.dump(self.metrics_dict, file, indent=2)
+        self.assertEqual(metrics_file.read_metrics_file(file_name), self.metrics_dict)
+
+    def test_ndjson(self):
+        # the format is told by the content, not the name
+        file_name = self.file_name("metrics.json")
+        metrics_file.write_ndjson(file_name, self.metrics_dict)
+        read = metrics_file.read_metrics_file(file_name)
+        self.assertEqual(list(read.pop("series")), [("cpu_metrics", series("pod1"))])
+        self.assertEqual(read, METADATA)
+
+    def test_columnar(self):
+        file_name = self.file_name("metrics.json")
+        metrics_file.write_columnar(file_name, self.metrics_dict)
+        read = metrics_file.read_metrics_file(file_name)
+        self.assertEqual(read["cpu_metrics"][0]["metric"], series("pod1")["metric"])
+        self.assertEqual(read["memory_metrics"], [])
+
+    def test_gzipped_json(self):
+        file_name = self.file_name("metrics.json.gz")
+        with gzip.open(file_name, "wt") as file:
+            metrics_file.write_json(file, self.metrics_dict)
+        self.assertEqual(metrics_file.read_metrics_file(file_name), self.metrics_dict)
+
+    def test_gzipped_ndjson(self):
+        file_name = self.file_name("metrics.ndjson.gz")
+        with gzip.open(file_name, "wt") as file:
+            with NdjsonMetricsFileWriter(file, METADATA) as writer:
+                writer.add_series("cpu_metrics", series("pod1"))
+                writer.add_series("cpu_metrics", series("pod2"))
+            # the writer leaves a file it was given open
+            self.assertFalse(file.closed)
+        read = metrics_file.read_metrics_file(file_name)
+        self.assertEqual(
+            list(read.pop("series")),
+            [("cpu_metrics", series("pod1")), ("cpu_metrics", series("pod2"))],
+        )
+        self.assertEqual(read, METADATA)
+
+        # cut short in the middle of the compressed stream
+        with open(file_name, "rb") as file:
+            content = file.read()
+        with open(file_name, "wb") as file:
+            file.write(content[:-20])
+        read = metrics_file.read_metrics_file(file_name)
+        self.assertLessEqual(len(list(read["series"])), 1)
+
+    def test_gzipped_stream(self):
+        file_name = self.file_name("metrics.json.gz")
+        with gzip.open(file_name, "wt") as file:
+            with MetricsFileWriter(file, METADATA) as writer:
+                writer.add_series("cpu_metrics", series("pod1"))
+                writer.start_list("memory_metrics")
+        self.assertEqual(metrics_file.read_metrics_file(file_name), self.metrics_dict)
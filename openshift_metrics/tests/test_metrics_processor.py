@@ -1,3 +1,4 @@
+from array import array
 from unittest import TestCase, mock
 from openshift_metrics import metrics_processor, invoice
 
@@ -275,6 +276,115 @@ class TestMergeMetrics(TestCase):
         processor.merge_metrics("gpu_request", test_metric_list)
         self.assertEqual(processor.merged_data, expected_output_dict)
 
+    def test_merge_metrics_runs(self):
+        metric = {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"}
+        values = [[0, "1"], [60, "1"], [120, "2"], [300, "2"], [360, "2"]]
+        runs = [[0, 2, "1"], [120, 1, "2"], [300, 2, "2"]]
+
+        processor = metrics_processor.MetricsProcessor()
+        processor.merge_metrics("cpu_request", [{"metric": metric, "values": values}])
+        run_processor = metrics_processor.MetricsProcessor()
+        run_processor.merge_metrics(
+            "cpu_request", [{"metric": metric, "runs": runs}], interval_minutes=1
+        )
+        self.assertEqual(run_processor.merged_data, processor.merged_data)
+
+    def test_merge_metrics_runs_as_spans(self):
+        metric = {"pod": "pod1", "namespace": "namespace1", "node": "wrk-1"}
+        cpu_runs = [[0, 4, "1"], [240, 2, "2"], [480, 3, "2"]]
+        memory_runs = [[60, 2, "4"], [180, 5, "8"]]
+        gpu_values = [[120, "1"], [240, "1"], [600, "1"]]
+        gpu_metric = {
+            **metric,
+            "resource": "nvidia.com/gpu",
+            "label_nvidia_com_gpu_product": "NVIDIA-A100-SXM4-40GB",
+        }
+        metrics_to_check = ["cpu_request", "memory_request", "gpu_request"]
+
+        def expand(runs):
+            return [
+                [start + i * 60, value]
+                for start, count, value in runs
+                for i in range(count)
+            ]
+
+        processor = metrics_processor.MetricsProcessor(interval_minutes=1)
+        processor.merge_metrics(
+            "cpu_request", [{"metric": metric, "values": expand(cpu_runs)}]
+        )
+        processor.merge_metrics(
+            "memory_request", [{"metric": metric, "values": expand(memory_runs)}]
+        )
+        processor.merge_metrics(
+            "gpu_request", [{"metric": gpu_metric, "values": gpu_values}]
+        )
+
+        run_processor = metrics_processor.MetricsProcessor(interval_minutes=1)
+        run_processor.merge_metrics(
+            "cpu_request", [{"metric": metric, "runs": cpu_runs}]
+        )
+        run_processor.merge_metrics(
+            "memory_request", [{"metric": metric, "runs": memory_runs}]
+        )
+        run_processor.merge_metrics(
+            "gpu_request", [{"metric": gpu_metric, "values": gpu_values}]
+        )
+
+        self.assertLess(
+            len(run_processor.merged_data["namespace1"]["pod1"]["metrics"]),
+            len(processor.merged_data["namespace1"]["pod1"]["metrics"]),
+        )
+        self.assertEqual(
+            run_processor.condense_metrics(metrics_to_check),
+            processor.condense_metrics(metrics_to_check),
+        )
+
+    def test_merge_metrics_runs_of_another_interval(self):
+        metric = {"pod": "pod1", "namespace": "namespace1"}
+        cpu_runs = [[0, 6, "1"]]
+        memory_runs = [[120, 2, "4"]]
+        metrics_to_check = ["cpu_request", "memory_request"]
+
+        processor = metrics_processor.MetricsProcessor(interval_minutes=1)
+        processor.merge_metrics(
+            "cpu_request",
+            [{"metric": metric, "values": [[t, "1"] for t in range(0, 360, 60)]}],
+        )
+        processor.merge_metrics(
+            "memory_request", [{"metric": metric, "values": [[120, "4"], [240, "4"]]}]
+        )
+
+        run_processor = metrics_processor.MetricsProcessor(interval_minutes=1)
+        run_processor.merge_metrics(
+            "cpu_request", [{"metric": metric, "runs": cpu_runs}]
+        )
+        # runs two minutes apart are samples, not a span of the processor's interval
+        run_processor.merge_metrics(
+            "memory_request",
+            [{"metric": metric, "runs": memory_runs}],
+            interval_minutes=2,
+        )
+        self.assertEqual(
+            run_processor.condense_metrics(metrics_to_check),
+            processor.condense_metrics(metrics_to_check),
+        )
+
+    def test_merge_metrics_columns(self):
+        metric = {"pod": "pod1", "namespace": "namespace1", "resource": "cpu"}
+        values = [[0, "1"], [60, "1"], [120, "2"]]
+        columns = {
+            "metric": metric,
+            "timestamps": memoryview(array("q", [0, 60, 120])),
+            "value_ids": memoryview(array("i", [0, 0, 1])),
+            "value_table": ["1", "2"],
+        }
+
+        processor = metrics_processor.MetricsProcessor()
+        processor.merge_metrics("cpu_request", [{"metric": metric, "values": values}])
+        column_processor = metrics_processor.MetricsProcessor()
+        column_processor.merge_metrics("cpu_request", [columns])
+        self.assertEqual(column_processor.merged_data, processor.merged_data)
+
 
 class TestCondenseMetrics(TestCase):
     def test_condense_metrics(self):
@@ -646,6 +756,37 @@ class TestExtractGPUInfo(TestCase):
             gpu_info = processor._extract_gpu_info("gpu_request", metric_with_label)
             assert gpu_info.gpu_type == "V100-GPU"
 
+    def test_extract_gpu_info_from_node_label_cache(self):
+        metric_without_label = {
+            "metric": {
+                "pod": "pod1",
+                "namespace": "namespace1",
+                "resource": "nvidia.com/gpu",
+                "node": "node-1",
+            },
+            "values": [
+                [60, 1],
+            ],
+        }
+        node_labels = {
+            "node-1": {
+                "label_nvidia_com_gpu_product": "V100-GPU",
+                "label_nvidia_com_gpu_machine": "Dell PowerEdge",
+            }
+        }
+
+        with mock.patch.object(
+            metrics_processor.MetricsProcessor,
+            "_load_gpu_mapping",
+            return_value={"node-1": "A100-GPU"},
+        ):
+            processor = metrics_processor.MetricsProcessor(node_labels=node_labels)
+            gpu_info = processor._extract_gpu_info("gpu_request", metric_without_label)
+
+            # the cache is preferred over the gpu-node file
+            assert gpu_info.gpu_type == "V100-GPU"
+            assert gpu_info.node_model == "Dell PowerEdge"
+
     def test_extract_gpu_info_no_info_anywhere(self):
         """When node is missing in the file, we get no gpu info"""
         mocked_gpu_mapping = {
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from openshift_metrics.node_label_cache import NodeLabelCache
+
+NODE_LABELS = [
+    {
+        "metric": {
+            "__name__": "kube_node_labels",
+            "node": "wrk-3",
+            "label_nvidia_com_gpu_product": "NVIDIA-A100-SXM4-40GB",
+            "label_nvidia_com_gpu_machine": "PowerEdge-XE8545",
+        }
+    },
+    {"metric": {"node": "wrk-4", "label_nvidia_com_gpu_product": "Tesla-V100"}},
+]
+
+
+class TestNodeLabelCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_name = os.path.join(self.directory.name, "node_labels.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_update_and_reload(self):
+        cache = NodeLabelCache(self.file_name).load()
+        self.assertEqual(cache.missing(["wrk-4", "wrk-3", "wrk-3"]), ["wrk-3", "wrk-4"])
+        self.assertEqual(cache.update(NODE_LABELS), 2)
+        cache.save()
+
+        cache = NodeLabelCache(self.file_name).load()
+        self.assertEqual(cache.missing(["wrk-3", "wrk-5"]), ["wrk-5"])
+        self.assertEqual(
+            cache.node_labels(),
+            [
+                {
+                    "metric": {
+                        "node": "wrk-3",
+                        "label_nvidia_com_gpu_product": "NVIDIA-A100-SXM4-40GB",
+                        "label_nvidia_com_gpu_machine": "PowerEdge-XE8545",
+                    }
+                },
+                {
+                    "metric": {
+                        "node": "wrk-4",
+                        "label_nvidia_com_gpu_product": "Tesla-V100",
+                    }
+                },
+            ],
+        )
+
+    def test_known_nodes_are_kept(self):
+        cache = NodeLabelCache(self.file_name)
+        cache.update(NODE_LABELS)
+        changed = {"metric": {"node": "wrk-3", "label_nvidia_com_gpu_product": "other"}}
+        self.assertEqual(cache.update([changed]), 0)
+        self.assertEqual(
+            cache.nodes["wrk-3"]["label_nvidia_com_gpu_product"],
+            "NVIDIA-A100-SXM4-40GB",
+        )
+
+    def test_save_only_when_updated(self):
+        cache = NodeLabelCache(self.file_name).load()
+        cache.save()
+        self.assertFalse(os.path.exists(self.file_name))
+
+    @mock.patch("openshift_metrics.utils.upload_to_s3")
+    @mock.patch("openshift_metrics.utils.download_from_s3")
+    def test_s3(self, mock_download, mock_upload):
+        def download(bucket, location, file_name):
+            with open(file_name, "w") as file:
+                json.dump(
+                    {"wrk-4": {"label_nvidia_com_gpu_product": "Tesla-V100"}}, file
+                )
+            return True
+
+        def upload(file_name, bucket, location):
+            with open(file_name) as file:
+                self.uploaded = json.load(file)
+
+        mock_download.side_effect = download
+        mock_upload.side_effect = upload
+        cache = NodeLabelCache("s3://metrics-bucket/node_labels.json").load()
+        mock_download.assert_called_once_with(
+            "metrics-bucket", "node_labels.json", mock.ANY
+        )
+        self.assertEqual(cache.missing(["wrk-3", "wrk-4"]), ["wrk-3"])
+
+        cache.update(NODE_LABELS)
+        cache.save()
+        mock_upload.assert_called_once_with(
+            mock.ANY, "metrics-bucket", "node_labels.json"
+        )
+        self.assertEqual(sorted(self.uploaded), ["wrk-3", "wrk-4"])
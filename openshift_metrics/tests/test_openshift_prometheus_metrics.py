@@ -0,0 +1,806 @@
+import argparse
+import copy
+import gzip
+import io
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import Future
+from datetime import datetime, UTC
+from decimal import Decimal
+from unittest import TestCase, mock
+
+from openshift_metrics import invoice, utils
+from openshift_metrics import openshift_prometheus_metrics as collector
+from openshift_metrics.coverage_index import CoverageIndex
+from openshift_metrics.metrics_file import (
+    MetricsFileWriter,
+    NdjsonMetricsFileWriter,
+    read_metrics_file,
+    read_ndjson,
+)
+from openshift_metrics.metrics_processor import MetricsProcessor
+from openshift_metrics.node_label_cache import NodeLabelCache
+from openshift_metrics.utils import EmptyResultError
+
+PROJECTION_RE = re.compile(r"^max by \(([^)]*)\) \((.*)\)$")
+NAMESPACE_MATCHER_RE = re.compile(r'namespace=~"([^"]*)", ')
+
+
+def request(pod, resource, node="wrk-1", value="1", instance="10.0.0.1:10259"):
+    return {
+        "metric": {
+            "__name__": "kube_pod_resource_request",
+            "instance": instance,
+            "job": "scheduler",
+            "namespace": "ns1",
+            "node": node,
+            "pod": pod,
+            "priority": "0",
+            "resource": resource,
+            "scheduler": "default-scheduler",
+            "unit": "cores" if resource == "cpu" else "bytes",
+        },
+        "values": [[0, value], [900, value]],
+    }
+
+
+RESOURCE_REQUESTS = [
+    request("pod1", "cpu"),
+    request("pod1", "memory", value="1073741824"),
+    request("pod2", "cpu", node="wrk-3"),
+    request("pod2", "memory", node="wrk-3", value="2147483648"),
+    request("pod2", "nvidia.com/gpu", node="wrk-3"),
+    request("pod3", "cpu"),
+    # the same series scraped from the second scheduler
+    request("pod3", "cpu", instance="10.0.0.2:10259"),
+    request("pod3", "memory", value="536870912"),
+]
+
+
+def projected(pod, resource, node="wrk-1", value="1"):
+    metric = request(pod, resource, node, value)
+    metric["metric"] = {
+        label: metric["metric"][label] for label in collector.PROJECTED_LABELS
+    }
+    return metric
+
+
+# What prometheus answers for RESOURCE_REQUESTS wrapped in max by the
+# projected labels: the two schedulers' pod3 cpu series become one
+PROJECTED_RESOURCE_REQUESTS = [
+    projected("pod1", "cpu"),
+    projected("pod1", "memory", value="1073741824"),
+    projected("pod2", "cpu", node="wrk-3"),
+    projected("pod2", "memory", node="wrk-3", value="2147483648"),
+    projected("pod2", "nvidia.com/gpu", node="wrk-3"),
+    projected("pod3", "cpu"),
+    projected("pod3", "memory", value="536870912"),
+]
+
+
+class FakePrometheusClient:
+    """
+    Answers the collector queries from resource_requests, and the queries
+    projected with max by from projected_requests
+    """
+
+    def __init__(
+        self,
+        resource_requests,
+        pod_labels=None,
+        node_labels=None,
+        projected_requests=None,
+    ):
+        self.resource_requests = resource_requests
+        self.projected_requests = projected_requests
+        self.series = {
+            collector.KUBE_POD_LABELS: pod_labels or [],
+            collector.KUBE_NODE_LABELS: node_labels or [],
+        }
+        self.queries = []
+
+    def _future(self, result):
+        future = Future()
+        if result:
+            future.set_result(result)
+        else:
+            future.set_exception(EmptyResultError())
+        return future
+
+    @staticmethod
+    def _namespaces(query):
+        """Splits the namespace matcher off query"""
+        matcher = NAMESPACE_MATCHER_RE.search(query)
+        if matcher is None:
+            return query, ".*"
+        return query.replace(matcher.group(), ""), matcher.group(1).replace(
+            "\\\\", "\\"
+        )
+
+    def submit(self, metric, start_date, end_date):
+        self.queries.append(metric)
+        projection = PROJECTION_RE.match(metric)
+        query = projection.group(2) if projection else metric
+        query, namespaces = self._namespaces(query)
+        resources = {
+            collector.CPU_REQUEST: ["cpu"],
+            collector.MEMORY_REQUEST: ["memory"],
+            collector.GPU_REQUEST: ["nvidia.com/gpu"],
+            collector.RESOURCE_REQUEST: ["cpu", "memory", "nvidia.com/gpu"],
+        }[query]
+        if projection:
+            assert projection.group(1).split(", ") == collector.PROJECTED_LABELS
+        requests = self.projected_requests if projection else self.resource_requests
+        result = [
+            copy.deepcopy(metric)
+            for metric in requests
+            if metric["metric"]["resource"] in resources
+            and re.fullmatch(namespaces, metric["metric"]["namespace"])
+        ]
+        return self._future(result)
+
+    def submit_series(self, selector, start_date, end_date):
+        self.queries.append(selector)
+        selector, _ = self._namespaces(selector)
+        node_matcher = re.search(r'node=~"([^"]*)"', selector)
+        if node_matcher:
+            return self._future(
+                [
+                    node_label
+                    for node_label in self.series[collector.KUBE_NODE_LABELS]
+                    if re.fullmatch(
+                        node_matcher.group(1).replace("\\\\", "\\"),
+                        node_label["metric"]["node"],
+                    )
+                ]
+            )
+        return self._future(self.series[selector])
+
+    def submit_stream(self, metric, start_date, end_date, consume):
+        future = self.submit(metric, start_date, end_date)
+        if future.exception() is None:
+            for series in future.result():
+                consume(series)
+        return future
+
+
+class TestCollectMetrics(TestCase):
+    pod_labels = [{"metric": {"pod": "pod1", "label_nerc_mghpcc_org_class": "compute"}}]
+    node_labels = [
+        {"metric": {"node": "wrk-3", "label_nvidia_com_gpu_product": "A100"}}
+    ]
+
+    def collect(self, resource_requests, combined_query):
+        prom_client = FakePrometheusClient(
+            resource_requests, self.pod_labels, self.node_labels
+        )
+        metrics = collector.collect_metrics(
+            prom_client, "2022-03-14", "2022-03-14", combined_query=combined_query
+        )
+        return metrics, prom_client.queries
+
+    def test_combined_query(self):
+        metrics, queries = self.collect(RESOURCE_REQUESTS, combined_query=False)
+        combined_metrics, combined_queries = self.collect(
+            RESOURCE_REQUESTS, combined_query=True
+        )
+        self.assertEqual(combined_metrics, metrics)
+        self.assertEqual(len(metrics["cpu_metrics"]), 4)
+        self.assertEqual(len(metrics["memory_metrics"]), 3)
+        self.assertEqual(
+            metrics["gpu_metrics"][0]["metric"]["label_nvidia_com_gpu_product"],
+            "A100",
+        )
+        self.assertEqual(
+            metrics["cpu_metrics"][0]["metric"]["label_nerc_mghpcc_org_class"],
+            "compute",
+        )
+        self.assertEqual(
+            [query for query in combined_queries if "resource_request" in query],
+            [collector.RESOURCE_REQUEST],
+        )
+        self.assertEqual(len(queries), 5)
+
+    def test_combined_query_without_gpus(self):
+        resource_requests = [
+            metric
+            for metric in RESOURCE_REQUESTS
+            if metric["metric"]["resource"] != "nvidia.com/gpu"
+        ]
+        metrics, _ = self.collect(resource_requests, combined_query=False)
+        combined_metrics, _ = self.collect(resource_requests, combined_query=True)
+        self.assertEqual(combined_metrics, metrics)
+        self.assertNotIn("gpu_metrics", combined_metrics)
+
+    def test_split_by_resource(self):
+        resource_requests = collector.split_by_resource(
+            RESOURCE_REQUESTS + [request("pod4", "ephemeral-storage")]
+        )
+        self.assertEqual(
+            {resource: len(metrics) for resource, metrics in resource_requests.items()},
+            {"cpu": 4, "memory": 3, "gpu": 1},
+        )
+
+
+class TestNamespaceFilter(TestCase):
+    def test_namespace_matcher(self):
+        other_namespace = request("pod9", "cpu")
+        other_namespace["metric"]["namespace"] = "ns2"
+        prom_client = FakePrometheusClient(
+            RESOURCE_REQUESTS + [other_namespace],
+            TestCollectMetrics.pod_labels,
+            TestCollectMetrics.node_labels,
+        )
+        metrics = collector.collect_metrics(
+            prom_client,
+            "2022-03-14",
+            "2022-03-14",
+            namespace_matcher='namespace=~"ns1"',
+        )
+        expected = collector.collect_metrics(
+            FakePrometheusClient(
+                RESOURCE_REQUESTS,
+                TestCollectMetrics.pod_labels,
+                TestCollectMetrics.node_labels,
+            ),
+            "2022-03-14",
+            "2022-03-14",
+        )
+        self.assertEqual(metrics, expected)
+        self.assertIn(
+            'kube_pod_resource_request{namespace=~"ns1", resource="cpu", node!=""}'
+            " unless on(pod, namespace) kube_pod_status_unschedulable",
+            prom_client.queries,
+        )
+        self.assertIn(
+            'kube_pod_labels{namespace=~"ns1", label_nerc_mghpcc_org_class!=""}',
+            prom_client.queries,
+        )
+
+    def test_no_upload(self):
+        argv = [
+            "openshift_prometheus_metrics",
+            "--openshift-url",
+            "https://prometheus.example.com",
+            "--namespaces",
+            "ns1",
+            "--upload-to-s3",
+        ]
+        with (
+            mock.patch("sys.argv", argv),
+            mock.patch.object(utils, "upload_to_s3") as upload_to_s3,
+            self.assertRaises(SystemExit),
+        ):
+            collector.main()
+        upload_to_s3.assert_not_called()
+
+
+class TestNodeLabelCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.node_label_cache = NodeLabelCache(
+            os.path.join(self.directory.name, "node_labels.json")
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def collect(self):
+        prom_client = FakePrometheusClient(
+            RESOURCE_REQUESTS,
+            TestCollectMetrics.pod_labels,
+            TestCollectMetrics.node_labels,
+        )
+        metrics = collector.collect_metrics(
+            prom_client,
+            "2022-03-14",
+            "2022-03-14",
+            node_label_cache=self.node_label_cache,
+        )
+        return metrics, [
+            query for query in prom_client.queries if "kube_node_labels" in query
+        ]
+
+    def test_only_new_nodes_are_queried(self):
+        expected, _ = TestCollectMetrics().collect(RESOURCE_REQUESTS, False)
+
+        metrics, node_queries = self.collect()
+        self.assertEqual(metrics, expected)
+        self.assertEqual(
+            node_queries,
+            ['kube_node_labels{node=~"wrk\\\\-3", label_nvidia_com_gpu_product!=""}'],
+        )
+        self.node_label_cache.save()
+
+        # the next run finds every GPU node in the cache
+        self.node_label_cache = NodeLabelCache(self.node_label_cache.location).load()
+        metrics, node_queries = self.collect()
+        self.assertEqual(metrics, expected)
+        self.assertEqual(node_queries, [])
+
+    def test_no_node_labels(self):
+        prom_client = FakePrometheusClient(RESOURCE_REQUESTS, [], [])
+        metrics = collector.collect_metrics(
+            prom_client,
+            "2022-03-14",
+            "2022-03-14",
+            node_label_cache=self.node_label_cache,
+        )
+        self.assertNotIn("gpu_metrics", metrics)
+        self.assertFalse(self.node_label_cache.updated)
+
+
+class TestStreamMetrics(TestCase):
+    def test_same_as_collect_metrics(self):
+        for combined_query, node_labels in [
+            (False, TestCollectMetrics.node_labels),
+            (True, TestCollectMetrics.node_labels),
+            (False, []),
+            (True, []),
+        ]:
+            with self.subTest(combined_query=combined_query, node_labels=node_labels):
+                metrics_dict = {"start_date": "2022-03-14"}
+                metrics_dict.update(
+                    collector.collect_metrics(
+                        FakePrometheusClient(
+                            RESOURCE_REQUESTS,
+                            TestCollectMetrics.pod_labels,
+                            node_labels,
+                        ),
+                        "2022-03-14",
+                        "2022-03-14",
+                        combined_query=combined_query,
+                    )
+                )
+                with tempfile.TemporaryDirectory() as directory:
+                    file_name = os.path.join(directory, "metrics.json")
+                    with MetricsFileWriter(
+                        file_name, {"start_date": "2022-03-14"}
+                    ) as writer:
+                        collector.stream_metrics(
+                            FakePrometheusClient(
+                                RESOURCE_REQUESTS,
+                                TestCollectMetrics.pod_labels,
+                                node_labels,
+                            ),
+                            "2022-03-14",
+                            "2022-03-14",
+                            writer,
+                            combined_query=combined_query,
+                        )
+                    with open(file_name) as file:
+                        self.assertEqual(file.read(), json.dumps(metrics_dict))
+
+                    ndjson_file_name = os.path.join(directory, "metrics.ndjson")
+                    with NdjsonMetricsFileWriter(
+                        ndjson_file_name, {"start_date": "2022-03-14"}
+                    ) as writer:
+                        collector.stream_metrics(
+                            FakePrometheusClient(
+                                RESOURCE_REQUESTS,
+                                TestCollectMetrics.pod_labels,
+                                node_labels,
+                            ),
+                            "2022-03-14",
+                            "2022-03-14",
+                            writer,
+                            combined_query=combined_query,
+                        )
+                    streamed = read_ndjson(ndjson_file_name)
+                    for key, series in streamed.pop("series"):
+                        streamed.setdefault(key, []).append(series)
+                    for key in writer.lists:
+                        streamed.setdefault(key, [])
+                    self.assertEqual(streamed, metrics_dict)
+
+    def test_unsupported_options(self):
+        for option in [["--cache-dir", "/tmp/cache"], ["--split-by-namespace"]]:
+            with self.subTest(option=option):
+                argv = [
+                    "openshift_prometheus_metrics",
+                    "--openshift-url",
+                    "https://prometheus.example.com",
+                    "--stream",
+                    *option,
+                ]
+                with (
+                    mock.patch("sys.argv", argv),
+                    mock.patch.object(collector, "stream_metrics") as stream_metrics,
+                    self.assertRaises(SystemExit),
+                ):
+                    collector.main()
+                stream_metrics.assert_not_called()
+
+
+SU_DEFINITIONS = {
+    invoice.SU_CPU: {"GPUs": 0, "vCPUs": 1, "RAM": 4096},
+    invoice.SU_A100_GPU: {"GPUs": 1, "vCPUs": 24, "RAM": 74 * 1024},
+    invoice.SU_UNKNOWN_GPU: {"GPUs": 1, "vCPUs": 8, "RAM": 64 * 1024},
+    invoice.SU_UNKNOWN_MIG_GPU: {"GPUs": 1, "vCPUs": 8, "RAM": 64 * 1024},
+    invoice.SU_UNKNOWN: {"GPUs": 0, "vCPUs": 1, "RAM": 1024},
+}
+
+
+class TestProjectLabels(TestCase):
+    def write_invoices(self, metrics, directory):
+        processor = MetricsProcessor(15)
+        processor.merge_metrics("cpu_request", metrics["cpu_metrics"])
+        processor.merge_metrics("memory_request", metrics["memory_metrics"])
+        processor.merge_metrics("gpu_request", metrics["gpu_metrics"])
+        condensed_metrics = processor.condense_metrics(
+            ["cpu_request", "memory_request", "gpu_request", "gpu_type"]
+        )
+        rates = invoice.Rates(
+            cpu=Decimal("0.013"),
+            gpu_a100sxm4=Decimal("2.078"),
+            gpu_a100=Decimal("1.803"),
+            gpu_v100=Decimal("1.214"),
+            gpu_h100=Decimal("6.04"),
+        )
+        report_metadata = invoice.ReportMetadata(
+            report_month="2022-03",
+            cluster_name="test-cluster",
+            report_start_time=datetime(2022, 3, 14, tzinfo=UTC),
+            report_end_time=datetime(2022, 3, 15, tzinfo=UTC),
+            generated_at=datetime(2022, 3, 15, tzinfo=UTC),
+        )
+        utils.write_metrics_by_namespace(
+            condensed_metrics,
+            os.path.join(directory, "invoice.csv"),
+            report_metadata,
+            rates,
+            SU_DEFINITIONS,
+        )
+        utils.write_metrics_by_classes(
+            condensed_metrics,
+            os.path.join(directory, "classes.csv"),
+            report_metadata,
+            rates,
+            ["ns1"],
+            SU_DEFINITIONS,
+        )
+        utils.write_metrics_by_pod(
+            condensed_metrics, os.path.join(directory, "pods.csv"), SU_DEFINITIONS
+        )
+        invoices = {}
+        for file_name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, file_name), "rb") as file:
+                invoices[file_name] = file.read()
+        return invoices
+
+    def test_duplicate_series_are_equal(self):
+        """
+        Without the projection the samples of series that only differ in the
+        dropped labels overwrite each other when merged, with it prometheus
+        keeps the largest. The invoices are only the same because such
+        duplicates, the series of the two schedulers, carry equal values.
+        """
+        metrics = collector.collect_metrics(
+            FakePrometheusClient(
+                RESOURCE_REQUESTS,
+                TestCollectMetrics.pod_labels,
+                TestCollectMetrics.node_labels,
+            ),
+            "2022-03-14",
+            "2022-03-14",
+        )
+        duplicates = {}
+        for key in ("cpu_metrics", "memory_metrics", "gpu_metrics"):
+            for series in metrics[key]:
+                labels = tuple(
+                    series["metric"][label] for label in collector.PROJECTED_LABELS
+                )
+                duplicates.setdefault(labels, []).append(series["values"])
+        self.assertIn(2, [len(values) for values in duplicates.values()])
+        for values in duplicates.values():
+            self.assertEqual(values, [values[0]] * len(values))
+
+    def test_invoices_are_identical(self):
+        for combined_query in (False, True):
+            with self.subTest(combined_query=combined_query):
+                metrics = collector.collect_metrics(
+                    FakePrometheusClient(
+                        RESOURCE_REQUESTS,
+                        TestCollectMetrics.pod_labels,
+                        TestCollectMetrics.node_labels,
+                    ),
+                    "2022-03-14",
+                    "2022-03-14",
+                    combined_query=combined_query,
+                )
+                projected_metrics = collector.collect_metrics(
+                    FakePrometheusClient(
+                        RESOURCE_REQUESTS,
+                        TestCollectMetrics.pod_labels,
+                        TestCollectMetrics.node_labels,
+                        projected_requests=PROJECTED_RESOURCE_REQUESTS,
+                    ),
+                    "2022-03-14",
+                    "2022-03-14",
+                    combined_query=combined_query,
+                    project_labels=True,
+                )
+                self.assertNotIn(
+                    "instance", projected_metrics["cpu_metrics"][0]["metric"]
+                )
+                self.assertEqual(len(projected_metrics["cpu_metrics"]), 3)
+
+                with tempfile.TemporaryDirectory() as directory:
+                    invoices = self.write_invoices(metrics, directory)
+                with tempfile.TemporaryDirectory() as directory:
+                    projected_invoices = self.write_invoices(
+                        projected_metrics, directory
+                    )
+                self.assertEqual(projected_invoices, invoices)
+
+
+@mock.patch.dict(
+    os.environ, {"PROD_TOKEN": "prod-token", "OPENSHIFT_TOKEN": "example-token"}
+)
+class TestMultipleClusters(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.clusters_file = os.path.join(self.directory.name, "clusters.json")
+        with open(self.clusters_file, "w") as file:
+            json.dump(
+                [
+                    {
+                        "url": "https://thanos-querier-openshift-monitoring.apps.shift.nerc.mghpcc.org",
+                        "token_env": "PROD_TOKEN",
+                        "concurrency": 8,
+                        "bucket": "prod-metrics",
+                    },
+                    {
+                        "url": "https://prometheus.example.com",
+                        "name": "example",
+                        "bucket": "example-metrics",
+                    },
+                ],
+                file,
+            )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_load_clusters(self):
+        clusters = collector.load_clusters(self.clusters_file)
+        self.assertEqual(
+            [(c.name, c.token, c.concurrency, c.bucket) for c in clusters],
+            [
+                ("ocp-prod", "prod-token", 8, "prod-metrics"),
+                ("example", "example-token", 5, "example-metrics"),
+            ],
+        )
+
+    def test_token_not_set(self):
+        argv = ["openshift_prometheus_metrics", "--clusters-file", self.clusters_file]
+        with (
+            mock.patch.dict(os.environ),
+            mock.patch("sys.argv", argv),
+            mock.patch.object(collector, "collect_metrics") as collect_metrics,
+            mock.patch("sys.stderr", new_callable=io.StringIO) as stderr,
+            self.assertRaises(SystemExit),
+        ):
+            del os.environ["PROD_TOKEN"]
+            collector.main()
+        collect_metrics.assert_not_called()
+        self.assertIn(
+            "Set PROD_TOKEN to the token of cluster ocp-prod", stderr.getvalue()
+        )
+
+    def run_collector(self, collect_metrics, *extra_args):
+        output_file = os.path.join(self.directory.name, "metrics.json")
+        argv = [
+            "openshift_prometheus_metrics",
+            "--clusters-file",
+            self.clusters_file,
+            "--report-start-date",
+            "2022-03-14",
+            "--report-end-date",
+            "2022-03-14",
+            "--output-file",
+            output_file,
+            "--upload-to-s3",
+            *extra_args,
+        ]
+        with (
+            mock.patch("sys.argv", argv),
+            mock.patch.object(collector, "collect_metrics", collect_metrics),
+            mock.patch.object(utils, "upload_to_s3") as upload_to_s3,
+            mock.patch.object(collector, "CoverageIndex"),
+        ):
+            collector.main()
+        return upload_to_s3
+
+    def test_every_cluster_is_written_and_uploaded(self):
+        def collect_metrics(prom_client, *args, **kwargs):
+            return {"cpu_metrics": [prom_client.prometheus_url]}
+
+        upload_to_s3 = self.run_collector(collect_metrics)
+        for name, bucket in [
+            ("ocp-prod", "prod-metrics"),
+            ("example", "example-metrics"),
+        ]:
+            output_file = os.path.join(self.directory.name, name, "metrics.json")
+            with open(output_file) as file:
+                metrics = json.load(file)
+            self.assertEqual(metrics["cluster_name"], name)
+            upload_to_s3.assert_any_call(
+                output_file, bucket, "data_2022-03/metrics-2022-03-14.json"
+            )
+
+    def test_columnar_alongside(self):
+        def collect_metrics(prom_client, *args, **kwargs):
+            return {
+                "cpu_metrics": [
+                    {"metric": {"pod": "pod1"}, "values": [[1647216000, "1"]]}
+                ]
+            }
+
+        upload_to_s3 = self.run_collector(collect_metrics, "--columnar")
+        output_dir = os.path.join(self.directory.name, "example")
+        with open(os.path.join(output_dir, "metrics.json")) as file:
+            metrics = json.load(file)
+        columnar = read_metrics_file(os.path.join(output_dir, "metrics.columnar"))
+        self.assertEqual(columnar["cluster_name"], metrics["cluster_name"])
+        self.assertEqual(
+            columnar["cpu_metrics"][0]["metric"], metrics["cpu_metrics"][0]["metric"]
+        )
+        upload_to_s3.assert_any_call(
+            os.path.join(output_dir, "metrics.columnar"),
+            "example-metrics",
+            "data_2022-03/metrics-2022-03-14.columnar",
+        )
+
+    def test_gzip_to_s3(self):
+        def collect_metrics(prom_client, *args, **kwargs):
+            return {"cpu_metrics": []}
+
+        s3 = mock.MagicMock()
+        s3.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+        s3.upload_part.return_value = {"ETag": "etag"}
+        with mock.patch.object(utils, "get_s3_client", return_value=s3):
+            upload_to_s3 = self.run_collector(collect_metrics, "--gzip-to-s3")
+
+        # nothing is written to disk or uploaded from there
+        upload_to_s3.assert_not_called()
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "example")))
+        uploads = {}
+        for c in s3.upload_part.call_args_list:
+            uploads.setdefault(c.kwargs["Bucket"], b"")
+            uploads[c.kwargs["Bucket"]] += c.kwargs["Body"]
+        metrics = json.loads(gzip.decompress(uploads["example-metrics"]))
+        self.assertEqual(metrics["cluster_name"], "example")
+        self.assertEqual(s3.complete_multipart_upload.call_count, 2)
+        s3.create_multipart_upload.assert_any_call(
+            Bucket="example-metrics", Key="data_2022-03/metrics-2022-03-14.json.gz"
+        )
+
+    def test_report_script_merges_every_extension(self):
+        script = os.path.join(
+            os.path.dirname(__file__), "..", "..", "bin", "produce_report.sh"
+        )
+        with open(script) as file:
+            patterns = re.split(r"[\s;]+", file.read())
+        for columnar in (None, "alongside", "instead"):
+            for ndjson in (False, True):
+                for gzip_to_s3 in (False, True):
+                    args = argparse.Namespace(
+                        columnar=columnar, ndjson=ndjson, gzip_to_s3=gzip_to_s3
+                    )
+                    extension = collector.file_extension(args)
+                    self.assertIn(f"/data/*.{extension}", patterns)
+
+    def test_failed_cluster(self):
+        def collect_metrics(prom_client, *args, **kwargs):
+            if "example" in prom_client.prometheus_url:
+                raise EmptyResultError("no data")
+            return {"cpu_metrics": []}
+
+        with self.assertRaises(SystemExit) as raised:
+            self.run_collector(collect_metrics)
+        self.assertIn("example", str(raised.exception))
+        # the other cluster is still collected
+        self.assertTrue(
+            os.path.exists(
+                os.path.join(self.directory.name, "ocp-prod", "metrics.json")
+            )
+        )
+
+    def test_single_cluster(self):
+        output_file = os.path.join(self.directory.name, "metrics.json")
+        argv = [
+            "openshift_prometheus_metrics",
+            "--openshift-url",
+            "https://prometheus.example.com",
+            "--report-start-date",
+            "2022-03-14",
+            "--report-end-date",
+            "2022-03-14",
+            "--output-file",
+            output_file,
+            "--cache-dir",
+            os.path.join(self.directory.name, "cache"),
+        ]
+        collect_metrics = mock.Mock(return_value={"cpu_metrics": []})
+        with (
+            mock.patch("sys.argv", argv),
+            mock.patch.object(collector, "collect_metrics", collect_metrics),
+        ):
+            collector.main()
+        with open(output_file) as file:
+            metrics = json.load(file)
+        self.assertEqual(metrics["cluster_name"], "https://prometheus.example.com")
+        prom_client = collect_metrics.call_args.args[0]
+        self.assertIsNotNone(prom_client.cache)
+
+
+class TestFillGaps(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_only_missing_days_are_collected(self):
+        index = CoverageIndex("openshift-metrics")
+        index.add(
+            "2022-03-02", "2022-03-03", 15, "data_2022-03/metrics-2022-03-02.json"
+        )
+        index.add(
+            "2022-03-05", "2022-03-05", 60, "data_2022-03/metrics-2022-03-05.json"
+        )
+        argv = [
+            "openshift_prometheus_metrics",
+            "--openshift-url",
+            "https://prometheus.example.com",
+            "--report-start-date",
+            "2022-03-01",
+            "--report-end-date",
+            "2022-03-06",
+            "--upload-to-s3",
+            "--fill-gaps",
+        ]
+        collect_metrics = mock.Mock(return_value={"cpu_metrics": []})
+        with (
+            mock.patch("sys.argv", argv),
+            mock.patch.object(collector, "collect_metrics", collect_metrics),
+            mock.patch.object(utils, "upload_to_s3") as upload_to_s3,
+            mock.patch.object(collector, "CoverageIndex") as coverage_index,
+        ):
+            coverage_index.return_value.load.return_value = index
+            collector.main()
+
+        self.assertEqual(
+            [call.args[1:3] for call in collect_metrics.call_args_list],
+            [("2022-03-01", "2022-03-01"), ("2022-03-04", "2022-03-06")],
+        )
+        self.assertEqual(
+            [call.args[2] for call in upload_to_s3.call_args_list],
+            [
+                "data_2022-03/metrics-2022-03-01.json",
+                "coverage.json",
+                "data_2022-03/metrics-2022-03-04-to-2022-03-06.json",
+                "coverage.json",
+            ],
+        )
+        self.assertEqual(index.missing_ranges("2022-03-01", "2022-03-06", 15), [])
+        with open("metrics-2022-03-04-to-2022-03-06.json") as file:
+            metrics = json.load(file)
+        self.assertEqual(metrics["start_date"], "2022-03-04")
+        self.assertEqual(metrics["end_date"], "2022-03-06")
+
+    def test_needs_upload(self):
+        argv = [
+            "openshift_prometheus_metrics",
+            "--openshift-url",
+            "https://prometheus.example.com",
+            "--fill-gaps",
+        ]
+        with mock.patch("sys.argv", argv), self.assertRaises(SystemExit):
+            collector.main()
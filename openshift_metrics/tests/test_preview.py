@@ -0,0 +1,93 @@
+from datetime import datetime, UTC
+from decimal import Decimal
+from unittest import TestCase
+
+from openshift_metrics import invoice, preview
+
+RATES = invoice.Rates(
+    cpu=Decimal("0.5"),
+    gpu_a100=Decimal("2"),
+    gpu_a100sxm4=Decimal("2"),
+    gpu_v100=Decimal("1"),
+    gpu_h100=Decimal("6"),
+)
+SU_DEFINITIONS = {
+    invoice.SU_CPU: {"GPUs": 0, "vCPUs": 1, "RAM": 4096},
+    invoice.SU_A100_GPU: {"GPUs": 1, "vCPUs": 24, "RAM": 74 * 1024},
+}
+HOUR = 3600
+
+
+def block(duration, cpu_request, memory_gib, **kwargs):
+    return {
+        "duration": duration,
+        "cpu_request": cpu_request,
+        "memory_request": memory_gib * 2**30,
+        **kwargs,
+    }
+
+
+class TestEstimateCosts(TestCase):
+    def test_estimate_costs(self):
+        condensed_metrics_dict = {
+            "ns1": {
+                "pod1": {"metrics": {0: block(10 * HOUR, "1", 4)}},
+                # the request changed, so it's two stretches
+                "pod2": {
+                    "metrics": {
+                        0: block(2 * HOUR, "2", 4),
+                        2 * HOUR: block(3 * HOUR, "1", 4),
+                    }
+                },
+            },
+            "ns2": {
+                "pod3": {
+                    "metrics": {
+                        0: block(
+                            4 * HOUR,
+                            "1",
+                            8,
+                            gpu_request="1",
+                            gpu_type=invoice.GPU_A100,
+                            gpu_resource=invoice.WHOLE_GPU,
+                        )
+                    }
+                }
+            },
+        }
+        report_metadata = invoice.ReportMetadata(
+            report_month="2022-03",
+            cluster_name="ocp-prod",
+            report_start_time=datetime(2022, 3, 1, tzinfo=UTC),
+            report_end_time=datetime(2022, 3, 15, tzinfo=UTC),
+            generated_at=datetime(2022, 3, 15, tzinfo=UTC),
+        )
+        estimates = preview.estimate_costs(
+            condensed_metrics_dict, report_metadata, RATES, SU_DEFINITIONS, 60
+        )
+        # 10 + 2 * 2 + 3 = 17 CPU SU hours, 3 stretches with 1, 2 and 1 SUs
+        self.assertEqual(estimates["ns1"], (Decimal("8.50"), Decimal("2.00")))
+        self.assertEqual(estimates["ns2"], (Decimal("8.00"), Decimal("2.00")))
+
+    def test_error_bound_shrinks_with_the_interval(self):
+        condensed_metrics_dict = {
+            "ns1": {"pod1": {"metrics": {0: block(10 * HOUR, "4", 4)}}}
+        }
+        report_metadata = invoice.ReportMetadata(
+            report_month="2022-03",
+            cluster_name="ocp-prod",
+            report_start_time=datetime(2022, 3, 1, tzinfo=UTC),
+            report_end_time=datetime(2022, 3, 15, tzinfo=UTC),
+            generated_at=datetime(2022, 3, 15, tzinfo=UTC),
+        )
+        bounds = [
+            preview.estimate_costs(
+                condensed_metrics_dict,
+                report_metadata,
+                RATES,
+                SU_DEFINITIONS,
+                interval_minutes,
+            )["ns1"][1]
+            for interval_minutes in (60, 15)
+        ]
+        self.assertEqual(bounds, [Decimal("2.00"), Decimal("0.50")])
@@ -1,7 +1,16 @@
+import json
+import requests
+import threading
+import time
+from datetime import datetime, timedelta, UTC
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 from requests.exceptions import ConnectionError
 from unittest import TestCase, mock
 
+from openshift_metrics import prometheus_client
 from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.utils import EmptyResultError, QueryTooLargeError
 
 
 class TestQueryMetric(TestCase):
@@ -43,3 +52,494 @@ class TestQueryMetric(TestCase):
             "2022-03-14",
         )
         self.assertEqual(mock_get.call_count, 1)
+        # a connection error doesn't count as prometheus throttling us
+        self.assertEqual(prom_client.governor.throttled, 0)
+        self.assertEqual(prom_client.governor.limit, prom_client.governor.max_limit)
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_query_metric_reuses_session(self, mock_sleep, mock_get):
+        mock_response = mock.Mock(status_code=200)
+        mock_response.json.return_value = {"data": {"result": "this is data"}}
+        mock_get.return_value = mock_response
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        session = prom_client.session
+        prom_client.query_metric("fake-metric", "2022-03-14", "2022-03-14")
+        prom_client.query_metric("fake-metric", "2022-03-15", "2022-03-15")
+        self.assertIs(prom_client.session, session)
+        self.assertEqual(session.headers["Authorization"], "Bearer fake-token")
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_query_metric_max_source_resolution(self, mock_sleep, mock_get):
+        mock_response = mock.Mock(status_code=200)
+        mock_response.json.return_value = {"data": {"result": "this is data"}}
+        mock_get.return_value = mock_response
+        prom_client = PrometheusClient(
+            "https://fake-url", "fake-token", 60, max_source_resolution="1h"
+        )
+        prom_client.query_metric("fake-metric", "2022-03-14", "2022-03-14")
+        params = request_params(*mock_get.call_args.args, **mock_get.call_args.kwargs)
+        self.assertEqual(params["step"], ["60m"])
+        self.assertEqual(params["max_source_resolution"], ["1h"])
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_query_is_encoded(self, mock_sleep, mock_get):
+        metric = 'fake_metric{namespace=~"ns-a+|ns&b|ns#c"}'
+        mock_response = mock.Mock(status_code=200)
+        mock_response.json.return_value = {"data": {"result": "this is data"}}
+        mock_response.iter_content.return_value = [
+            b'{"data": {"result": [{"metric": {}, "values": []}]}}'
+        ]
+        mock_get.return_value = mock_response
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+
+        prom_client.query_metric(metric, "2022-03-14", "2022-03-14")
+        params = request_params(*mock_get.call_args.args, **mock_get.call_args.kwargs)
+        self.assertEqual(params["query"], [metric])
+
+        list(prom_client.iter_metric(metric, "2022-03-14", "2022-03-14"))
+        params = request_params(*mock_get.call_args.args, **mock_get.call_args.kwargs)
+        self.assertEqual(params["query"], [metric])
+
+
+class TestSubmit(TestCase):
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_submit(self, mock_sleep, mock_get):
+        def fake_get(url, **kwargs):
+            metric = request_params(url, **kwargs)["query"][0]
+            return mock.Mock(
+                status_code=200,
+                json=mock.Mock(return_value={"data": {"result": [metric]}}),
+            )
+
+        mock_get.side_effect = fake_get
+        with PrometheusClient("https://fake-url", "fake-token") as prom_client:
+            futures = [
+                prom_client.submit(metric, "2022-03-14", "2022-03-14")
+                for metric in ["metric-a", "metric-b", "metric-c"]
+            ]
+            results = [future.result() for future in futures]
+        self.assertEqual(results, [["metric-a"], ["metric-b"], ["metric-c"]])
+        self.assertEqual(mock_get.call_count, 3)
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_submit_exception(self, mock_sleep, mock_get):
+        mock_get.return_value = mock.Mock(status_code=404)
+        with PrometheusClient("https://fake-url", "fake-token") as prom_client:
+            future = prom_client.submit("fake-metric", "2022-03-14", "2022-03-14")
+            self.assertRaises(EmptyResultError, future.result)
+
+
+def request_params(url, params=None, **kwargs):
+    """Returns the query parameters prometheus reads from a request"""
+    prepared = requests.Request("GET", url, params=params).prepare()
+    return parse_qs(urlparse(prepared.url).query)
+
+
+def fake_query_range(url, **kwargs):
+    """
+    Pretends to be prometheus: pod1 has a sample at every step and pod2 only
+    exists between 10:00 and 30:00 on the second day.
+    """
+    params = request_params(url, **kwargs)
+    start = datetime.fromisoformat(params["start"][0]).timestamp()
+    end = datetime.fromisoformat(params["end"][0]).timestamp()
+    step = int(params["step"][0].rstrip("m")) * 60
+    pod2_start = datetime(2022, 3, 15, 10, tzinfo=UTC).timestamp()
+    pod2_end = datetime(2022, 3, 16, 6, tzinfo=UTC).timestamp()
+
+    pod1 = {"metric": {"pod": "pod1"}, "values": []}
+    pod2 = {"metric": {"pod": "pod2"}, "values": []}
+    timestamp = start
+    while timestamp <= end:
+        pod1["values"].append([int(timestamp), str(timestamp % 7)])
+        if pod2_start <= timestamp <= pod2_end:
+            pod2["values"].append([int(timestamp), "1"])
+        timestamp += step
+    result = [series for series in [pod1, pod2] if series["values"]]
+    return mock.Mock(
+        status_code=200,
+        json=mock.Mock(return_value={"data": {"result": result}}),
+    )
+
+
+class FakePrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.delay)
+            status, body, *headers = server.respond(self.path)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers[0] if headers else {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakePrometheus(ThreadingHTTPServer):
+    """
+    Answers query_range requests with fake_query_range in a background thread.
+    respond can return extra headers after the status and body.
+    """
+
+    def __init__(self, respond=None, delay=0):
+        super().__init__(("127.0.0.1", 0), FakePrometheusHandler)
+        self.respond = respond or self.query_range
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @staticmethod
+    def query_range(path):
+        return 200, {"data": fake_query_range(f"http://fake-url{path}").json()["data"]}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class TestShardedQuery(TestCase):
+    def test_split_range(self):
+        start = datetime(2022, 3, 14, tzinfo=UTC)
+        end = datetime(2022, 3, 14, 23, 59, 59, tzinfo=UTC)
+        ranges = prometheus_client.split_range(
+            start, end, timedelta(hours=6), timedelta(minutes=15)
+        )
+        self.assertEqual(
+            ranges,
+            [
+                (start, datetime(2022, 3, 14, 5, 45, tzinfo=UTC)),
+                (
+                    datetime(2022, 3, 14, 6, tzinfo=UTC),
+                    datetime(2022, 3, 14, 11, 45, tzinfo=UTC),
+                ),
+                (
+                    datetime(2022, 3, 14, 12, tzinfo=UTC),
+                    datetime(2022, 3, 14, 17, 45, tzinfo=UTC),
+                ),
+                (datetime(2022, 3, 14, 18, tzinfo=UTC), end),
+            ],
+        )
+
+    def test_split_range_unaligned_step(self):
+        start = datetime(2022, 3, 14, tzinfo=UTC)
+        end = datetime(2022, 3, 14, 2, tzinfo=UTC)
+        ranges = prometheus_client.split_range(
+            start, end, timedelta(hours=1), timedelta(minutes=25)
+        )
+        self.assertEqual(
+            ranges,
+            [
+                (start, datetime(2022, 3, 14, 0, 50, tzinfo=UTC)),
+                (datetime(2022, 3, 14, 1, 15, tzinfo=UTC), end),
+            ],
+        )
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_sharded_query_matches_single_query(self, mock_sleep, mock_get):
+        mock_get.side_effect = fake_query_range
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        expected = prom_client.query_metric("fake-metric", "2022-03-14", "2022-03-16")
+        self.assertEqual(mock_get.call_count, 1)
+
+        for shard in ["hour", "day", "week"]:
+            with self.subTest(shard=shard):
+                metrics = prom_client.query_metric(
+                    "fake-metric", "2022-03-14", "2022-03-16", shard=shard
+                )
+                self.assertEqual(metrics, expected)
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_sharded_query_failed_shard(self, mock_sleep, mock_get):
+        def fail_second_day(url, **kwargs):
+            if kwargs["params"]["start"].startswith("2022-03-15"):
+                return mock.Mock(status_code=500, reason="Internal Server Error")
+            return fake_query_range(url, **kwargs)
+
+        mock_get.side_effect = fail_second_day
+        prom_client = PrometheusClient("https://fake-url", "fake-token", shard="day")
+        self.assertRaises(
+            EmptyResultError,
+            prom_client.query_metric,
+            "fake-metric",
+            "2022-03-14",
+            "2022-03-16",
+        )
+
+    def test_stitch_results_drops_repeated_samples(self):
+        first = [{"metric": {"pod": "pod1"}, "values": [[0, "1"], [60, "1"]]}]
+        second = [
+            {"metric": {"pod": "pod1"}, "values": [[60, "1"], [120, "2"]]},
+            {"metric": {"pod": "pod0"}, "values": [[120, "3"]]},
+        ]
+        self.assertEqual(
+            prometheus_client.stitch_results([first, second]),
+            [
+                {"metric": {"pod": "pod0"}, "values": [[120, "3"]]},
+                {
+                    "metric": {"pod": "pod1"},
+                    "values": [[0, "1"], [60, "1"], [120, "2"]],
+                },
+            ],
+        )
+
+
+class TestQueryBisection(TestCase):
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_bisect_time_range(self, mock_sleep, mock_get):
+        def limited_query_range(url, **kwargs):
+            params = request_params(url, **kwargs)
+            start = datetime.fromisoformat(params["start"][0])
+            end = datetime.fromisoformat(params["end"][0])
+            if end - start > timedelta(hours=5):
+                return mock.Mock(
+                    status_code=422,
+                    reason="Unprocessable Entity",
+                    json=mock.Mock(
+                        return_value={"error": "exceeded maximum resolution"}
+                    ),
+                )
+            return fake_query_range(url, **kwargs)
+
+        mock_get.side_effect = fake_query_range
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        expected = prom_client.query_metric("fake-metric", "2022-03-14", "2022-03-16")
+
+        mock_get.reset_mock()
+        mock_get.side_effect = limited_query_range
+        metrics = prom_client.query_metric("fake-metric", "2022-03-14", "2022-03-16")
+        self.assertEqual(metrics, expected)
+        mock_sleep.assert_not_called()
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_bisect_gives_up_on_single_step(self, mock_sleep, mock_get):
+        mock_get.return_value = mock.Mock(
+            status_code=503,
+            reason="Service Unavailable",
+            json=mock.Mock(return_value={"error": "query would load too many samples"}),
+        )
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        self.assertRaises(
+            QueryTooLargeError,
+            prom_client.query_metric,
+            "fake-metric",
+            "2022-03-14",
+            "2022-03-14",
+        )
+        # the refused queries are split, never retried as they are
+        mock_sleep.assert_not_called()
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_other_unprocessable_query_not_bisected(self, mock_sleep, mock_get):
+        mock_get.return_value = mock.Mock(
+            status_code=422,
+            reason="Unprocessable Entity",
+            json=mock.Mock(
+                return_value={"error": "execution: expanding series: bad regex"}
+            ),
+        )
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        self.assertRaises(
+            EmptyResultError,
+            prom_client.query_metric,
+            "fake-metric",
+            "2022-03-14",
+            "2022-03-16",
+        )
+        # failed like any other error rather than split into smaller queries
+        self.assertEqual(mock_get.call_count, 3)
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_split_by_namespace(self, mock_sleep, mock_get):
+        namespaces = ["ns-a", "ns-b", "ns-c"]
+
+        def limited_by_series(url, params=None, **kwargs):
+            if "/label/namespace/values" in url:
+                self.assertEqual(params["match[]"], 'fake_metric{node!=""}')
+                return mock.Mock(
+                    status_code=200,
+                    json=mock.Mock(return_value={"data": namespaces}),
+                )
+            query = request_params(url, params)["query"][0]
+            queried = [ns for ns in namespaces if ns.replace("-", "\\\\-") in query]
+            if not queried or len(queried) > 1:
+                return mock.Mock(
+                    status_code=400,
+                    reason="Bad Request",
+                    json=mock.Mock(return_value={"error": "exceeded series limit"}),
+                )
+            result = [
+                {
+                    "metric": {"namespace": queried[0], "pod": "pod1"},
+                    "values": [[1647216000, "1"]],
+                }
+            ]
+            return mock.Mock(
+                status_code=200,
+                json=mock.Mock(return_value={"data": {"result": result}}),
+            )
+
+        mock_get.side_effect = limited_by_series
+        prom_client = PrometheusClient(
+            "https://fake-url", "fake-token", split_by_namespace=True
+        )
+        start = datetime(2022, 3, 14, tzinfo=UTC)
+        metrics = prom_client.query_range(
+            'fake_metric{node!=""} unless on(pod) other_metric', start, start
+        )
+        self.assertEqual(
+            [metric["metric"]["namespace"] for metric in metrics], namespaces
+        )
+
+
+class TestQuerySeries(TestCase):
+    @mock.patch("requests.Session.get")
+    def test_query_series(self, mock_get):
+        mock_get.return_value = mock.Mock(
+            status_code=200,
+            json=mock.Mock(
+                return_value={
+                    "data": [
+                        {"node": "wrk-2", "label_nvidia_com_gpu_product": "A100"},
+                        {"node": "wrk-1", "label_nvidia_com_gpu_product": "V100"},
+                        {"node": "wrk-2", "label_nvidia_com_gpu_product": "A100"},
+                    ]
+                }
+            ),
+        )
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        series = prom_client.query_series(
+            'kube_node_labels{label_nvidia_com_gpu_product!=""}',
+            "2022-03-14",
+            "2022-03-15",
+        )
+        self.assertEqual(
+            series,
+            [
+                {"metric": {"node": "wrk-2", "label_nvidia_com_gpu_product": "A100"}},
+                {"metric": {"node": "wrk-1", "label_nvidia_com_gpu_product": "V100"}},
+            ],
+        )
+        mock_get.assert_called_once_with(
+            "https://fake-url/api/v1/series",
+            params={
+                "match[]": 'kube_node_labels{label_nvidia_com_gpu_product!=""}',
+                "start": "2022-03-14T00:00:00Z",
+                "end": "2022-03-15T23:59:59Z",
+            },
+            verify=True,
+        )
+
+    @mock.patch("requests.Session.get")
+    def test_query_series_empty(self, mock_get):
+        mock_get.return_value = mock.Mock(
+            status_code=200, json=mock.Mock(return_value={"data": []})
+        )
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        self.assertRaises(
+            EmptyResultError,
+            prom_client.query_series,
+            "kube_pod_labels",
+            "2022-03-14",
+            "2022-03-14",
+        )
+
+
+STREAMED_RESULT = [
+    {
+        "metric": {"pod": "pod{1}", "namespace": 'ns "quoted" \\ }'},
+        "values": [[1647216000, "1"], [1647216900, "2"]],
+    },
+    {
+        "metric": {"pod": "pod2", "namespace": "ns\u00e9"},
+        "values": [[1647216000, "0.5"]],
+    },
+]
+
+
+def chunked(body, size):
+    return [body[i : i + size] for i in range(0, len(body), size)]
+
+
+class TestStreaming(TestCase):
+    body = json.dumps(
+        {
+            "status": "success",
+            "data": {"resultType": "matrix", "result": STREAMED_RESULT},
+        },
+        indent=1,
+    ).encode()
+
+    def test_iter_result_series(self):
+        for size in (1, 2, 7, len(self.body)):
+            with self.subTest(size=size):
+                self.assertEqual(
+                    list(
+                        prometheus_client.iter_result_series(chunked(self.body, size))
+                    ),
+                    STREAMED_RESULT,
+                )
+
+    def test_iter_result_series_truncated(self):
+        with self.assertRaises(ValueError):
+            list(prometheus_client.iter_result_series(chunked(self.body[:-40], 5)))
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_iter_metric(self, mock_sleep, mock_get):
+        empty_response = mock.Mock(status_code=200)
+        empty_response.iter_content.return_value = [
+            b'{"status":"success","data":{"resultType":"matrix","result":[]}}'
+        ]
+        response = mock.Mock(status_code=200)
+        response.iter_content.return_value = chunked(self.body, 10)
+        mock_get.side_effect = [empty_response, response]
+
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        series = prom_client.iter_metric("fake-metric", "2022-03-14", "2022-03-14")
+        self.assertEqual(next(series), STREAMED_RESULT[0])
+        self.assertEqual(list(series), STREAMED_RESULT[1:])
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertTrue(mock_get.call_args.kwargs["stream"])
+
+    @mock.patch("requests.Session.get")
+    @mock.patch("time.sleep")
+    def test_iter_metric_empty(self, mock_sleep, mock_get):
+        mock_get.return_value = mock.Mock(status_code=404)
+        prom_client = PrometheusClient("https://fake-url", "fake-token")
+        with self.assertRaises(EmptyResultError):
+            list(prom_client.iter_metric("fake-metric", "2022-03-14", "2022-03-14"))
+        self.assertEqual(mock_get.call_count, 3)
@@ -0,0 +1,50 @@
+from unittest import TestCase
+
+from openshift_metrics import promql
+
+
+class TestAddLabelMatcher(TestCase):
+    def test_add_label_matcher(self):
+        query = 'kube_pod_resource_request{resource="cpu", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable'
+        self.assertEqual(
+            promql.add_label_matcher(query, 'namespace="ns1"'),
+            'kube_pod_resource_request{namespace="ns1", resource="cpu", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable',
+        )
+
+    def test_add_label_matcher_empty_selector(self):
+        self.assertEqual(
+            promql.add_label_matcher("max by (pod) (kube_pod_labels{})", 'pod="a"'),
+            'max by (pod) (kube_pod_labels{pod="a"})',
+        )
+
+    def test_add_label_matcher_no_selector(self):
+        self.assertRaises(
+            ValueError, promql.add_label_matcher, "kube_pod_labels", 'pod="a"'
+        )
+
+    def test_regex_matcher(self):
+        self.assertEqual(
+            promql.regex_matcher("namespace", ["ns1", "ns-2"]),
+            'namespace=~"ns1|ns\\\\-2"',
+        )
+
+    def test_pattern_matcher(self):
+        self.assertEqual(
+            promql.pattern_matcher("namespace", 'ns-\\d+|"quoted"'),
+            'namespace=~"ns-\\\\d+|\\"quoted\\""',
+        )
+
+
+class TestMetricName(TestCase):
+    def test_metric_name(self):
+        query = 'kube_pod_resource_request{resource="cpu", node!=""} unless on(pod, namespace) kube_pod_status_unschedulable'
+        self.assertEqual(promql.metric_name(query), "kube_pod_resource_request")
+        self.assertEqual(
+            promql.metric_name('kube_node_labels{node="a"}'), "kube_node_labels"
+        )
+
+    def test_metric_name_dropped(self):
+        self.assertIsNone(promql.metric_name("max by (pod) (kube_pod_labels{})"))
+        self.assertIsNone(
+            promql.metric_name("kube_pod_labels{} * on(pod) kube_pod_info{}")
+        )
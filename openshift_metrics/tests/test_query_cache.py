@@ -0,0 +1,98 @@
+import os
+import tempfile
+from datetime import datetime, timedelta, UTC
+from unittest import TestCase, mock
+
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.query_cache import QueryCache
+from openshift_metrics.tests.test_prometheus_client import fake_query_range
+
+RESULT = [{"metric": {"pod": "pod1"}, "values": [[1647216000, "1"]]}]
+
+
+class TestQueryCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = QueryCache(self.directory.name, 2**20, timedelta(hours=6))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        start = datetime(2022, 3, 14, tzinfo=UTC)
+        end = datetime(2022, 3, 14, 23, 59, 59, tzinfo=UTC)
+        key = self.cache.key("https://fake-url", "fake-metric", start, end, 15)
+        self.assertIsNone(self.cache.get(key))
+        self.cache.put(key, RESULT)
+        self.assertEqual(self.cache.get(key), RESULT)
+        self.assertNotEqual(
+            key, self.cache.key("https://other-url", "fake-metric", start, end, 15)
+        )
+        self.assertNotEqual(
+            key, self.cache.key("https://fake-url", "fake-metric", start, end, 5)
+        )
+
+    def test_unreadable_file(self):
+        with open(os.path.join(self.directory.name, "broken.json.gz"), "wb") as file:
+            file.write(b"not gzip")
+        self.assertIsNone(self.cache.get("broken"))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_is_cacheable(self):
+        now = datetime.now(UTC)
+        self.assertTrue(self.cache.is_cacheable(now - timedelta(hours=7)))
+        self.assertFalse(self.cache.is_cacheable(now - timedelta(hours=5)))
+
+    def test_evicts_least_recently_used(self):
+        for i, key in enumerate(["a", "b", "c"]):
+            self.cache.put(key, RESULT * 100)
+            os.utime(self.cache._path(key), (1000 + i, 1000 + i))
+        # reading "a" makes it the most recently used
+        self.cache.get("a")
+        file_size = os.path.getsize(self.cache._path("a"))
+        self.cache.max_bytes = 2 * file_size
+        self.cache.evict()
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), RESULT * 100)
+        self.assertEqual(self.cache.get("c"), RESULT * 100)
+
+
+class TestCachedQueries(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        cache = QueryCache(self.directory.name, 2**20, timedelta(hours=6))
+        self.prom_client = PrometheusClient(
+            "https://fake-url", "fake-token", cache=cache
+        )
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    @mock.patch("requests.Session.get")
+    def test_past_ranges_are_cached(self, mock_get):
+        mock_get.side_effect = fake_query_range
+        expected = self.prom_client.query_metric(
+            "fake-metric", "2022-03-14", "2022-03-16", shard="day"
+        )
+        self.assertEqual(mock_get.call_count, 3)
+
+        metrics = self.prom_client.query_metric(
+            "fake-metric", "2022-03-14", "2022-03-16", shard="day"
+        )
+        self.assertEqual(metrics, expected)
+        self.assertEqual(mock_get.call_count, 3)
+
+        # an overlapping run only fetches the day it hasn't seen yet
+        self.prom_client.query_metric(
+            "fake-metric", "2022-03-15", "2022-03-17", shard="day"
+        )
+        self.assertEqual(mock_get.call_count, 4)
+
+    @mock.patch("requests.Session.get")
+    def test_recent_ranges_are_not_cached(self, mock_get):
+        mock_get.side_effect = fake_query_range
+        today = datetime.now(UTC).strftime("%Y-%m-%d")
+        self.prom_client.query_metric("fake-metric", today, today)
+        self.prom_client.query_metric("fake-metric", today, today)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(os.listdir(self.directory.name), [])
@@ -0,0 +1,85 @@
+from datetime import datetime, UTC
+from unittest import TestCase, mock
+
+from openshift_metrics.query_planner import QueryPlanner
+
+
+def fake_prom_client(series_per_namespace, other_namespaces=()):
+    prom_client = mock.Mock(step_min=15, max_workers=4)
+    prom_client._label_values.return_value = [
+        *series_per_namespace,
+        *other_namespaces,
+    ]
+    prom_client.query_instant.return_value = [
+        {"metric": {"namespace": namespace}, "value": [0, str(count)]}
+        for namespace, count in series_per_namespace.items()
+    ]
+    return prom_client
+
+
+class TestQueryPlanner(TestCase):
+    start = datetime(2024, 1, 1, tzinfo=UTC)
+    end = datetime(2024, 1, 31, 23, 59, 59, tzinfo=UTC)
+
+    def test_small_query_is_not_split(self):
+        prom_client = fake_prom_client({"ns1": 10, "ns2": 20})
+        planner = QueryPlanner(prom_client, max_samples=1000000)
+        plan = planner.plan("fake-metric", self.start, self.end)
+        self.assertEqual(plan.series, 30)
+        self.assertEqual(plan.samples, 30 * 31 * 96)
+        self.assertIsNone(plan.shard)
+        self.assertEqual(plan.namespace_groups, [])
+        self.assertEqual(plan.concurrency, 1)
+        self.assertEqual(prom_client.query_instant.call_count, 3)
+        prom_client.query_instant.assert_called_with(
+            "count by (namespace) (fake-metric)", self.end
+        )
+
+    def test_large_query_is_split_by_time(self):
+        prom_client = fake_prom_client({"ns1": 100, "ns2": 200})
+        planner = QueryPlanner(prom_client, max_samples=300 * 96)
+        plan = planner.plan("fake-metric", self.start, self.end)
+        self.assertEqual(plan.shard, "day")
+        self.assertEqual(plan.namespace_groups, [])
+        self.assertEqual(plan.concurrency, 4)
+
+    def test_huge_query_is_split_by_namespace(self):
+        prom_client = fake_prom_client({"ns1": 100, "ns2": 200, "ns3": 50})
+        planner = QueryPlanner(prom_client, max_samples=250 * 4)
+        plan = planner.plan('fake_metric{node!=""}', self.start, self.end)
+        self.assertEqual(plan.shard, "hour")
+        self.assertEqual(plan.namespace_groups, [["ns2", "ns3"], ["ns1"]])
+
+    def test_namespaces_between_probes_are_grouped(self):
+        prom_client = fake_prom_client(
+            {"ns1": 100, "ns2": 200, "ns3": 50}, other_namespaces=["ns4"]
+        )
+        planner = QueryPlanner(prom_client, max_samples=250 * 4)
+        plan = planner.plan('fake_metric{node!=""}', self.start, self.end)
+        self.assertEqual(plan.namespace_groups, [["ns2", "ns3"], ["ns1", "ns4"]])
+        prom_client._label_values.assert_called_once_with(
+            "namespace", 'fake_metric{node!=""}', self.start, self.end
+        )
+
+    def test_query_without_namespace_is_not_partitioned(self):
+        self.assertEqual(
+            QueryPlanner.group_namespaces({"": 1000}, max_series=10),
+            [],
+        )
+
+    def test_query_metric_follows_plan(self):
+        prom_client = fake_prom_client({"ns1": 100, "ns2": 200})
+        prom_client.query_range.return_value = ["data"]
+        planner = QueryPlanner(prom_client, max_samples=300 * 96)
+        self.assertEqual(
+            planner.query_metric("fake-metric", "2024-01-01", "2024-01-31"),
+            ["data"],
+        )
+        prom_client.query_range.assert_called_once_with(
+            "fake-metric",
+            self.start,
+            self.end,
+            shard="day",
+            namespace_groups=[],
+            max_workers=4,
+        )
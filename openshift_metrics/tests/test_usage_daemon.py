@@ -0,0 +1,271 @@
+import os
+import tempfile
+from datetime import datetime, UTC
+from decimal import Decimal
+from unittest import TestCase, mock
+
+from openshift_metrics import invoice, utils
+from openshift_metrics import usage_daemon
+from openshift_metrics.metrics_processor import MetricsProcessor
+from openshift_metrics.usage_daemon import UsageState
+
+SU_DEFINITIONS = {
+    invoice.SU_CPU: {"GPUs": 0, "vCPUs": 1, "RAM": 4096},
+    invoice.SU_A100_GPU: {"GPUs": 1, "vCPUs": 24, "RAM": 74 * 1024},
+}
+RATES = invoice.Rates(
+    cpu=Decimal("0.5"),
+    gpu_a100=Decimal("2"),
+    gpu_a100sxm4=Decimal("2"),
+    gpu_v100=Decimal("1"),
+    gpu_h100=Decimal("6"),
+)
+STEP = 900
+# 2022-03-01T00:00:00Z
+MONTH_START = 1646092800
+
+
+def series(pod, values, namespace="ns1", resource="cpu", **labels):
+    return {
+        "metric": {
+            "namespace": namespace,
+            "pod": pod,
+            "node": "wrk-1",
+            "resource": resource,
+            **labels,
+        },
+        "values": [[MONTH_START + step * STEP, value] for step, value in values],
+    }
+
+
+# pod1 runs throughout and changes its request, pod2 stops and starts again,
+# pod3 stops for good, pod4 uses a GPU
+METRICS = {
+    "cpu_metrics": [
+        series("pod1", [(i, "1" if i < 10 else "2") for i in range(20)]),
+        series("pod2", [(i, "1") for i in list(range(3, 7)) + list(range(12, 20))]),
+        series("pod3", [(i, "4") for i in range(0, 9)], namespace="ns2"),
+        series("pod4", [(i, "8") for i in range(5, 20)], namespace="ns2"),
+    ],
+    "memory_metrics": [
+        series("pod1", [(i, str(2**30)) for i in range(20)], resource="memory"),
+        series(
+            "pod2",
+            [(i, str(2**30)) for i in list(range(3, 7)) + list(range(12, 20))],
+            resource="memory",
+        ),
+        series(
+            "pod3",
+            [(i, str(2**31)) for i in range(0, 9)],
+            namespace="ns2",
+            resource="memory",
+        ),
+        series(
+            "pod4",
+            [(i, str(2**33)) for i in range(5, 20)],
+            namespace="ns2",
+            resource="memory",
+        ),
+    ],
+    "gpu_metrics": [
+        series(
+            "pod4",
+            [(i, "1") for i in range(5, 20)],
+            namespace="ns2",
+            resource="nvidia.com/gpu",
+            label_nvidia_com_gpu_product=invoice.GPU_A100,
+        )
+    ],
+}
+
+
+def window(start_step, end_step):
+    """Returns the samples of METRICS from start_step through end_step"""
+    low = MONTH_START + start_step * STEP
+    high = MONTH_START + end_step * STEP
+    windowed = {}
+    for name, metrics in METRICS.items():
+        windowed[name] = []
+        for metric in metrics:
+            values = [v for v in metric["values"] if low <= v[0] <= high]
+            if values:
+                windowed[name].append({"metric": metric["metric"], "values": values})
+    return windowed
+
+
+def full_su_hours(last_step, ignore_hours=None):
+    """The SU hours of every namespace when processing all samples at once"""
+    processor = MetricsProcessor(interval_minutes=15)
+    metrics = window(0, last_step)
+    processor.merge_metrics("cpu_request", metrics["cpu_metrics"])
+    processor.merge_metrics("memory_request", metrics["memory_metrics"])
+    processor.merge_metrics("gpu_request", metrics["gpu_metrics"])
+    su_hours = {}
+    for namespace, pods in processor.condense_metrics(
+        usage_daemon.METRICS_TO_CHECK
+    ).items():
+        project_invoice = invoice.ProjectInvoce(
+            project=namespace,
+            project_id=namespace,
+            rates=RATES,
+            su_definitions=SU_DEFINITIONS,
+            ignore_hours=ignore_hours,
+        )
+        for pod, pod_dict in pods.items():
+            for start_time, pod_metric_dict in pod_dict["metrics"].items():
+                project_invoice.add_pod(
+                    UsageState._pod(
+                        namespace,
+                        pod,
+                        start_time,
+                        pod_metric_dict["duration"],
+                        pod_metric_dict,
+                    )
+                )
+        su_hours[namespace] = project_invoice.su_hours
+    return su_hours
+
+
+class TestUsageState(TestCase):
+    def test_start_of_month(self):
+        state = UsageState.start_of_month("2022-03", 15)
+        self.assertEqual(state.watermark, MONTH_START - STEP)
+        self.assertEqual(state.next_month_start(), 1648771200)
+
+    def run_updates(self, watermarks, save_to=None, ignore_hours=None):
+        state = UsageState.start_of_month("2022-03", 15)
+        previous = -1
+        for watermark in watermarks:
+            state.add_samples(
+                window(previous + 1, watermark),
+                MONTH_START + watermark * STEP,
+                SU_DEFINITIONS,
+                ignore_hours,
+            )
+            if save_to:
+                state.save(save_to)
+                state = UsageState.load(save_to)
+            previous = watermark
+        return state
+
+    def su_hours(self, state, ignore_hours=None):
+        return {
+            namespace: project_invoice.su_hours
+            for namespace, project_invoice in state.project_invoices(
+                RATES, SU_DEFINITIONS, ignore_hours
+            ).items()
+        }
+
+    def test_incremental_updates_match_full_processing(self):
+        for watermarks in ([19], [0, 1, 2, 19], [4, 9, 10, 11, 15, 19], range(20)):
+            with self.subTest(watermarks=watermarks):
+                state = self.run_updates(watermarks)
+                self.assertEqual(self.su_hours(state), full_su_hours(19))
+                # only the last sample of the running pods is kept
+                self.assertEqual(
+                    {
+                        pod: list(pod_dict["metrics"])
+                        for pods in state.merged_data.values()
+                        for pod, pod_dict in pods.items()
+                    },
+                    {
+                        pod: [MONTH_START + 19 * STEP]
+                        for pod in ("pod1", "pod2", "pod4")
+                    },
+                )
+
+    def test_state_is_saved_between_updates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            state = self.run_updates(
+                [4, 9, 12, 19], save_to=os.path.join(directory, "state.json")
+            )
+        self.assertEqual(self.su_hours(state), full_su_hours(19))
+
+    def test_totals_up_to_the_watermark(self):
+        state = self.run_updates([7, 14])
+        self.assertEqual(self.su_hours(state), full_su_hours(14))
+
+    def test_ignore_hours(self):
+        ignore_hours = [
+            (
+                datetime.fromtimestamp(MONTH_START + 5 * STEP, UTC),
+                datetime.fromtimestamp(MONTH_START + 13 * STEP, UTC),
+            )
+        ]
+        state = self.run_updates([4, 9, 15], ignore_hours=ignore_hours)
+        expected = full_su_hours(15, ignore_hours)
+        self.assertNotEqual(expected, full_su_hours(15))
+        self.assertEqual(self.su_hours(state, ignore_hours), expected)
+        state.close_all(SU_DEFINITIONS, ignore_hours)
+        self.assertEqual(state.su_hours, expected)
+
+    def test_close_all(self):
+        state = self.run_updates([9, 19])
+        state.close_all(SU_DEFINITIONS)
+        self.assertEqual(state.open_since, {})
+        self.assertEqual(state.su_hours, full_su_hours(19))
+
+
+class FakePrometheusClient:
+    def __init__(self):
+        self.ranges = []
+
+    def query_range(self, metric, start, end):
+        self.ranges.append((start, end))
+        resource = "memory" if "memory" in metric else "cpu"
+        if "nvidia" in metric:
+            raise utils.EmptyResultError("no GPUs")
+        return [series("pod1", [(i, "1") for i in range(2880)], resource=resource)]
+
+
+class TestUpdate(TestCase):
+    def test_update_fetches_complete_steps_of_the_month(self):
+        prom_client = FakePrometheusClient()
+        state = UsageState.start_of_month("2022-03", 15)
+        usage_daemon.update(
+            prom_client, state, datetime(2022, 3, 2, 1, 7, tzinfo=UTC), SU_DEFINITIONS
+        )
+        self.assertEqual(
+            prom_client.ranges[0],
+            (datetime(2022, 3, 1, tzinfo=UTC), datetime(2022, 3, 2, 0, 45, tzinfo=UTC)),
+        )
+        self.assertEqual(state.watermark, MONTH_START + 99 * STEP)
+
+        # nothing new yet
+        prom_client.ranges = []
+        usage_daemon.update(
+            prom_client, state, datetime(2022, 3, 2, 1, 14, tzinfo=UTC), SU_DEFINITIONS
+        )
+        self.assertEqual(prom_client.ranges, [])
+
+        # the next update stops at the end of the month
+        usage_daemon.update(
+            prom_client, state, datetime(2022, 4, 1, 3, tzinfo=UTC), SU_DEFINITIONS
+        )
+        self.assertEqual(
+            prom_client.ranges[0],
+            (
+                datetime(2022, 3, 2, 1, tzinfo=UTC),
+                datetime(2022, 3, 31, 23, 45, tzinfo=UTC),
+            ),
+        )
+        self.assertEqual(state.watermark + STEP, state.next_month_start())
+
+    def test_write_report(self):
+        state = UsageState.start_of_month("2022-03", 15)
+        state.add_samples(window(0, 19), MONTH_START + 19 * STEP, SU_DEFINITIONS)
+        with mock.patch.object(utils, "csv_writer") as csv_writer:
+            usage_daemon.write_report(
+                state, "usage.csv", "ocp-prod", RATES, SU_DEFINITIONS
+            )
+        rows = csv_writer.call_args.args[0]
+        self.assertEqual(rows[0], utils.INVOICE_HEADERS)
+        self.assertEqual(
+            [(row[3], row[11], row[12]) for row in rows[1:]],
+            [
+                ("ns1", 11, invoice.SU_CPU),
+                ("ns2", 9, invoice.SU_CPU),
+                ("ns2", 4, invoice.SU_A100_GPU),
+            ],
+        )
+        self.assertEqual(rows[1][2], "2022-03-01T05:00:00+00:00")
@@ -10,8 +10,9 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 #
+import gzip
 import tempfile
-from unittest import TestCase
+from unittest import TestCase, mock
 from decimal import Decimal
 
 from openshift_metrics import utils, invoice, merge
@@ -28,6 +29,59 @@ RATES = invoice.Rates(
 SU_DEFINITIONS = merge.get_su_definitions("2025-04")
 
 
+class TestS3MultipartUpload(TestCase):
+    def setUp(self):
+        self.s3 = mock.MagicMock()
+        self.s3.create_multipart_upload.return_value = {"UploadId": "upload-1"}
+        self.s3.upload_part.side_effect = lambda **kwargs: {
+            "ETag": f"etag-{kwargs['PartNumber']}"
+        }
+        patcher = mock.patch.object(utils, "get_s3_client", return_value=self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def bodies(self):
+        return [c.kwargs["Body"] for c in self.s3.upload_part.call_args_list]
+
+    def test_parts(self):
+        with utils.S3MultipartUpload("bucket", "key", part_bytes=4) as upload:
+            upload.write(b"abcdef")
+            upload.write(b"ghij")
+            self.assertEqual(self.bodies(), [b"abcd", b"efgh"])
+            self.s3.complete_multipart_upload.assert_not_called()
+
+        self.assertEqual(self.bodies(), [b"abcd", b"efgh", b"ij"])
+        self.s3.complete_multipart_upload.assert_called_once_with(
+            Bucket="bucket",
+            Key="key",
+            UploadId="upload-1",
+            MultipartUpload={
+                "Parts": [
+                    {"ETag": "etag-1", "PartNumber": 1},
+                    {"ETag": "etag-2", "PartNumber": 2},
+                    {"ETag": "etag-3", "PartNumber": 3},
+                ]
+            },
+        )
+
+    def test_abort(self):
+        with self.assertRaises(RuntimeError):
+            with utils.S3MultipartUpload("bucket", "key", part_bytes=4) as upload:
+                upload.write(b"abcdef")
+                raise RuntimeError
+        self.s3.complete_multipart_upload.assert_not_called()
+        self.s3.abort_multipart_upload.assert_called_once_with(
+            Bucket="bucket", Key="key", UploadId="upload-1"
+        )
+
+    def test_gzip_to_s3(self):
+        with utils.gzip_to_s3("bucket", "key.json.gz") as file:
+            file.write('{"cluster_name": "test"}')
+        self.assertEqual(
+            gzip.decompress(b"".join(self.bodies())), b'{"cluster_name": "test"}'
+        )
+
+
 class TestWriteMetricsByPod(TestCase):
     def test_write_metrics_log(self):
         test_metrics_dict = {
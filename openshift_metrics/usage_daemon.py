@@ -0,0 +1,474 @@
+"""
+Keeps the month-to-date usage of a cluster current by fetching only the
+samples that are newer than the last update
+"""
+
+import argparse
+import functools
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, UTC
+from decimal import Decimal
+
+from nerc_rates import outages
+
+from openshift_metrics import invoice, promql, utils
+from openshift_metrics.merge import (
+    get_su_definitions,
+    load_nerc_rates,
+    parse_timestamp_range,
+)
+from openshift_metrics.metrics_processor import MetricsProcessor
+from openshift_metrics.openshift_prometheus_metrics import (
+    CPU_REQUEST,
+    GPU_REQUEST,
+    KUBE_NODE_LABELS,
+    MEMORY_REQUEST,
+    PROJECTED_LABELS,
+    URL_CLUSTER_NAME_MAPPING,
+)
+from openshift_metrics.prometheus_client import PrometheusClient
+from openshift_metrics.config import (
+    OPENSHIFT_PROMETHEUS_URL,
+    OPENSHIFT_TOKEN,
+    PROM_QUERY_INTERVAL_MINUTES,
+    PROM_QUERY_CONCURRENCY,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS_TO_CHECK = ["cpu_request", "memory_request", "gpu_request", "gpu_type"]
+
+
+class UsageState:
+    """
+    What is known about the usage of a month so far, saved between updates.
+
+    The watermark is the time of the last step that has been fetched. Pods
+    that had a sample at the watermark are still running; only their last
+    sample and the start of their current stretch are kept, in the
+    MetricsProcessor merged_data shape. The stretches that have ended are
+    added up into the SU hours of their namespace, by SU type, like
+    ProjectInvoce does, and their samples are dropped. A stretch's overlap
+    with the ignore hours is left out when it is added up, so outages have
+    to be known by the time a stretch ends to be left out of its hours.
+    """
+
+    def __init__(
+        self,
+        month: str,
+        interval_minutes: int,
+        watermark: int,
+        merged_data: dict = None,
+        open_since: dict = None,
+        su_hours: dict = None,
+    ):
+        self.month = month
+        self.interval_minutes = interval_minutes
+        self.watermark = watermark
+        self.merged_data = merged_data if merged_data is not None else {}
+        self.open_since = open_since if open_since is not None else {}
+        self.su_hours = su_hours if su_hours is not None else {}
+
+    @property
+    def step(self) -> int:
+        return self.interval_minutes * 60
+
+    @classmethod
+    def start_of_month(cls, month: str, interval_minutes: int):
+        """Returns the state of month before anything has been fetched"""
+        step = interval_minutes * 60
+        month_start = int(
+            datetime.strptime(month, "%Y-%m").replace(tzinfo=UTC).timestamp()
+        )
+        # the first step of the month is the first one the watermark is before
+        return cls(month, interval_minutes, -(-month_start // step) * step - step)
+
+    def next_month_start(self) -> int:
+        month_start = datetime.strptime(self.month, "%Y-%m").replace(tzinfo=UTC)
+        return int((month_start + timedelta(days=32)).replace(day=1).timestamp())
+
+    @classmethod
+    def load(cls, file_name):
+        """Reads the state from file_name"""
+        with open(file_name) as file:
+            state = json.load(file)
+        # JSON turns the sample times into strings
+        merged_data = {
+            namespace: {
+                pod: {
+                    **pod_dict,
+                    "metrics": {
+                        int(epoch_time): sample
+                        for epoch_time, sample in pod_dict["metrics"].items()
+                    },
+                }
+                for pod, pod_dict in pods.items()
+            }
+            for namespace, pods in state["merged_data"].items()
+        }
+        su_hours = {
+            namespace: {su_type: Decimal(hours) for su_type, hours in hours.items()}
+            for namespace, hours in state["su_hours"].items()
+        }
+        return cls(
+            state["month"],
+            state["interval_minutes"],
+            state["watermark"],
+            merged_data,
+            state["open_since"],
+            su_hours,
+        )
+
+    def save(self, file_name):
+        """Writes the state to file_name, replacing it all at once"""
+        with open(f"{file_name}.tmp", "w") as file:
+            json.dump(
+                {
+                    "month": self.month,
+                    "interval_minutes": self.interval_minutes,
+                    "watermark": self.watermark,
+                    "merged_data": self.merged_data,
+                    "open_since": self.open_since,
+                    "su_hours": {
+                        namespace: {su_type: str(h) for su_type, h in hours.items()}
+                        for namespace, hours in self.su_hours.items()
+                    },
+                },
+                file,
+            )
+        os.replace(f"{file_name}.tmp", file_name)
+
+    def _project_invoice(self, namespace, su_definitions, ignore_hours=None):
+        project_invoice = invoice.ProjectInvoce(
+            project=namespace,
+            project_id=namespace,
+            rates=None,
+            su_definitions=su_definitions,
+            ignore_hours=ignore_hours,
+        )
+        project_invoice.su_hours = self.su_hours.setdefault(
+            namespace, project_invoice.su_hours
+        )
+        return project_invoice
+
+    @staticmethod
+    def _pod(namespace, pod, start_time, duration, pod_metric_dict) -> invoice.Pod:
+        return invoice.Pod(
+            pod_name=pod,
+            namespace=namespace,
+            start_time=start_time,
+            duration=duration,
+            cpu_request=Decimal(pod_metric_dict.get("cpu_request", 0)),
+            gpu_request=Decimal(pod_metric_dict.get("gpu_request", 0)),
+            memory_request=Decimal(pod_metric_dict.get("memory_request", 0)) / 2**30,
+            gpu_type=pod_metric_dict.get("gpu_type"),
+            gpu_resource=pod_metric_dict.get("gpu_resource"),
+            node_hostname=pod_metric_dict.get("node"),
+            node_model=pod_metric_dict.get("node_model"),
+        )
+
+    def add_samples(
+        self, metrics_dict, watermark: int, su_definitions, ignore_hours=None
+    ):
+        """
+        Adds the resource requests fetched from after the current watermark
+        up to watermark, which becomes the new one. Stretches that ended are
+        added to the SU hours, the ones still running at watermark are kept.
+        """
+        processor = MetricsProcessor(
+            interval_minutes=self.interval_minutes, merged_data=self.merged_data
+        )
+        processor.merge_metrics("cpu_request", metrics_dict["cpu_metrics"])
+        processor.merge_metrics("memory_request", metrics_dict["memory_metrics"])
+        processor.merge_metrics("gpu_request", metrics_dict.get("gpu_metrics", []))
+        condensed_metrics_dict = processor.condense_metrics(METRICS_TO_CHECK)
+
+        merged_data = {}
+        open_since = {}
+        for namespace, pods in condensed_metrics_dict.items():
+            for pod, pod_dict in pods.items():
+                stretches = sorted(pod_dict["metrics"].items())
+                for i, (start_time, pod_metric_dict) in enumerate(stretches):
+                    duration = pod_metric_dict["duration"]
+                    # the first stretch may carry on one from an earlier update
+                    if i == 0 and pod in self.open_since.get(namespace, {}):
+                        since = self.open_since[namespace][pod]
+                        duration += start_time - since
+                        start_time = since
+                    last_sample = start_time + duration - self.step
+                    if i == len(stretches) - 1 and last_sample == watermark:
+                        samples = processor.merged_data[namespace][pod]["metrics"]
+                        merged_data.setdefault(namespace, {})[pod] = {
+                            **pod_dict,
+                            "metrics": {last_sample: samples[last_sample]},
+                        }
+                        open_since.setdefault(namespace, {})[pod] = start_time
+                    else:
+                        self._project_invoice(
+                            namespace, su_definitions, ignore_hours
+                        ).add_pod(
+                            self._pod(
+                                namespace, pod, start_time, duration, pod_metric_dict
+                            )
+                        )
+        self.merged_data = merged_data
+        self.open_since = open_since
+        self.watermark = watermark
+
+    def _open_pods(self):
+        """Yields the running pods as invoice.Pods lasting up to the watermark"""
+        for namespace, pods in self.open_since.items():
+            for pod, since in pods.items():
+                pod_metric_dict = self.merged_data[namespace][pod]["metrics"][
+                    self.watermark
+                ]
+                duration = self.watermark - since + self.step
+                yield (
+                    namespace,
+                    self._pod(namespace, pod, since, duration, pod_metric_dict),
+                )
+
+    def close_all(self, su_definitions, ignore_hours=None):
+        """Ends the stretches of all running pods at the watermark"""
+        for namespace, pod in list(self._open_pods()):
+            self._project_invoice(namespace, su_definitions, ignore_hours).add_pod(pod)
+        self.merged_data = {}
+        self.open_since = {}
+
+    def project_invoices(
+        self, rates: invoice.Rates, su_definitions, ignore_hours=None
+    ) -> dict:
+        """Returns the ProjectInvoces of every namespace up to the watermark"""
+        project_invoices = {}
+        for namespace in sorted(set(self.su_hours) | set(self.open_since)):
+            project_invoice = invoice.ProjectInvoce(
+                project=namespace,
+                project_id=namespace,
+                rates=rates,
+                su_definitions=su_definitions,
+                ignore_hours=ignore_hours,
+            )
+            project_invoice.su_hours.update(self.su_hours.get(namespace, {}))
+            project_invoices[namespace] = project_invoice
+        for namespace, pod in self._open_pods():
+            project_invoices[namespace].add_pod(pod)
+        return project_invoices
+
+
+def fetch_samples(prom_client, start: datetime, end: datetime) -> dict:
+    """
+    Fetches the resource requests between start and end, keeping only the
+    labels the metrics processor reads
+    """
+    metrics_dict = {}
+    metrics_dict["cpu_metrics"] = prom_client.query_range(
+        promql.project_labels(CPU_REQUEST, PROJECTED_LABELS), start, end
+    )
+    metrics_dict["memory_metrics"] = prom_client.query_range(
+        promql.project_labels(MEMORY_REQUEST, PROJECTED_LABELS), start, end
+    )
+    # because if nobody requests a GPU then we will get an empty set
+    try:
+        gpu_request_metrics = prom_client.query_range(
+            promql.project_labels(GPU_REQUEST, PROJECTED_LABELS), start, end
+        )
+        node_labels = prom_client.query_series(
+            KUBE_NODE_LABELS, f"{start:%Y-%m-%d}", f"{end:%Y-%m-%d}"
+        )
+        metrics_dict["gpu_metrics"] = MetricsProcessor.insert_node_labels(
+            node_labels, gpu_request_metrics
+        )
+    except utils.EmptyResultError:
+        logger.info(f"No GPU metrics found from {start} to {end}")
+    return metrics_dict
+
+
+def update(
+    prom_client, state: UsageState, now: datetime, su_definitions, ignore_hours=None
+):
+    """
+    Fetches the steps after the watermark that are complete by now, up to
+    the end of the state's month, and adds them to state.
+    """
+    step = state.step
+    # the newest step is left for later, not every target has been scraped for it
+    end = min(
+        int(now.timestamp()) // step * step - step,
+        (state.next_month_start() - 1) // step * step,
+    )
+    start = state.watermark + step
+    if start > end:
+        return
+    logger.info(
+        f"Fetching {(end - start) // step + 1} steps from {datetime.fromtimestamp(start, UTC)}"
+    )
+    metrics_dict = fetch_samples(
+        prom_client,
+        datetime.fromtimestamp(start, UTC),
+        datetime.fromtimestamp(end, UTC),
+    )
+    state.add_samples(metrics_dict, end, su_definitions, ignore_hours)
+
+
+def write_report(
+    state: UsageState, file_name, cluster_name, rates, su_definitions, ignore_hours=None
+):
+    """Writes the month-to-date invoice rows of state to file_name"""
+    report_metadata = invoice.ReportMetadata(
+        report_month=state.month,
+        cluster_name=cluster_name,
+        report_start_time=datetime.strptime(state.month, "%Y-%m").replace(tzinfo=UTC),
+        report_end_time=datetime.fromtimestamp(state.watermark + state.step, UTC),
+        generated_at=datetime.now(UTC),
+    )
+    rows = [utils.INVOICE_HEADERS]
+    for project_invoice in state.project_invoices(
+        rates, su_definitions, ignore_hours
+    ).values():
+        rows.extend(project_invoice.generate_invoice_rows(report_metadata))
+    utils.csv_writer(rows, file_name)
+
+
+def main():
+    """Updates the month-to-date usage every --poll-minutes"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--openshift-url",
+        help="OpenShift Prometheus URL",
+        default=OPENSHIFT_PROMETHEUS_URL,
+    )
+    parser.add_argument(
+        "--state-file",
+        default="usage-state.json",
+        help="Where the usage so far is kept between updates and restarts",
+    )
+    parser.add_argument(
+        "--output-file",
+        help="Name of the usage file. Defaults to Usage NERC OpenShift <report_month>.csv",
+    )
+    parser.add_argument(
+        "--poll-minutes",
+        type=int,
+        default=15,
+        help="How often the newest samples are fetched",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Update the usage once and exit, for running from a CronJob",
+    )
+    parser.add_argument(
+        "--use-nerc-rates",
+        action="store_true",
+        help="Use rates and outages from the nerc-rates repo",
+    )
+    parser.add_argument(
+        "--ignore-hours",
+        type=parse_timestamp_range,
+        nargs="*",
+        help="List of timestamp ranges in UTC to ignore in the format 'YYYY-MM-DDTHH:MM:SS,YYYY-MM-DDTHH:MM:SS'",
+    )
+    parser.add_argument("--rate-cpu-su", type=Decimal)
+    parser.add_argument("--rate-gpu-v100-su", type=Decimal)
+    parser.add_argument("--rate-gpu-a100sxm4-su", type=Decimal)
+    parser.add_argument("--rate-gpu-a100-su", type=Decimal)
+    parser.add_argument("--rate-gpu-h100-su", type=Decimal)
+
+    args = parser.parse_args()
+    if not args.openshift_url:
+        sys.exit(
+            "Must specify --openshift-url or set OPENSHIFT_PROMETHEUS_URL in your environment"
+        )
+    cluster_name = URL_CLUSTER_NAME_MAPPING.get(args.openshift_url, args.openshift_url)
+
+    if os.path.exists(args.state_file):
+        state = UsageState.load(args.state_file)
+        if state.interval_minutes != PROM_QUERY_INTERVAL_MINUTES:
+            sys.exit(
+                f"{args.state_file} was collected at {state.interval_minutes} minute intervals, not {PROM_QUERY_INTERVAL_MINUTES}"
+            )
+    else:
+        state = UsageState.start_of_month(
+            datetime.now(UTC).strftime("%Y-%m"), PROM_QUERY_INTERVAL_MINUTES
+        )
+
+    su_definitions = functools.cache(get_su_definitions)
+
+    @functools.cache
+    def invoice_rates(report_month):
+        if args.use_nerc_rates:
+            return load_nerc_rates(report_month)
+        return invoice.Rates(
+            cpu=Decimal(args.rate_cpu_su),
+            gpu_a100=Decimal(args.rate_gpu_a100_su),
+            gpu_a100sxm4=Decimal(args.rate_gpu_a100sxm4_su),
+            gpu_v100=Decimal(args.rate_gpu_v100_su),
+            gpu_h100=Decimal(args.rate_gpu_h100_su),
+        )
+
+    def ignore_hours(state):
+        if not args.use_nerc_rates:
+            return args.ignore_hours
+        # outages are looked up on every update, they may be added during the month
+        next_month = datetime.fromtimestamp(state.next_month_start(), UTC)
+        return outages.load_from_url().get_outages_during(
+            f"{state.month}-01", f"{next_month:%Y-%m-%d}", cluster_name
+        )
+
+    def report(state, month_ignore_hours):
+        output_file = args.output_file or f"Usage NERC OpenShift {state.month}.csv"
+        write_report(
+            state,
+            output_file,
+            cluster_name,
+            invoice_rates(state.month),
+            su_definitions(state.month),
+            month_ignore_hours,
+        )
+
+    # the catch up at the start of a month is fetched a day at a time
+    with PrometheusClient(
+        args.openshift_url,
+        OPENSHIFT_TOKEN,
+        PROM_QUERY_INTERVAL_MINUTES,
+        max_workers=PROM_QUERY_CONCURRENCY,
+        shard="day",
+    ) as prom_client:
+        while True:
+            try:
+                month_ignore_hours = ignore_hours(state)
+                update(
+                    prom_client,
+                    state,
+                    datetime.now(UTC),
+                    su_definitions(state.month),
+                    month_ignore_hours,
+                )
+                if state.watermark + state.step >= state.next_month_start():
+                    # a month's invoice only covers its own samples
+                    state.close_all(su_definitions(state.month), month_ignore_hours)
+                    report(state, month_ignore_hours)
+                    logger.info(f"Finished the usage of {state.month}")
+                    next_month = datetime.fromtimestamp(state.next_month_start(), UTC)
+                    state = UsageState(
+                        next_month.strftime("%Y-%m"),
+                        state.interval_minutes,
+                        state.watermark,
+                    )
+                    continue
+                state.save(args.state_file)
+                report(state, month_ignore_hours)
+            except Exception:
+                logger.exception("Updating the usage failed, trying again later")
+            if args.once:
+                break
+            time.sleep(args.poll_minutes * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,14 +14,19 @@
 """Holds bunch of utility functions"""
 
 import csv
+import functools
+import gzip
 import boto3
+import botocore.exceptions
 import logging
+from contextlib import contextmanager
 
 from openshift_metrics import invoice
 from openshift_metrics.config import (
     S3_ENDPOINT_URL,
     S3_ACCESS_KEY_ID,
     S3_SECRET_ACCESS_KEY,
+    S3_MULTIPART_PART_BYTES,
 )
 from decimal import Decimal
 
@@ -29,26 +34,164 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+# The columns of the invoice rows ProjectInvoce generates
+INVOICE_HEADERS = [
+    "Invoice Month",
+    "Report Start Time",
+    "Report End Time",
+    "Project - Allocation",
+    "Project - Allocation ID",
+    "Manager (PI)",
+    "Cluster Name",
+    "Invoice Email",
+    "Invoice Address",
+    "Institution",
+    "Institution - Specific Code",
+    "SU Hours (GBhr or SUhr)",
+    "SU Type",
+    "Rate",
+    "Cost",
+    "Generated At",
+]
+
+
 class EmptyResultError(Exception):
     """Raise when no results are retrieved for a query"""
 
 
-def upload_to_s3(file, bucket, location):
+class QueryTooLargeError(Exception):
+    """Raise when prometheus refuses a query because it would return too much data"""
+
+
+class RequestBudgetError(Exception):
+    """Raise when a run has sent as many requests to prometheus as it may"""
+
+
+@functools.cache
+def get_s3_client():
+    """Returns the S3 client, which is created once and shared by all threads"""
     if not S3_ACCESS_KEY_ID or not S3_SECRET_ACCESS_KEY:
         raise Exception(
             "Must provide S3_OUTPUT_ACCESS_KEY_ID and"
             " S3_OUTPUT_SECRET_ACCESS_KEY environment variables."
         )
-    s3 = boto3.client(
+    return boto3.client(
         "s3",
         endpoint_url=S3_ENDPOINT_URL,
         aws_access_key_id=S3_ACCESS_KEY_ID,
         aws_secret_access_key=S3_SECRET_ACCESS_KEY,
     )
+
+
+def upload_to_s3(file, bucket, location):
+    s3 = get_s3_client()
     logger.info(f"Uploading {file} to s3://{bucket}/{location}")
     s3.upload_file(file, Bucket=bucket, Key=location)
 
 
+class S3MultipartUpload:
+    """
+    A binary file object that uploads what's written to it to
+    s3://bucket/location as a multipart upload. Only the part being filled
+    is held in memory and nothing is written to disk. The upload is
+    completed when the object is closed, and aborted if the with block
+    raises, so no object is left behind for a failed run.
+    """
+
+    def __init__(self, bucket, location, part_bytes=S3_MULTIPART_PART_BYTES):
+        self.bucket = bucket
+        self.location = location
+        self.name = f"s3://{bucket}/{location}"
+        self.part_bytes = part_bytes
+        self._s3 = get_s3_client()
+        self._buffer = bytearray()
+        self._parts = []
+        logger.info(f"Uploading to {self.name}")
+        self._upload_id = self._s3.create_multipart_upload(Bucket=bucket, Key=location)[
+            "UploadId"
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.part_bytes:
+            self._upload_part(self._buffer[: self.part_bytes])
+            del self._buffer[: self.part_bytes]
+        return len(data)
+
+    def flush(self):
+        """Parts other than the last must be full, so they're only sent when they are"""
+
+    def _upload_part(self, data):
+        part_number = len(self._parts) + 1
+        response = self._s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.location,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(data),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """Uploads what's left as the last part and completes the upload"""
+        if self._buffer or not self._parts:
+            self._upload_part(self._buffer)
+            self._buffer = bytearray()
+        self._s3.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.location,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        """Drops the parts uploaded so far"""
+        logger.warning(f"Aborting the upload to {self.name}")
+        self._s3.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.location, UploadId=self._upload_id
+        )
+
+
+@contextmanager
+def gzip_to_s3(bucket, location):
+    """Yields a text file that is gzipped and uploaded to s3://bucket/location as it's written"""
+    with S3MultipartUpload(bucket, location) as upload, gzip.open(upload, "wt") as file:
+        yield file
+
+
+def download_from_s3(bucket, location, file) -> bool:
+    """Downloads s3://bucket/location to file, returns False if there's no such object"""
+    s3 = get_s3_client()
+    logger.info(f"Downloading s3://{bucket}/{location} to {file}")
+    try:
+        s3.download_file(Bucket=bucket, Key=location, Filename=file)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise
+    return True
+
+
+def list_s3_keys(bucket, prefix="") -> list:
+    """Returns the keys of all objects in bucket that start with prefix"""
+    s3 = get_s3_client()
+    keys = []
+    for page in s3.get_paginator("list_objects_v2").paginate(
+        Bucket=bucket, Prefix=prefix
+    ):
+        keys.extend(item["Key"] for item in page.get("Contents", []))
+    return keys
+
+
 def csv_writer(rows, file_name):
     """Writes rows as csv to file_name"""
     logger.info(f"Writing report to {file_name}")
@@ -70,26 +213,7 @@ def write_metrics_by_namespace(
     """
     invoices = {}
     rows = []
-    headers = [
-        "Invoice Month",
-        "Report Start Time",
-        "Report End Time",
-        "Project - Allocation",
-        "Project - Allocation ID",
-        "Manager (PI)",
-        "Cluster Name",
-        "Invoice Email",
-        "Invoice Address",
-        "Institution",
-        "Institution - Specific Code",
-        "SU Hours (GBhr or SUhr)",
-        "SU Type",
-        "Rate",
-        "Cost",
-        "Generated At",
-    ]
-
-    rows.append(headers)
+    rows.append(INVOICE_HEADERS)
 
     for namespace, pods in condensed_metrics_dict.items():
         if namespace not in invoices:
@@ -194,26 +318,7 @@ def write_metrics_by_classes(
     """
     invoices = {}
     rows = []
-    headers = [
-        "Invoice Month",
-        "Report Start Time",
-        "Report End Time",
-        "Project - Allocation",
-        "Project - Allocation ID",
-        "Manager (PI)",
-        "Cluster Name",
-        "Invoice Email",
-        "Invoice Address",
-        "Institution",
-        "Institution - Specific Code",
-        "SU Hours (GBhr or SUhr)",
-        "SU Type",
-        "Rate",
-        "Cost",
-        "Generated At",
-    ]
-
-    rows.append(headers)
+    rows.append(INVOICE_HEADERS)
 
     for namespace, pods in condensed_metrics_dict.items():
         if namespace not in namespaces_with_classes: